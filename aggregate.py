@@ -14,133 +14,58 @@
  limitations under the License.
 """
 
-from process_results import *
-import os
-import numpy as np
-
-
-def load_1Client_Experiment():
-    os.chdir('1Client_IdealBenchmark')
-    data = parse_client_stats(0)
-    os.chdir('..')
-    return data
-
-
-def load_5Clients_Experiment():
-    os.chdir('5Clients_IdealBenchmark')
-    results = []
-    for i in range(5):
-        results.append(parse_client_stats(i))
-    os.chdir('..')
-    return results
-
-
-def load_10Clients_Experiment():
-    os.chdir('10Clients_IdealBenchmark')
-    results = []
-    for i in range(10):
-        results.append(parse_client_stats(i))
-    os.chdir('..')
-    return results
-
-def load_system_stats():
-    df = pd.read_csv('system_stats.csv')
-    start_time = df['timestamp'][0]
-    df['timestamp'] = (df['timestamp'] - start_time) / (60 * 1000.0)
-    df['avg_cpu_load'] = df['cpu_load'].rolling(11, center=True).mean()
+import matplotlib.pyplot as plt
+
+from plot_results import autolabel
+from query import collect_metrics
+from timeseries import system_timeline
+
+BENCHMARKS = (('1Client_Benchmark', '1 client'),
+              ('5Clients_Benchmark', '5 clients'),
+              ('10Clients_Benchmark', '10 clients'))
+
+
+def load_system_stats(exp_dir='.'):
+    # envelope of the CPU load across runs, downsampled for plotting
+    df = system_timeline(exp_dir, 'cpu_load')
+    df['time'] = df['time'] / 60.0
     return df
 
 
 def plot_avg_times():
-    c1 = load_1Client_Experiment()
-    c5 = load_5Clients_Experiment()
-    c10 = load_10Clients_Experiment()
-
-    avg_up = [c1['avg_up']]
-    avg_proc = [c1['avg_proc']]
-    avg_down = [c1['avg_down']]
-
-    sum_up = 0
-    count_up = 0
-    sum_down = 0
-    count_down = 0
-    sum_proc = 0
-    count_proc = 0
-
-    for c in c5:
-        sum_up += c['avg_up'] * c['count_up']
-        sum_down += c['avg_down'] * c['count_down']
-        sum_proc += c['avg_proc'] * c['count_proc']
-
-        count_up += c['count_up']
-        count_down += c['count_down']
-        count_proc += c['count_proc']
-
-    avg_up.append(sum_up / float(count_up))
-    avg_down.append(sum_down / float(count_down))
-    avg_proc.append(sum_proc / float(count_proc))
-
-    sum_up = 0
-    count_up = 0
-    sum_down = 0
-    count_down = 0
-    sum_proc = 0
-    count_proc = 0
-
-    for c in c10:
-        sum_up += c['avg_up'] * c['count_up']
-        sum_down += c['avg_down'] * c['count_down']
-        sum_proc += c['avg_proc'] * c['count_proc']
-
-        count_up += c['count_up']
-        count_down += c['count_down']
-        count_proc += c['count_proc']
-
-    avg_up.append(sum_up / float(count_up))
-    avg_down.append(sum_down / float(count_down))
-    avg_proc.append(sum_proc / float(count_proc))
+    # means over the frames of all clients of each experiment
+    data = collect_metrics(dict((label, exp_dir)
+                                for exp_dir, label in BENCHMARKS),
+                           ('uplink', 'processing', 'downlink'))
+    x = list(data.keys())
+    avg_up = [df['uplink'].mean() for df in data.values()]
+    avg_proc = [df['processing'].mean() for df in data.values()]
+    avg_down = [df['downlink'].mean() for df in data.values()]
 
     fig, ax = plt.subplots()
 
-    x = ['1 client', '5 clients', '10 clients']
-
     rects1 = ax.bar(x, avg_up, label='Avg uplink time')
     rects2 = ax.bar(x, avg_proc, bottom=avg_up, label='Avg processing time')
     rects3 = ax.bar(x, avg_down,
                     bottom=[x + y for x, y in zip(avg_up, avg_proc)],
                     label='Avg downlink time')
 
-    autolabel(ax, rects1)
-    autolabel(ax, rects2)
-    autolabel(ax, rects3)
+    for rects in (rects1, rects2, rects3):
+        autolabel(ax, rects, ax.get_ylim(), bottom=True)
 
     ax.set_ylabel('Time [ms]')
     plt.legend(bbox_to_anchor=(1.04, 1), loc="upper left")
-    # plt.savefig(
-    #     'client_{}_avgtimes_.png'.format(data['client_id']),
-    #     bbox_inches='tight'
-    # )
     plt.show()
 
 
 def compare_cpu_loads():
-    os.chdir('1Client_IdealBenchmark')
-    c1_df = load_system_stats()
-    os.chdir('..')
-
-    os.chdir('5Clients_IdealBenchmark')
-    c5_df = load_system_stats()
-    os.chdir('..')
-
-    os.chdir('10Clients_IdealBenchmark')
-    c10_df = load_system_stats()
-    os.chdir('..')
-
     fig, ax = plt.subplots()
 
-    ax.plot(c1_df['timestamp'], c1_df['avg_cpu_load'], label='1 client')
-    ax.plot(c5_df['timestamp'], c5_df['avg_cpu_load'], label='5 clients')
-    ax.plot(c10_df['timestamp'], c10_df['avg_cpu_load'], label='10 clients')
+    for exp_dir, label in BENCHMARKS:
+        df = load_system_stats(exp_dir)
+        line, = ax.plot(df['time'], df['median'], label=label)
+        ax.fill_between(df['time'], df['min'], df['max'],
+                        color=line.get_color(), alpha=0.3, linewidth=0)
 
     ax.set_ylabel('Load [%]')
     ax.set_xlabel('Time [m]')
@@ -0,0 +1,775 @@
+"""
+ Copyright 2019 Manuel Olguín
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import io
+import json
+import lzma
+import os
+import re
+import struct
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from concurrent_logging import LOGGER
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# the raw files of every run_N directory of an experiment are stored in a
+# single file, as compressed columns of a few tables:
+#   clients: one row per NN_stats.json, frames: one row per frame in them,
+#   servers: one row per server_stats.json, system: one row per line of the
+#   system_stats.csv files
+ARCHIVE_FILE = 'runs.archive'
+ARCHIVE_MAGIC = b'EDRA'
+ARCHIVE_VERSION = 1
+CONFIG_FILES = ('experiment_config.json', 'experiment_config.toml')
+CLIENT_STATS_PATTERN = re.compile(r'^(\d{2})_stats\.json$')
+RUN_DIR_PATTERN = re.compile(r'^run_(\d+)$')
+SERVER_STATS = 'server_stats.json'
+SYSTEM_STATS = 'system_stats.csv'
+FRAMES_PATH = ('run_results', 'frames')
+
+# bookkeeping columns, JSON keys are never lists of this form
+RUN_COLUMN = ('#run',)
+CLIENT_COLUMN = ('#client',)
+FRAMES_COLUMN = ('#frames',)
+HEADER_COLUMN = ('#header',)
+
+LZMA_PRESET = 6
+ZSTD_LEVEL = 19
+INT_LIMIT = 2 ** 53  # integers exactly representable as float64
+DECIMAL_SCALES = (1, 10, 100, 1000, 10000)
+
+MISSING = object()  # key absent from a record
+
+
+def _compress(data: bytes, codec: str) -> bytes:
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return lzma.compress(data, preset=LZMA_PRESET)
+
+
+def _decompress(data: bytes, codec: str) -> bytes:
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('Archive was compressed with zstd, but the '
+                               'zstandard module is not installed')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return lzma.decompress(data)
+
+
+def _shuffle(values: np.ndarray) -> bytes:
+    # bytes of equal significance together compress much better
+    values = values.astype('<i8')
+    return values.view(np.uint8).reshape(-1, 8).T.tobytes()
+
+
+def _unshuffle(data: bytes) -> np.ndarray:
+    planes = np.frombuffer(data, dtype=np.uint8).reshape(8, -1)
+    return planes.T.copy().view('<i8').ravel()
+
+
+def _deltas(values: np.ndarray) -> bytes:
+    return _shuffle(np.diff(values.astype(np.int64), prepend=0))
+
+
+def _undeltas(data: bytes) -> np.ndarray:
+    return np.cumsum(_unshuffle(data))
+
+
+def _bits(flags: np.ndarray) -> bytes:
+    return np.packbits(flags.astype(bool)).tobytes()
+
+
+def _unbits(data: bytes, n: int) -> np.ndarray:
+    return np.unpackbits(np.frombuffer(data, dtype=np.uint8),
+                         count=n).astype(bool)
+
+
+def _float_encoding(values: np.ndarray) -> Tuple[Dict, bytes]:
+    """
+    Floats as delta-encoded integers: exact decimal fixed point, or else their
+    IEEE 754 bit patterns.
+    """
+    with np.errstate(all='ignore'):
+        for scale in DECIMAL_SCALES:
+            scaled = np.rint(values * scale)
+            if np.all(np.abs(scaled) < INT_LIMIT) and \
+                    np.array_equal(scaled / scale, values) and \
+                    np.array_equal(np.signbit(scaled), np.signbit(values)):
+                return {'scale': scale}, _deltas(scaled)
+    return {'scale': None}, _deltas(values.view(np.int64))
+
+
+def _float_decoding(meta: Dict, data: bytes) -> np.ndarray:
+    values = _undeltas(data)
+    if meta['scale'] is None:
+        return values.view(np.float64)
+    return values.astype(np.float64) / meta['scale']
+
+
+def _scalar_kind(value) -> str:
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int) and abs(value) < INT_LIMIT:
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, str):
+        return 'str'
+    return 'json'
+
+
+def encode_column(values: List) -> Tuple[Dict, bytes]:
+    """
+    Encodes a column of JSON values, MISSING where a record lacks the key.
+    Returns the metadata needed to decode it and its (uncompressed) bytes.
+    """
+    present = np.array([v is not MISSING for v in values], dtype=bool)
+    null = np.array([v is None for v in values], dtype=bool)
+    values = [v for v in values if v is not MISSING and v is not None]
+    kinds = {_scalar_kind(v) for v in values}
+
+    meta = OrderedDict([('rows', len(present)), ('count', len(values))])
+    parts = []
+    if not present.all():
+        meta['missing'] = True
+        parts.append(_bits(present))
+    if null.any():
+        meta['null'] = True
+        parts.append(_bits(null[present]))
+
+    if kinds == {'bool'}:
+        meta['kind'] = 'bool'
+        parts.append(_bits(np.array(values, dtype=bool)))
+    elif kinds == {'int'}:
+        meta['kind'] = 'int'
+        parts.append(_deltas(np.array(values, dtype=np.int64)))
+    elif kinds and kinds <= {'int', 'float'}:
+        meta['kind'] = 'number'
+        is_int = np.array([isinstance(v, int) for v in values], dtype=bool)
+        if is_int.any():
+            meta['ints'] = True
+            parts.append(_bits(is_int))
+        float_meta, data = _float_encoding(np.array(values, dtype=np.float64))
+        meta.update(float_meta)
+        parts.append(data)
+    else:
+        meta['kind'] = 'str' if kinds <= {'str'} else 'json'
+        if meta['kind'] == 'json':
+            values = [json.dumps(v) for v in values]
+        encoded = [v.encode('utf-8') for v in values]
+        parts.append(_shuffle(np.array([len(e) for e in encoded])))
+        parts.append(b''.join(encoded))
+
+    meta['parts'] = [len(p) for p in parts]
+    return meta, b''.join(parts)
+
+
+def decode_column(meta: Dict, data: bytes) -> List:
+    """
+    Inverse of encode_column.
+    """
+    parts = []
+    offset = 0
+    for size in meta['parts']:
+        parts.append(data[offset:offset + size])
+        offset += size
+    parts.reverse()
+
+    rows, count = meta['rows'], meta['count']
+    present = _unbits(parts.pop(), rows) if meta.get('missing') \
+        else np.ones(rows, dtype=bool)
+    null = _unbits(parts.pop(), int(present.sum())) if meta.get('null') \
+        else np.zeros(int(present.sum()), dtype=bool)
+
+    kind = meta['kind']
+    if count == 0:
+        values = []
+    elif kind == 'bool':
+        values = _unbits(parts.pop(), count).tolist()
+    elif kind == 'int':
+        values = _undeltas(parts.pop()).tolist()
+    elif kind == 'number':
+        is_int = _unbits(parts.pop(), count) if meta.get('ints') else None
+        values = _float_decoding(meta, parts.pop()).tolist()
+        if is_int is not None:
+            values = [int(v) if i else v for v, i in zip(values, is_int)]
+    else:
+        lengths = _unshuffle(parts.pop())
+        blob = parts.pop()
+        ends = np.cumsum(lengths).tolist()
+        starts = [0] + ends[:-1]
+        values = [blob[s:e].decode('utf-8') for s, e in zip(starts, ends)]
+        if kind == 'json':
+            values = [json.loads(v) for v in values]
+
+    it = iter(values)
+    present_values = [None if n else next(it) for n in null]
+    it = iter(present_values)
+    return [next(it) if p else MISSING for p in present]
+
+
+def _flatten(record: Dict, prefix: Tuple = ()) -> 'OrderedDict[Tuple, object]':
+    flat = OrderedDict()
+    for key, value in record.items():
+        path = prefix + (key,)
+        if isinstance(value, dict) and value:
+            flat.update(_flatten(value, path))
+        else:
+            flat[path] = value
+    return flat
+
+
+def _unflatten(flat: List[Tuple[Tuple, object]]) -> Dict:
+    record = OrderedDict()
+    for path, value in flat:
+        node = record
+        for key in path[:-1]:
+            node = node.setdefault(key, OrderedDict())
+        node[path[-1]] = value
+    return record
+
+
+def _parse_token(token: str):
+    # CSV fields as numbers only if they are printed back identically
+    try:
+        value = int(token)
+        if str(value) == token:
+            return value
+    except ValueError:
+        pass
+    try:
+        value = float(token)
+        if repr(value) == token:
+            return value
+    except ValueError:
+        pass
+    return token
+
+
+def _format_token(value) -> str:
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _split_csv(text: str) -> Optional[Tuple[List[str], List[List[str]]]]:
+    # only plain CSV as written by pandas is stored column-wise
+    if not text.endswith('\n') or '"' in text or '\r' in text:
+        return None
+    lines = text[:-1].split('\n')
+    header = lines[0].split(',')
+    rows = [line.split(',') for line in lines[1:]]
+    if any(len(row) != len(header) for row in rows):
+        return None
+    return header, rows
+
+
+class _Table():
+    """
+    Column-wise accumulation of records with possibly different keys.
+    """
+
+    def __init__(self):
+        self.columns = OrderedDict()  # type: Dict[Tuple, List]
+        self.rows = 0
+
+    def append(self, record: Dict[Tuple, object]) -> None:
+        for path in record:
+            if path not in self.columns:
+                self.columns[path] = [MISSING] * self.rows
+        for path, column in self.columns.items():
+            column.append(record.get(path, MISSING))
+        self.rows += 1
+
+
+def _run_dirs(exp_dir: str) -> List[Tuple[int, str]]:
+    runs = []
+    for name in os.listdir(exp_dir):
+        match = RUN_DIR_PATTERN.match(name)
+        if match and os.path.isdir(os.path.join(exp_dir, name)):
+            runs.append((int(match.group(1)), name))
+    return sorted(runs)
+
+
+def _read_text(filename: str) -> str:
+    with open(filename, 'r', encoding='utf-8', newline='') as f:
+        return f.read()
+
+
+def archive_experiment(exp_dir: str, codec: str = 'lzma') -> Dict[str, int]:
+    """
+    Archives the client, server and system stats and the configuration of an
+    experiment. Returns the total size of the files and of the archive.
+    """
+    if codec == 'zstd' and zstandard is None:
+        raise RuntimeError('zstd compression needs the zstandard module')
+
+    clients, frames, servers, system = _Table(), _Table(), _Table(), _Table()
+    headers = []  # type: List[List[str]]
+    blobs = OrderedDict()  # type: Dict[str, bytes]
+    runs = []
+    raw_size = 0
+
+    for run, run_name in _run_dirs(exp_dir):
+        run_path = os.path.join(exp_dir, run_name)
+        names = sorted(os.listdir(run_path))
+        runs.append(run)
+
+        for name in names:
+            match = CLIENT_STATS_PATTERN.match(name)
+            if not match and name != SERVER_STATS:
+                continue
+            text = _read_text(os.path.join(run_path, name))
+            raw_size += len(text.encode('utf-8'))
+            try:
+                data = json.loads(text, object_pairs_hook=OrderedDict)
+            except ValueError:
+                data = None  # e.g. an aborted run, stored as it is
+            flat = _flatten(data) if isinstance(data, dict) else None
+            if match and flat is not None:
+                frame_list = flat.pop(FRAMES_PATH, None)
+                flat[FRAMES_PATH] = MISSING  # keeps the position of the key
+                ok = isinstance(frame_list, list) and all(
+                    isinstance(f, dict) and
+                    all(_scalar_kind(v) != 'json' or v is None
+                        for v in f.values()) for f in frame_list)
+                if ok:
+                    restored = list(flat.items())
+                    restored[list(flat).index(FRAMES_PATH)] = \
+                        (FRAMES_PATH, frame_list)
+                    ok = json.dumps(_unflatten(restored)) == text
+            else:
+                ok = flat is not None and json.dumps(
+                    _unflatten(list(flat.items()))) == text
+
+            if not ok:
+                blobs['{}/{}'.format(run_name, name)] = text.encode('utf-8')
+            elif match:
+                del flat[FRAMES_PATH]
+                record = OrderedDict([(RUN_COLUMN, run),
+                                      (CLIENT_COLUMN, int(match.group(1))),
+                                      (FRAMES_COLUMN, len(frame_list))])
+                record.update(flat)
+                # the position of the frames among the other keys
+                record[FRAMES_PATH] = True
+                clients.append(record)
+                for frame in frame_list:
+                    frames.append(OrderedDict(((k,), v)
+                                              for k, v in frame.items()))
+            else:
+                record = OrderedDict([(RUN_COLUMN, run)])
+                record.update(flat)
+                servers.append(record)
+
+        if SYSTEM_STATS in names:
+            text = _read_text(os.path.join(run_path, SYSTEM_STATS))
+            raw_size += len(text.encode('utf-8'))
+            split = _split_csv(text)
+            if split is None:
+                blobs['{}/{}'.format(run_name, SYSTEM_STATS)] = \
+                    text.encode('utf-8')
+                continue
+            header, rows = split
+            if header not in headers:
+                headers.append(header)
+            header_idx = headers.index(header)
+            for row in rows:
+                record = OrderedDict([(RUN_COLUMN, run),
+                                      (HEADER_COLUMN, header_idx)])
+                record.update(((h,), _parse_token(t))
+                              for h, t in zip(header, row))
+                system.append(record)
+
+    config = OrderedDict()
+    for name in CONFIG_FILES:
+        if os.path.exists(os.path.join(exp_dir, name)):
+            config[name] = _read_text(os.path.join(exp_dir, name))
+
+    blocks = []
+    offset = 0
+
+    def add_block(data: bytes) -> Dict:
+        nonlocal offset
+        compressed = _compress(data, codec)
+        blocks.append(compressed)
+        block = {'offset': offset, 'size': len(compressed)}
+        offset += len(compressed)
+        return block
+
+    tables = OrderedDict()
+    for name, table in (('clients', clients), ('frames', frames),
+                        ('servers', servers), ('system', system)):
+        columns = []
+        for path, values in table.columns.items():
+            meta, data = encode_column(values)
+            meta['path'] = list(path)
+            meta.update(add_block(data))
+            columns.append(meta)
+        tables[name] = {'rows': table.rows, 'columns': columns}
+
+    manifest = OrderedDict([
+        ('version', ARCHIVE_VERSION),
+        ('codec', codec),
+        ('config', config),
+        ('runs', runs),
+        ('system_headers', headers),
+        ('tables', tables),
+        ('blobs', OrderedDict((k, add_block(v)) for k, v in blobs.items()))
+    ])
+    manifest_data = json.dumps(manifest).encode('utf-8')
+
+    filename = os.path.join(exp_dir, ARCHIVE_FILE)
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(ARCHIVE_MAGIC)
+        f.write(struct.pack('<I', len(manifest_data)))
+        f.write(manifest_data)
+        for block in blocks:
+            f.write(block)
+    os.replace(filename + '.tmp', filename)
+
+    archive_size = os.path.getsize(filename)
+    LOGGER.info('Archived %d runs of %s: %d bytes in %d bytes (%.1fx), %d '
+                'files stored whole', len(runs), exp_dir, raw_size,
+                archive_size, raw_size / max(archive_size, 1), len(blobs))
+    return {'raw': raw_size, 'archive': archive_size}
+
+
+class RunArchive():
+    """
+    Read access to the archive of an experiment. Columns are decompressed
+    the first time they are needed and kept afterwards.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            if f.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+                raise ValueError('{} is not a run archive'.format(filename))
+            (length,) = struct.unpack('<I', f.read(4))
+            self.manifest = json.loads(f.read(length).decode('utf-8'),
+                                       object_pairs_hook=OrderedDict)
+            self.data_offset = f.tell()
+        if self.manifest['version'] > ARCHIVE_VERSION:
+            raise ValueError('Unsupported archive version {}'.format(
+                self.manifest['version']))
+        self.codec = self.manifest['codec']
+        self._columns = {}  # type: Dict[Tuple[str, Tuple], List]
+        self._row_ranges = {}  # type: Dict[str, Dict]
+
+    @property
+    def runs(self) -> List[int]:
+        return self.manifest['runs']
+
+    @property
+    def config(self) -> Dict[str, str]:
+        return self.manifest['config']
+
+    def _block(self, block: Dict) -> bytes:
+        with open(self.filename, 'rb') as f:
+            f.seek(self.data_offset + block['offset'])
+            return _decompress(f.read(block['size']), self.codec)
+
+    def column(self, table: str, path: Tuple) -> List:
+        key = (table, tuple(path))
+        if key not in self._columns:
+            for meta in self.manifest['tables'][table]['columns']:
+                if tuple(meta['path']) == tuple(path):
+                    self._columns[key] = decode_column(meta,
+                                                       self._block(meta))
+                    break
+            else:
+                raise KeyError(path)
+        return self._columns[key]
+
+    def paths(self, table: str) -> List[Tuple]:
+        return [tuple(m['path'])
+                for m in self.manifest['tables'][table]['columns']]
+
+    def _rows(self, table: str, key: Tuple) -> Tuple[int, int]:
+        """
+        Row range of a run (and client) in a table; rows are stored in the
+        order of runs and clients.
+        """
+        if table not in self._row_ranges:
+            keys = list(zip(*[self.column(table, c) for c in
+                              ((RUN_COLUMN, CLIENT_COLUMN)
+                               if table == 'clients' else (RUN_COLUMN,))]))
+            ranges = OrderedDict()
+            for i, k in enumerate(keys):
+                start, _ = ranges.get(k, (i, i))
+                ranges[k] = (start, i + 1)
+            self._row_ranges[table] = ranges
+        return self._row_ranges[table][key]
+
+    def has(self, run: int, client: Optional[int] = None) -> bool:
+        try:
+            if client is None:
+                self._rows('servers', (run,))
+            else:
+                self._rows('clients', (run, client))
+            return True
+        except KeyError:
+            return False
+
+    def blob(self, run: int, name: str) -> Optional[bytes]:
+        block = self.manifest['blobs'].get('run_{}/{}'.format(run, name))
+        return None if block is None else self._block(block)
+
+    def _record(self, table: str, row: int) -> List[Tuple[Tuple, object]]:
+        return [(p, self.column(table, p)[row]) for p in self.paths(table)
+                if p[0][0] != '#' or len(p) > 1]
+
+    def client_stats(self, run: int, client: int) -> Dict:
+        """
+        Contents of run_<run>/<client>_stats.json.
+        """
+        blob = self.blob(run, '{:02}_stats.json'.format(client))
+        if blob is not None:
+            return json.loads(blob.decode('utf-8'),
+                              object_pairs_hook=OrderedDict)
+
+        row, _ = self._rows('clients', (run, client))
+        # frames of each client are stored consecutively, in file order
+        counts = self.column('clients', FRAMES_COLUMN)
+        first = sum(counts[:row])
+        frame_paths = self.paths('frames')
+        frame_columns = [self.column('frames', p)[first:first + counts[row]]
+                         for p in frame_paths]
+        frame_list = [
+            OrderedDict((p[0], v) for p, v in zip(frame_paths, values)
+                        if v is not MISSING)
+            for values in zip(*frame_columns)]
+
+        record = [(p, frame_list if p == FRAMES_PATH else v)
+                  for p, v in self._record('clients', row)
+                  if v is not MISSING]
+        return _unflatten(record)
+
+    def server_stats(self, run: int) -> Dict:
+        """
+        Contents of run_<run>/server_stats.json.
+        """
+        blob = self.blob(run, SERVER_STATS)
+        if blob is not None:
+            return json.loads(blob.decode('utf-8'),
+                              object_pairs_hook=OrderedDict)
+        row, _ = self._rows('servers', (run,))
+        return _unflatten([(p, v) for p, v in self._record('servers', row)
+                           if v is not MISSING])
+
+    def _system_rows(self, run: int) -> Tuple[List[str], int, int]:
+        start, end = self._rows('system', (run,))
+        header = self.manifest['system_headers'][
+            self.column('system', HEADER_COLUMN)[start]]
+        return header, start, end
+
+    def system_stats(self, run: int) -> pd.DataFrame:
+        """
+        Contents of run_<run>/system_stats.csv as a DataFrame.
+        """
+        blob = self.blob(run, SYSTEM_STATS)
+        if blob is not None:
+            return pd.read_csv(io.BytesIO(blob),
+                               float_precision='round_trip')
+        try:
+            header, start, end = self._system_rows(run)
+        except KeyError:
+            raise FileNotFoundError('No system stats for run {}'.format(run))
+        return pd.DataFrame(OrderedDict(
+            (h, self.column('system', (h,))[start:end]) for h in header))
+
+    def system_stats_text(self, run: int) -> Optional[str]:
+        blob = self.blob(run, SYSTEM_STATS)
+        if blob is not None:
+            return blob.decode('utf-8')
+        try:
+            header, start, end = self._system_rows(run)
+        except KeyError:
+            return None
+        columns = [self.column('system', (h,))[start:end] for h in header]
+        lines = [','.join(header)] + [
+            ','.join(_format_token(v) for v in values)
+            for values in zip(*columns)]
+        return '\n'.join(lines) + '\n'
+
+    def files(self, run: int) -> 'OrderedDict[str, str]':
+        """
+        Names and contents of all archived files of a run.
+        """
+        files = OrderedDict()
+        rows = zip(self.column('clients', RUN_COLUMN),
+                   self.column('clients', CLIENT_COLUMN)) \
+            if self.manifest['tables']['clients']['rows'] else []
+        clients = sorted({c for r, c in rows if r == run} |
+                         {int(m.group(1)) for m in (
+                             CLIENT_STATS_PATTERN.match(k.split('/')[1])
+                             for k in self.manifest['blobs']
+                             if k.split('/')[0] == 'run_{}'.format(run))
+                          if m})
+        for client in clients:
+            name = '{:02}_stats.json'.format(client)
+            blob = self.blob(run, name)
+            files[name] = json.dumps(self.client_stats(run, client)) \
+                if blob is None else blob.decode('utf-8')
+        blob = self.blob(run, SERVER_STATS)
+        if blob is not None:
+            files[SERVER_STATS] = blob.decode('utf-8')
+        elif self.has(run):
+            files[SERVER_STATS] = json.dumps(self.server_stats(run))
+        system = self.system_stats_text(run)
+        if system is not None:
+            files[SYSTEM_STATS] = system
+        return files
+
+
+_ARCHIVES = {}  # type: Dict[str, Tuple[float, RunArchive]]
+
+
+def open_archive(exp_dir: str = '.') -> Optional[RunArchive]:
+    """
+    The archive of an experiment, or None if it has none. Archives are kept
+    open per process until they change on disk.
+    """
+    filename = os.path.abspath(os.path.join(exp_dir, ARCHIVE_FILE))
+    try:
+        mtime = os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    cached = _ARCHIVES.get(filename)
+    if cached is None or cached[0] != mtime:
+        cached = _ARCHIVES[filename] = (mtime, RunArchive(filename))
+    return cached[1]
+
+
+def _archive_for(exp_dir: str, filename: str) -> RunArchive:
+    archive = open_archive(exp_dir)
+    if archive is None:
+        raise FileNotFoundError(filename)
+    return archive
+
+
+def load_client_stats(run_idx: int, client_idx: int,
+                      exp_dir: str = '.') -> Dict:
+    """
+    Statistics of a client in a run (counted from 0), from its run directory
+    or else the experiment's archive.
+    """
+    filename = os.path.join(exp_dir, 'run_{}'.format(run_idx + 1),
+                            '{:02}_stats.json'.format(client_idx))
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            return json.load(f)
+    return _archive_for(exp_dir, filename).client_stats(run_idx + 1,
+                                                        client_idx)
+
+
+def load_server_stats(run_idx: int, exp_dir: str = '.') -> Dict:
+    filename = os.path.join(exp_dir, 'run_{}'.format(run_idx + 1),
+                            SERVER_STATS)
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            return json.load(f)
+    return _archive_for(exp_dir, filename).server_stats(run_idx + 1)
+
+
+def load_system_stats(run_idx: int, exp_dir: str = '.') -> pd.DataFrame:
+    filename = os.path.join(exp_dir, 'run_{}'.format(run_idx + 1),
+                            SYSTEM_STATS)
+    if os.path.exists(filename):
+        # parsed exactly, as the archive stores them
+        return pd.read_csv(filename, float_precision='round_trip')
+    return _archive_for(exp_dir, filename).system_stats(run_idx + 1)
+
+
+def archived_config(exp_dir: str = '.') -> Tuple[str, str]:
+    """
+    Name and contents of the configuration file embedded in the archive.
+    """
+    archive = open_archive(exp_dir)
+    if archive is None or not archive.config:
+        raise FileNotFoundError(os.path.join(exp_dir, CONFIG_FILES[0]))
+    return next(iter(archive.config.items()))
+
+
+def verify_archive(exp_dir: str = '.') -> List[str]:
+    """
+    Files of the run directories which differ from or are missing in the
+    archive.
+    """
+    archive = RunArchive(os.path.join(exp_dir, ARCHIVE_FILE))
+    mismatches = []
+    for run, run_name in _run_dirs(exp_dir):
+        run_path = os.path.join(exp_dir, run_name)
+        files = archive.files(run) if run in archive.runs else {}
+        for name in sorted(os.listdir(run_path)):
+            if not CLIENT_STATS_PATTERN.match(name) and \
+                    name not in (SERVER_STATS, SYSTEM_STATS):
+                continue
+            if files.get(name) != _read_text(os.path.join(run_path, name)):
+                mismatches.append(os.path.join(run_name, name))
+    return mismatches
+
+
+def remove_archived_files(exp_dir: str = '.') -> int:
+    """
+    Deletes the archived files from the run directories, and the
+    directories themselves if nothing else is left in them.
+    """
+    removed = 0
+    for _, run_name in _run_dirs(exp_dir):
+        run_path = os.path.join(exp_dir, run_name)
+        for name in os.listdir(run_path):
+            if CLIENT_STATS_PATTERN.match(name) or \
+                    name in (SERVER_STATS, SYSTEM_STATS):
+                os.remove(os.path.join(run_path, name))
+                removed += 1
+        if not os.listdir(run_path):
+            os.rmdir(run_path)
+    return removed
+
+
+def unarchive_experiment(exp_dir: str = '.') -> int:
+    """
+    Restores the missing run files of an experiment from its archive. Returns
+    the number of files written.
+    """
+    archive = RunArchive(os.path.join(exp_dir, ARCHIVE_FILE))
+    written = 0
+    for name, text in archive.config.items():
+        if not os.path.exists(os.path.join(exp_dir, name)):
+            with open(os.path.join(exp_dir, name), 'w', encoding='utf-8',
+                      newline='') as f:
+                f.write(text)
+            written += 1
+    for run in archive.runs:
+        run_path = os.path.join(exp_dir, 'run_{}'.format(run))
+        os.makedirs(run_path, exist_ok=True)
+        for name, text in archive.files(run).items():
+            filename = os.path.join(run_path, name)
+            if os.path.exists(filename):
+                continue
+            with open(filename, 'w', encoding='utf-8', newline='') as f:
+                f.write(text)
+            written += 1
+    return written
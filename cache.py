@@ -0,0 +1,183 @@
+"""
+ Copyright 2019 Manuel Olguín
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import os
+import sys
+from collections import Counter, OrderedDict
+from typing import Callable, Hashable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# tables as read from disk, filtered frames and metrics derived from them,
+# and statistics computed over whole data sets
+NAMESPACES = ('raw', 'derived', 'summary')
+
+# memory budget of the process-wide cache, in MiB
+BUDGET_VARIABLE = 'EDGEDROID_CACHE_MB'
+DEFAULT_BUDGET_MB = 1024
+
+CacheKey = Tuple[str, str, Hashable]
+
+
+def file_fingerprint(*filenames: str) -> str:
+    """
+    Fingerprint of a set of files from their sizes and modification times.
+    """
+    parts = []
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+            parts.append('{}:{}:{}'.format(filename, st.st_size,
+                                           st.st_mtime_ns))
+        except FileNotFoundError:
+            parts.append('{}:missing'.format(filename))
+    return ';'.join(parts)
+
+
+def sizeof(value) -> int:
+    """
+    Approximate memory footprint of a cached value, in bytes.
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sizeof(k) + sizeof(v)
+                                          for k, v in value.items())
+    if isinstance(value, (list, tuple)) and \
+            not hasattr(value, '_fields'):
+        return sys.getsizeof(value) + sum(sizeof(v) for v in value)
+    return sys.getsizeof(value)
+
+
+def _shared(value):
+    """
+    Shallow copy of a cached value, which must not be modified in place.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.copy(deep=False)
+    if isinstance(value, dict):
+        return type(value)((k, _shared(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_shared(v) for v in value]
+    return value
+
+
+class ExperimentCache():
+    """
+    In-memory LRU cache of values computed from the files of an experiment,
+    invalidated by their fingerprint and bounded by a memory budget.
+    """
+
+    def __init__(self, budget: Optional[int] = None):
+        if budget is None:
+            budget = int(float(os.environ.get(BUDGET_VARIABLE,
+                                              DEFAULT_BUDGET_MB)) * 2 ** 20)
+        self.budget = budget
+        self.size = 0
+        self.hits = Counter()
+        self.misses = Counter()
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def _key(namespace: str, exp_dir: str, key: Hashable) -> CacheKey:
+        if namespace not in NAMESPACES:
+            raise ValueError('Unknown cache namespace: {}'.format(namespace))
+        return namespace, os.path.abspath(exp_dir), key
+
+    def get(self, namespace: str, exp_dir: str, key: Hashable,
+            fingerprint: str, default=None):
+        cache_key = self._key(namespace, exp_dir, key)
+        entry = self._entries.get(cache_key)
+        if entry is not None and entry[0] != fingerprint:
+            self._remove(cache_key)
+            entry = None
+        if entry is None:
+            self.misses[namespace] += 1
+            return default
+        self.hits[namespace] += 1
+        self._entries.move_to_end(cache_key)
+        return _shared(entry[1])
+
+    def put(self, namespace: str, exp_dir: str, key: Hashable,
+            fingerprint: str, value) -> None:
+        cache_key = self._key(namespace, exp_dir, key)
+        if cache_key in self._entries:
+            self._remove(cache_key)
+        size = sizeof(value)
+        if size > self.budget:
+            return
+        self._entries[cache_key] = (fingerprint, value, size)
+        self.size += size
+        self._evict()
+
+    def get_or_compute(self, namespace: str, exp_dir: str, key: Hashable,
+                       fingerprint: str, compute: Callable[[], object]):
+        missing = object()
+        value = self.get(namespace, exp_dir, key, fingerprint, missing)
+        if value is missing:
+            value = compute()
+            self.put(namespace, exp_dir, key, fingerprint, value)
+            value = _shared(value)
+        return value
+
+    def _remove(self, cache_key: CacheKey) -> None:
+        _, _, size = self._entries.pop(cache_key)
+        self.size -= size
+
+    def _evict(self) -> None:
+        while self.size > self.budget and self._entries:
+            self._remove(next(iter(self._entries)))
+
+    def resize(self, budget: int) -> None:
+        self.budget = budget
+        self._evict()
+
+    def invalidate(self, exp_dir: Optional[str] = None,
+                   namespace: Optional[str] = None) -> None:
+        """
+        Drops the entries of an experiment and/or namespace, all of them by
+        default.
+        """
+        exp_dir = None if exp_dir is None else os.path.abspath(exp_dir)
+        for cache_key in list(self._entries):
+            ns, directory, _ = cache_key
+            if (namespace is None or ns == namespace) and \
+                    (exp_dir is None or directory == exp_dir):
+                self._remove(cache_key)
+
+    def stats(self) -> pd.DataFrame:
+        """
+        Entries, size in bytes, hits and misses per namespace.
+        """
+        rows = []
+        for namespace in NAMESPACES:
+            sizes = [e[2] for k, e in self._entries.items()
+                     if k[0] == namespace]
+            rows.append({'namespace': namespace,
+                         'entries'  : len(sizes),
+                         'bytes'    : sum(sizes),
+                         'hits'     : self.hits[namespace],
+                         'misses'   : self.misses[namespace]})
+        return pd.DataFrame(rows).set_index('namespace')
+
+
+# shared by all loaders of the process
+EXPERIMENT_CACHE = ExperimentCache()
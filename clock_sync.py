@@ -0,0 +1,204 @@
+"""
+ Copyright 2019 Manuel Olguín
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+CLOCK_GROUPS = ['run_id', 'client_id']
+
+# the drift is fitted to the smallest delays in this many windows of each
+# group: queueing only ever adds delay, so the fastest frames follow the
+# clocks closely
+DRIFT_WINDOWS = 10
+
+# fraction of frames in a group allowed to stay non-causal after alignment,
+# so that a few bogus timestamps cannot move the offset of the whole group
+CAUSALITY_QUANTILE = 0.01
+
+# server timestamps and the client timestamps their offsets are predicted at
+ALIGNED_COLUMNS = {'server_recv': 'client_send',
+                   'server_send': 'client_recv'}
+
+# dropped: frames left with a non-positive uplink, processing or downlink
+# time after alignment, which util.valid_frames() leaves out
+FIT_COLUMNS = ['frames', 't0', 'offset', 'drift', 'lower', 'upper',
+               'prior_std', 'residual_std', 'noncausal', 'dropped']
+
+
+def frame_delays(frame_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Uplink (forward) and downlink (backward) delay of each frame, including the
+    clock offset.
+    """
+    return pd.DataFrame({
+        'forward' : frame_data['server_recv'] - frame_data['client_send'],
+        'backward': frame_data['client_recv'] - frame_data['server_send']
+    }, index=frame_data.index)
+
+
+def _truncated_normal_mean(lower: np.ndarray, upper: np.ndarray,
+                           scale: np.ndarray) -> np.ndarray:
+    """
+    Mean of a zero-mean normal distribution truncated to [lower, upper],
+    accurate far into the tails.
+    """
+    # scipy takes longer to import than most commands take to run
+    from scipy.special import erfcx, ndtr
+
+    lower, upper, scale = (np.asarray(v, dtype=np.float64)
+                           for v in (lower, upper, scale))
+    result = np.clip(0.0, lower, upper)
+    spread = scale > 0
+    if not spread.any():
+        return result
+
+    # intervals below zero are mirrored, leaving intervals containing zero
+    # and intervals above it
+    flip = upper[spread] < 0
+    sc = scale[spread]
+    a = np.where(flip, -upper[spread], lower[spread]) / sc
+    b = np.where(flip, -lower[spread], upper[spread]) / sc
+
+    with np.errstate(all='ignore'):
+        straddle = (np.exp(-a ** 2 / 2) - np.exp(-b ** 2 / 2)) \
+            / np.sqrt(2 * np.pi) / (ndtr(b) - ndtr(a))
+        ratio = np.exp((a ** 2 - b ** 2) / 2)
+        tail = np.sqrt(2 / np.pi) / erfcx(a / np.sqrt(2)) * (1 - ratio) \
+            / (1 - ratio * erfcx(b / np.sqrt(2)) / erfcx(a / np.sqrt(2)))
+        mean = sc * np.where(a > 0, tail, straddle)
+        # degenerate, zero-width intervals
+        midpoint = (lower[spread] + upper[spread]) / 2
+    mean = np.where(flip, -mean, mean)
+    result[spread] = np.where(np.isfinite(mean), mean, midpoint)
+    return result
+
+
+def estimate_clock_offsets(frame_data: pd.DataFrame,
+                           run_data: pd.DataFrame = None,
+                           by: List[str] = CLOCK_GROUPS) -> pd.DataFrame:
+    """
+    Estimates the offset of the server clock from the client clock in each
+    group as offset + drift * (t - t0), t being the client send time. The
+    offset is the NTP prior truncated to the bounds that keep frames causal.
+    """
+    delays = frame_delays(frame_data)
+    df = _keyed({'t': frame_data['client_send'],
+                 'forward': delays['forward'],
+                 'backward': delays['backward']}, frame_data, by)
+    df = df.loc[np.isfinite(df[['t', 'forward', 'backward']]).all(axis=1)]
+
+    grouped = df.groupby(by)
+    t_min = grouped['t'].transform('min')
+    span = grouped['t'].transform('max') - t_min
+    df['window'] = np.floor((df['t'] - t_min) / span.where(span > 0, 1.0)
+                            * DRIFT_WINDOWS).clip(upper=DRIFT_WINDOWS - 1)
+
+    # the drift is fitted to the midpoints of the minimum uplink and
+    # downlink delays per window, which a constant asymmetry does not tilt
+    windows = df.groupby(by + ['window']).agg(
+        t=('t', 'mean'), forward=('forward', 'min'),
+        backward=('backward', 'min')).reset_index()
+    windows['mid'] = (windows['forward'] - windows['backward']) / 2.0
+    w_grouped = windows.groupby(by)
+    dt = windows['t'] - w_grouped['t'].transform('mean')
+    dy = windows['mid'] - w_grouped['mid'].transform('mean')
+    sums = _keyed({'sxy': dt * dy, 'sxx': dt * dt}, windows, by) \
+        .groupby(by).sum()
+
+    fits = grouped.agg(frames=('t', 'size'), t0=('t', 'mean'))
+    fits['drift'] = (sums['sxy'] / sums['sxx']).where(sums['sxx'] > 0, 0.0)
+    residuals = dy - dt * windows[by].join(fits['drift'], on=by)['drift']
+    fits['residual_std'] = _keyed({'r2': residuals * residuals}, windows, by) \
+        .groupby(by)['r2'].mean().pow(0.5)
+
+    # causality bounds of the offset at t0
+    trend = _predict(df, fits.assign(offset=0.0), 't', by)
+    bounds = _keyed({'forward': df['forward'] - trend,
+                     'backward': df['backward'] + trend}, df, by) \
+        .groupby(by).quantile(CAUSALITY_QUANTILE)
+    fits['lower'] = -bounds['backward']
+    fits['upper'] = bounds['forward']
+
+    # NTP prior of the offset: centered on zero, with the timestamp error
+    # of the client as standard deviation
+    fits['prior_std'] = 0.0
+    if run_data is not None and set(by) == set(CLOCK_GROUPS):
+        client_cols = [c for c in ('ntp_offset', 'timestamp_error')
+                       if c in run_data.columns]
+        fits = fits.join(run_data.set_index(CLOCK_GROUPS)[client_cols])
+        if 'timestamp_error' in client_cols:
+            fits['prior_std'] = fits['timestamp_error'].fillna(0.0).abs()
+
+    # bounds that contradict each other (round trips shorter than the
+    # server processing) leave no causal offset, the midpoint is used
+    consistent = fits['lower'] <= fits['upper']
+    fits['offset'] = np.where(
+        consistent,
+        _truncated_normal_mean(fits['lower'].values, fits['upper'].values,
+                               fits['prior_std'].values),
+        (fits['lower'] + fits['upper']).values / 2.0)
+
+    offsets = _predict(df, fits, 't', by)
+    fits['noncausal'] = _keyed({
+        'noncausal': (df['forward'] < offsets) | (df['backward'] < -offsets)
+    }, df, by).groupby(by)['noncausal'].mean()
+
+    server_recv = frame_data['server_recv'] - np.nan_to_num(
+        _predict(frame_data, fits, 'client_send', by))
+    server_send = frame_data['server_send'] - np.nan_to_num(
+        _predict(frame_data, fits, 'client_recv', by))
+    valid = (server_recv > frame_data['client_send']) & \
+        (server_send > server_recv) & \
+        (frame_data['client_recv'] > server_send)
+    fits['dropped'] = _keyed({'dropped': ~valid}, frame_data, by) \
+        .groupby(by)['dropped'].sum().reindex(fits.index, fill_value=0)
+
+    extra = [c for c in fits.columns if c not in FIT_COLUMNS]
+    return fits[FIT_COLUMNS + extra].reset_index()
+
+
+def _keyed(columns: dict, source: pd.DataFrame,
+           by: List[str]) -> pd.DataFrame:
+    df = pd.DataFrame(columns)
+    for col in by:
+        df[col] = source[col]
+    return df
+
+
+def _predict(frame_data: pd.DataFrame, fits: pd.DataFrame,
+             time_col: str, by: List[str]) -> np.ndarray:
+    params = frame_data[by].join(fits[['t0', 'offset', 'drift']], on=by)
+    return (params['offset']
+            + params['drift'] * (frame_data[time_col] - params['t0'])).values
+
+
+def align_clocks(frame_data: pd.DataFrame,
+                 fits: pd.DataFrame,
+                 by: List[str] = CLOCK_GROUPS) -> pd.DataFrame:
+    """
+    Copy of the frame data with the estimated offsets removed from the server
+    timestamps.
+    """
+    if set(by) <= set(fits.columns):
+        fits = fits.set_index(by)
+    aligned = frame_data.copy()
+    for server_col, client_col in ALIGNED_COLUMNS.items():
+        if server_col in frame_data.columns:
+            aligned[server_col] = frame_data[server_col] - np.nan_to_num(
+                _predict(frame_data, fits, client_col, by))
+    return aligned
@@ -0,0 +1,137 @@
+"""
+ Copyright 2019 Manuel Olguín
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+from collections import OrderedDict
+from multiprocessing.pool import Pool
+from typing import Dict, Iterable
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from query import collect_metrics
+from util import PERCENTILES
+
+COMPARE_METRICS = ('processing', 'uplink', 'downlink', 'rtt')
+
+# number of array elements drawn per permutation batch, bounds memory use
+PERMUTATION_BATCH_ELEMENTS = 2 ** 22
+
+
+def cohens_d(a: np.ndarray, b: np.ndarray) -> float:
+    n_a, n_b = len(a), len(b)
+    pooled = ((n_a - 1) * np.var(a, ddof=1) + (n_b - 1) * np.var(b, ddof=1)) \
+        / (n_a + n_b - 2)
+    return float((np.mean(b) - np.mean(a)) / np.sqrt(pooled))
+
+
+def _permuted_sums(args) -> np.ndarray:
+    """
+    Sums of the first n_a pooled values over random permutations, in batches.
+    """
+    pooled, n_a, n_permutations, seed = args
+    rng = np.random.default_rng(seed)
+    n = len(pooled)
+    batch = max(1, PERMUTATION_BATCH_ELEMENTS // n)
+    sums = np.empty(n_permutations)
+    for start in range(0, n_permutations, batch):
+        size = min(batch, n_permutations - start)
+        # a random n_a-subset per row, without sorting the whole row
+        keys = rng.random((size, n))
+        subset = np.argpartition(keys, n_a - 1, axis=1)[:, :n_a]
+        sums[start:start + size] = pooled[subset].sum(axis=1)
+    return sums
+
+
+def permutation_pvalue(a: np.ndarray, b: np.ndarray,
+                       n_permutations: int = 10000, seed: int = 0,
+                       pool: Pool = None, chunks: int = 1) -> float:
+    """
+    Two-sided permutation test for the difference in means, in seeded chunks.
+    """
+    pooled = np.concatenate((a, b))
+    n_a, total = len(a), pooled.sum()
+    observed = abs(np.mean(b) - np.mean(a))
+
+    seeds = np.random.SeedSequence(seed).spawn(chunks)
+    sizes = np.diff(np.linspace(0, n_permutations, chunks + 1).astype(int))
+    tasks = [(pooled, n_a, int(size), s) for size, s in zip(sizes, seeds)]
+    sums = np.concatenate(pool.map(_permuted_sums, tasks) if pool
+                          else list(map(_permuted_sums, tasks)))
+
+    diffs = np.abs((total - sums) / (len(pooled) - n_a) - sums / n_a)
+    # add-one correction, the observed split counts as a permutation
+    return float((np.sum(diffs >= observed) + 1) / (n_permutations + 1))
+
+
+def compare_samples(a: np.ndarray, b: np.ndarray,
+                    n_permutations: int = 10000, seed: int = 0,
+                    pool: Pool = None, chunks: int = 1) -> Dict:
+    """
+    Statistics for sample b relative to baseline sample a. Deltas are b - a,
+    and positive effect sizes mean b is larger.
+    """
+    mw = stats.mannwhitneyu(b, a, alternative='two-sided')
+    ks = stats.ks_2samp(a, b)
+    result = OrderedDict([
+        ('n_baseline', len(a)),
+        ('n', len(b)),
+        ('mean_delta', float(np.mean(b) - np.mean(a)))
+    ])
+    deltas = np.percentile(b, PERCENTILES) - np.percentile(a, PERCENTILES)
+    for p, delta in zip(PERCENTILES, deltas):
+        result['p{}_delta'.format(p)] = float(delta)
+    result['cohens_d'] = cohens_d(a, b)
+    # Cliff's delta, P(b > a) - P(b < a), follows from the U statistic
+    result['cliffs_delta'] = float(2.0 * mw.statistic / (len(a) * len(b))
+                                   - 1.0)
+    result['mw_pvalue'] = float(mw.pvalue)
+    result['ks_stat'] = float(ks.statistic)
+    result['ks_pvalue'] = float(ks.pvalue)
+    if n_permutations > 0:
+        result['perm_pvalue'] = permutation_pvalue(a, b, n_permutations,
+                                                   seed, pool, chunks)
+    return result
+
+
+def compare_experiments(experiments: Dict[str, str],
+                        metrics: Iterable[str] = COMPARE_METRICS,
+                        feedback: bool = None,
+                        n_permutations: int = 10000,
+                        processes: int = 6,
+                        seed: int = 0) -> pd.DataFrame:
+    """
+    Compares every experiment to the first one, per metric, on successful runs.
+    """
+    metrics = tuple(metrics)
+    filters = {} if feedback is None else {'feedback': feedback}
+    data = collect_metrics(experiments, metrics, **filters)
+    names = list(data.keys())
+    baseline = names[0]
+
+    rows = []
+    with Pool(processes) as pool:
+        for name in names[1:]:
+            for metric in metrics:
+                row = OrderedDict([('experiment', name),
+                                   ('baseline', baseline),
+                                   ('metric', metric)])
+                row.update(compare_samples(
+                    data[baseline][metric].values.astype(np.float64),
+                    data[name][metric].values.astype(np.float64),
+                    n_permutations, seed, pool, processes))
+                rows.append(row)
+    return pd.DataFrame(rows)
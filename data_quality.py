@@ -0,0 +1,164 @@
+"""
+ Copyright 2019 Manuel Olguín
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+from histograms import fine_edges
+from util import iter_frame_partitions
+
+QUALITY_GROUPS = ['run_id', 'client_id']
+QUALITY_COLUMNS = ['run_id', 'client_id', 'frame_id', 'feedback',
+                   'client_send', 'server_recv', 'server_send', 'client_recv']
+
+# robust z-score above which an RTT is considered an outlier
+OUTLIER_Z = 3.5
+MAD_SCALE = 0.6745
+
+# a (run, client) is flagged if any of these fractions of its frames is
+# exceeded, or if it contains duplicate frames
+MAX_UNMATCHED_RATIO = 0.1
+MAX_NEGATIVE_RATIO = 0.05
+MAX_OUTLIER_RATIO = 0.1
+
+
+def robust_zscores(values: pd.Series, groups: pd.Series,
+                   reference: pd.DataFrame = None) -> pd.Series:
+    """
+    Median/MAD based z-scores within each group, or relative to a reference
+    table of medians and MADs indexed by group.
+    """
+    if reference is None:
+        median = values.groupby(groups).transform('median')
+        mad = (values - median).abs().groupby(groups).transform('median')
+    else:
+        median = groups.map(reference['median']).astype(float)
+        mad = groups.map(reference['mad']).astype(float)
+    return (MAD_SCALE * (values - median) / mad).where(mad > 0, 0.0)
+
+
+def _weighted_median(values: np.ndarray, weights: np.ndarray) -> float:
+    order = np.argsort(values)
+    cumulative = np.cumsum(weights[order])
+    idx = np.searchsorted(cumulative, cumulative[-1] / 2.0)
+    return float(values[order][idx])
+
+
+def rtt_reference(partitions: Iterable[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Median and MAD of the RTT by feedback, from log-binned histograms (0.5%
+    resolution).
+    """
+    edges = fine_edges()
+    centers = np.sqrt(edges[:-1] * edges[1:])
+    counts = {}
+    for frame_data in partitions:
+        rtt = (frame_data['client_recv'] - frame_data['client_send']).values
+        rtt = np.clip(rtt, edges[0], edges[-1])
+        for fb in (True, False):
+            hist, _ = np.histogram(rtt[frame_data['feedback'].values == fb],
+                                   edges)
+            counts[fb] = counts.get(fb, 0) + hist
+
+    reference = {}
+    for fb, hist in counts.items():
+        if hist.sum() == 0:
+            continue
+        median = _weighted_median(centers, hist)
+        reference[fb] = {'median': median,
+                         'mad'   : _weighted_median(np.abs(centers - median),
+                                                    hist)}
+    return pd.DataFrame.from_dict(reference, orient='index')
+
+
+def quality_checks(frame_data: pd.DataFrame,
+                   reference: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Per (run, client) counts of the frame-level checks of quality_report().
+    """
+    processing = frame_data['server_send'] - frame_data['server_recv']
+    uplink = frame_data['server_recv'] - frame_data['client_send']
+    downlink = frame_data['client_recv'] - frame_data['server_send']
+    rtt = frame_data['client_recv'] - frame_data['client_send']
+
+    negative = (processing <= 0) | (uplink <= 0) | (downlink <= 0)
+    outlier = robust_zscores(rtt, frame_data['feedback'],
+                             reference).abs() > OUTLIER_Z
+
+    ordered = frame_data.sort_values(QUALITY_GROUPS + ['frame_id'])
+    step = ordered.groupby(QUALITY_GROUPS)['frame_id'].diff()
+
+    checks = pd.DataFrame({
+        'frames'            : 1,
+        'negative_intervals': negative.astype(int),
+        'duplicates'        : (step == 0).astype(int),
+        'frame_id_gaps'     : (step > 1).astype(int),
+        'rtt_outliers'      : outlier.astype(int)
+    })
+    for col in QUALITY_GROUPS:
+        checks[col] = frame_data[col]
+    return checks.groupby(QUALITY_GROUPS).sum()
+
+
+def quality_report(frame_data: pd.DataFrame,
+                   run_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Per (run, client) counts of unmatched, non-causal, duplicate and
+    out-of-sequence frames and of RTT outliers, and whether the client run is
+    flagged.
+    """
+    return _finish_report(quality_checks(frame_data), run_data)
+
+
+def stream_quality_report(exp_dir: str,
+                          run_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Same as quality_report(), in two passes over the partitions.
+    """
+    reference = rtt_reference(
+        iter_frame_partitions(exp_dir, run_data, QUALITY_COLUMNS))
+    checks = pd.concat(
+        quality_checks(partition, reference)
+        for partition in iter_frame_partitions(exp_dir, run_data,
+                                               QUALITY_COLUMNS))
+    return _finish_report(checks, run_data)
+
+
+def _finish_report(report: pd.DataFrame,
+                   run_data: pd.DataFrame) -> pd.DataFrame:
+    runs = run_data.set_index(QUALITY_GROUPS)
+    report = runs[['success']].join(report, how='left')
+    report = report.fillna(0).astype({c: int for c in report.columns
+                                      if c != 'success'})
+
+    if 'n_frames' in runs.columns:
+        report['unmatched'] = (runs['n_frames'] - report['frames']).clip(
+            lower=0)
+    else:
+        report['unmatched'] = 0
+
+    frames = report['frames'].where(report['frames'] > 0, np.nan)
+    total = (frames + report['unmatched']).fillna(report['unmatched'])
+    report['flagged'] = \
+        (report['frames'] == 0) | \
+        (report['duplicates'] > 0) | \
+        (report['unmatched'] / total > MAX_UNMATCHED_RATIO) | \
+        (report['negative_intervals'] / frames > MAX_NEGATIVE_RATIO) | \
+        (report['rtt_outliers'] / frames > MAX_OUTLIER_RATIO)
+
+    return report.reset_index()
@@ -0,0 +1,258 @@
+"""
+ Copyright 2019 Manuel Olguín
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from multiprocessing.pool import Pool
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from scipy import stats
+
+from cache import EXPERIMENT_CACHE, file_fingerprint
+from concurrent_logging import LOGGER
+from query import Experiments, collect_all, source_fingerprint
+
+FITS_FILE = 'distribution_fits.json'
+
+# the exponential distribution is fitted with a free location parameter,
+# i.e. as a shifted exponential
+DISTRIBUTIONS = OrderedDict([
+    ('lognorm', stats.lognorm),
+    ('gamma', stats.gamma),
+    ('weibull', stats.weibull_min),
+    ('shifted_expon', stats.expon)
+])
+
+Fit = NamedTuple('Fit', [('distribution', str),
+                         ('params', List[float]),
+                         ('aic', float),
+                         ('ks_stat', float)])
+
+FitKey = Tuple[bool, str]
+
+# fits with a location further below the smallest value than the span of the
+# values are degenerate, e.g. a lognormal with a huge negative location and
+# a tiny shape parameter, approximating a normal distribution
+LOC_SPAN_TOLERANCE = 1.0
+
+# cached fits of an older version are refitted
+FIT_VERSION = 2
+
+
+def fingerprint(values: np.ndarray) -> str:
+    data = np.ascontiguousarray(values, dtype=np.float64)
+    return hashlib.sha1(data.tobytes()).hexdigest()
+
+
+def fit_distribution(name: str, values: np.ndarray) -> Fit:
+    dist = DISTRIBUTIONS[name]
+    params = dist.fit(values)
+    loglik = np.sum(dist.logpdf(values, *params))
+    aic = 2.0 * len(params) - 2.0 * loglik
+    ks_stat = stats.kstest(values, dist.cdf, args=params).statistic
+    return Fit(name, [float(p) for p in params], float(aic), float(ks_stat))
+
+
+def plausible(fit: Fit, lower: float, upper: float) -> bool:
+    """
+    Whether a fit is finite, with a positive scale and a location not far
+    outside the range of the values.
+    """
+    if not np.all(np.isfinite([fit.aic, fit.ks_stat] + list(fit.params))):
+        return False
+    loc, scale = fit.params[-2], fit.params[-1]
+    return scale > 0 and \
+        lower - LOC_SPAN_TOLERANCE * (upper - lower) <= loc <= upper
+
+
+def rank_fits(fits: List[Fit], values: np.ndarray) \
+        -> Tuple[List[Fit], List[Fit]]:
+    """
+    Splits fits into the plausible ones, sorted by AIC, best first, and the
+    rejected ones.
+    """
+    lower, upper = float(np.min(values)), float(np.max(values))
+    ranked = sorted((f for f in fits if plausible(f, lower, upper)),
+                    key=lambda f: (f.aic, f.ks_stat))
+    rejected = [f for f in fits if not plausible(f, lower, upper)]
+    return ranked, rejected
+
+
+def _fit_task(args) -> Fit:
+    name, values = args
+    return fit_distribution(name, values)
+
+
+def frozen(fit: Fit):
+    """
+    Returns the fitted scipy distribution, ready to draw samples from.
+    """
+    return DISTRIBUTIONS[fit.distribution](*fit.params)
+
+
+def _cache_key(key: FitKey) -> str:
+    feedback, metric = key
+    return '{}/{}'.format('feedback' if feedback else 'nofeedback', metric)
+
+
+def load_fit_cache(exp_dir: str) -> Dict:
+    try:
+        with open(os.path.join(exp_dir, FITS_FILE), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def cached_best_fit(exp_dir: str, feedback: bool,
+                    metric: str = 'processing') -> Optional[Fit]:
+    """
+    Best previously fitted distribution for a data set, without checking
+    whether it is up to date.
+    """
+    cached = load_fit_cache(exp_dir).get(_cache_key((feedback, metric)))
+    if not cached or cached.get('version') != FIT_VERSION or \
+            not cached['fits']:
+        return None
+    return Fit(**cached['fits'][0])
+
+
+def fit_experiments(experiments: Dict[str, str],
+                    metrics: Iterable[str] = ('processing',),
+                    feedbacks: Iterable[bool] = (True, False),
+                    processes: int = 6) \
+        -> 'OrderedDict[str, Dict[FitKey, List[Fit]]]':
+    """
+    Fits all candidate distributions to each (experiment, feedback, metric) of
+    successful runs in parallel, caching them per experiment. Returns the
+    plausible fits sorted by AIC, best first.
+    """
+    metrics = tuple(metrics)
+    feedbacks = tuple(feedbacks)
+    keys = [(fb, m) for fb in feedbacks for m in metrics]
+
+    exps = Experiments(experiments).experiments
+    caches = {name: load_fit_cache(exp_dir) for name, exp_dir in exps.items()}
+    sources = {name: source_fingerprint(exp_dir)
+               for name, exp_dir in exps.items()}
+
+    # if none of the input tables changed, skip loading the data entirely
+    results = OrderedDict((name, {}) for name in exps)
+    for name in exps:
+        for key in keys:
+            cached = caches[name].get(_cache_key(key))
+            if cached and cached.get('version') == FIT_VERSION and \
+                    cached.get('source') == sources[name]:
+                results[name][key] = [Fit(**f) for f in cached['fits']]
+    if all(len(r) == len(keys) for r in results.values()):
+        return results
+
+    query = Experiments(experiments).select().where(success=True) \
+        .metric(*metrics).groupby('experiment')
+    data = collect_all(*(query.where(feedback=fb) for fb in feedbacks))
+
+    results = OrderedDict((name, {}) for name in exps)
+    pending = []
+    for fb, fb_data in zip(feedbacks, data):
+        for exp_name, frames in fb_data.items():
+            for metric in metrics:
+                values = frames[metric].values
+                fp = fingerprint(values)
+                cached = caches[exp_name].get(_cache_key((fb, metric)))
+                if cached and cached.get('version') == FIT_VERSION and \
+                        cached['fingerprint'] == fp:
+                    results[exp_name][(fb, metric)] = \
+                        [Fit(**f) for f in cached['fits']]
+                    cached['source'] = sources[exp_name]
+                elif len(values) == 0:
+                    # nothing to fit
+                    results[exp_name][(fb, metric)] = []
+                    caches[exp_name][_cache_key((fb, metric))] = {
+                        'version'    : FIT_VERSION,
+                        'fingerprint': fp,
+                        'source'     : sources[exp_name],
+                        'fits'       : [],
+                        'rejected'   : []
+                    }
+                else:
+                    pending.append((exp_name, (fb, metric), fp, values))
+
+    if pending:
+        LOGGER.info('Fitting distributions for %d data sets', len(pending))
+        tasks = [(name, values)
+                 for _, _, _, values in pending for name in DISTRIBUTIONS]
+        with Pool(min(processes, len(tasks))) as pool:
+            fits = pool.map(_fit_task, tasks)
+
+        n_dists = len(DISTRIBUTIONS)
+        for i, (exp_name, key, fp, values) in enumerate(pending):
+            exp_fits, rejected = rank_fits(
+                fits[i * n_dists:(i + 1) * n_dists], values)
+            for fit in rejected:
+                LOGGER.info('Rejected implausible %s fit for %s, %s: %s',
+                            fit.distribution, exp_name, _cache_key(key),
+                            fit.params)
+            results[exp_name][key] = exp_fits
+            caches[exp_name][_cache_key(key)] = {
+                'version'    : FIT_VERSION,
+                'fingerprint': fp,
+                'source'     : sources[exp_name],
+                'fits'       : [f._asdict() for f in exp_fits],
+                'rejected'   : [f._asdict() for f in rejected]
+            }
+
+    for exp_name, exp_dir in exps.items():
+        with open(os.path.join(exp_dir, FITS_FILE), 'w') as f:
+            json.dump(caches[exp_name], f)
+
+    return results
+
+
+def best_fits(experiments: Dict[str, str],
+              metric: str = 'processing',
+              feedback: bool = True,
+              processes: int = 6) -> 'OrderedDict[str, Fit]':
+    """
+    Best fit (lowest AIC) per experiment for a single metric. Results are
+    also kept in memory until the data or the stored fits change.
+    """
+    key = ('best_fit', feedback, metric)
+    results = OrderedDict()
+    missing = OrderedDict()
+    for name, exp_dir in Experiments(experiments).experiments.items():
+        fit = EXPERIMENT_CACHE.get('summary', exp_dir, key,
+                                   _fit_fingerprint(exp_dir))
+        if fit is None:
+            missing[name] = exp_dir
+        results[name] = fit
+
+    if missing:
+        fits = fit_experiments(missing, (metric,), (feedback,), processes)
+        for name, exp_fits in fits.items():
+            if exp_fits.get((feedback, metric)):
+                results[name] = exp_fits[(feedback, metric)][0]
+                EXPERIMENT_CACHE.put('summary', missing[name], key,
+                                     _fit_fingerprint(missing[name]),
+                                     results[name])
+    return OrderedDict((name, fit) for name, fit in results.items()
+                       if fit is not None)
+
+
+def _fit_fingerprint(exp_dir: str) -> str:
+    return '{};{}'.format(source_fingerprint(exp_dir),
+                          file_fingerprint(os.path.join(exp_dir, FITS_FILE)))
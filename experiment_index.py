@@ -0,0 +1,219 @@
+"""
+ Copyright 2019 Manuel Olguín
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import json
+import os
+import re
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from concurrent_logging import LOGGER
+from query import METRICS, Experiments, collect_all, source_fingerprint
+from util import PERCENTILES, load_experiment_config, load_partition_index, \
+    load_run_data, round_floats, valid_runs
+
+INDEX_FILE = 'experiments_index.json'
+
+# files, besides the frame and run tables, summarized in the index
+SUMMARY_INPUTS = ('experiment_config.json', 'experiment_config.toml',
+                  'total_system_stats.csv',
+                  'sampled_time_stats_feedback.json',
+                  'sampled_time_stats_nofeedback.json')
+
+CPU_LIMIT_PATTERN = re.compile(r'_([0-9.]+)CPU$')
+
+
+def is_experiment(exp_dir: str) -> bool:
+    return any(os.path.exists(os.path.join(exp_dir, f))
+               for f in ('experiment_config.json', 'experiment_config.toml'))
+
+
+def input_fingerprint(exp_dir: str) -> str:
+    parts = [source_fingerprint(exp_dir)]
+    for filename in SUMMARY_INPUTS:
+        try:
+            st = os.stat(os.path.join(exp_dir, filename))
+            parts.append('{}:{}:{}'.format(filename, st.st_size,
+                                           st.st_mtime_ns))
+        except FileNotFoundError:
+            pass
+    return ';'.join(parts)
+
+
+def _has_frames(exp_dir: str) -> bool:
+    return load_partition_index(exp_dir) is not None or \
+        os.path.exists(os.path.join(exp_dir, 'total_frame_stats.csv'))
+
+
+def _describe(values: np.ndarray) -> Dict[str, float]:
+    if len(values) == 0:
+        return {}
+    results = OrderedDict(
+        ('p{}'.format(p), float(v))
+        for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES)))
+    results['mean'] = float(np.mean(values))
+    return results
+
+
+def _latency_summary(exp_dir: str) -> Dict:
+    """
+    Percentiles of each latency component of successful runs, by feedback
+    flag, from a single scan of the frame table.
+    """
+    query = Experiments({'exp': exp_dir}).select().where(success=True) \
+        .metric(*METRICS)
+    feedback, no_feedback = collect_all(query.where(feedback=True),
+                                        query.where(feedback=False))
+    return OrderedDict(
+        (name, OrderedDict((m, _describe(frames[m].values)) for m in METRICS))
+        for name, frames in (('feedback', feedback),
+                             ('nofeedback', no_feedback)))
+
+
+def _sampled_summary(exp_dir: str) -> Dict:
+    """
+    Mean latencies from the sampled statistics, for experiments whose frame
+    tables are not in the repository.
+    """
+    results = OrderedDict()
+    for name in ('feedback', 'nofeedback'):
+        filename = os.path.join(exp_dir,
+                                'sampled_time_stats_{}.json'.format(name))
+        try:
+            with open(filename, 'r') as f:
+                sampled = json.load(f)
+        except FileNotFoundError:
+            continue
+        results[name] = OrderedDict((m, {'mean': s['mean']})
+                                    for m, s in sampled.items())
+    return results
+
+
+def _system_summary(exp_dir: str) -> Dict:
+    try:
+        system = pd.read_csv(os.path.join(exp_dir, 'total_system_stats.csv'),
+                             usecols=['cpu_load', 'mem_avail'])
+    except FileNotFoundError:
+        return {}
+    return {
+        'cpu_load' : _describe(system['cpu_load'].values),
+        'mem_avail': {'mean': float(system['mem_avail'].mean()),
+                      'min' : float(system['mem_avail'].min())}
+    }
+
+
+def summarize_experiment(exp_dir: str) -> Dict:
+    name = os.path.basename(os.path.normpath(exp_dir))
+    config = load_experiment_config(exp_dir)
+    cpu_limit = CPU_LIMIT_PATTERN.search(name)
+
+    summary = OrderedDict([
+        ('experiment_id', config['experiment_id']),
+        ('fingerprint', input_fingerprint(exp_dir)),
+        ('config', OrderedDict([
+            ('clients', config['clients']),
+            ('runs', config['runs']),
+            ('steps', config.get('steps')),
+            ('num_cpus', config.get('num_cpus',
+                                    len(config.get('cpu_cores', [])) or None)),
+            ('cpu_limit', float(cpu_limit.group(1)) if cpu_limit else 1.0),
+            ('link', 'impaired' if 'BadLink' in name else 'optimal')
+        ]))
+    ])
+
+    try:
+        run_data = load_run_data(exp_dir)
+    except FileNotFoundError:
+        run_data = None
+    if run_data is not None:
+        successful = int(run_data['success'].sum())
+        summary['runs'] = OrderedDict([
+            ('client_runs', int(run_data.shape[0])),
+            ('successful', successful),
+            ('success_rate', successful / float(run_data.shape[0])),
+            ('valid', int(valid_runs(run_data).shape[0]))
+        ])
+
+    if run_data is not None and _has_frames(exp_dir):
+        summary['latency'] = _latency_summary(exp_dir)
+    else:
+        summary['latency'] = _sampled_summary(exp_dir)
+    summary['system'] = _system_summary(exp_dir)
+    return summary
+
+
+def load_index(root_dir: str = '.') -> 'OrderedDict[str, Dict]':
+    try:
+        with open(os.path.join(root_dir, INDEX_FILE), 'r') as f:
+            return json.load(f, object_pairs_hook=OrderedDict)
+    except FileNotFoundError:
+        return OrderedDict()
+
+
+def update_index(exp_dirs: Optional[Iterable[str]] = None,
+                 root_dir: str = '.',
+                 force: bool = False) -> 'OrderedDict[str, Dict]':
+    """
+    Updates the index of the experiments in root_dir, keeping unchanged
+    entries.
+    """
+    if exp_dirs is None:
+        exp_dirs = sorted(d for d in os.listdir(root_dir)
+                          if is_experiment(os.path.join(root_dir, d)))
+
+    index = load_index(root_dir)
+    for exp_dir in exp_dirs:
+        name = os.path.basename(os.path.normpath(exp_dir))
+        path = os.path.join(root_dir, name)
+        entry = index.get(name)
+        if not force and entry and \
+                entry['fingerprint'] == input_fingerprint(path):
+            continue
+        LOGGER.info('Summarizing %s', name)
+        index[name] = summarize_experiment(path)
+
+    index = OrderedDict(sorted(index.items()))
+    with open(os.path.join(root_dir, INDEX_FILE), 'w') as f:
+        json.dump(round_floats(index), f, indent=2)
+    return index
+
+
+def summary_table(index: Dict, feedback: bool = False,
+                  metrics: List[str] = ('processing', 'uplink', 'downlink',
+                                        'rtt'),
+                  stat: str = 'mean') -> pd.DataFrame:
+    """
+    One row per indexed experiment with its configuration, success rate, CPU
+    load and latencies.
+    """
+    fb = 'feedback' if feedback else 'nofeedback'
+    rows = []
+    for name, entry in index.items():
+        row = OrderedDict([('experiment', name)])
+        row.update(entry['config'])
+        row['success_rate'] = entry.get('runs', {}).get('success_rate',
+                                                        np.nan)
+        latency = entry['latency'].get(fb, {})
+        for m in metrics:
+            values = latency.get(m, {})
+            row['{}_{}'.format(m, stat)] = values.get(stat, np.nan)
+        row['cpu_load'] = entry['system'].get('cpu_load', {}).get('mean',
+                                                                  np.nan)
+        rows.append(row)
+    return pd.DataFrame(rows)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+ Copyright 2019 Manuel Olguín
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import asyncio
+import csv
+import json
+import os
+import signal
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional
+
+import click
+import numpy as np
+import psutil
+
+from concurrent_logging import LOGGER
+from dist_fit import cached_best_fit, frozen
+from util import client_ports, load_experiment_config
+
+SYSTEM_STATS_INTERVAL = 0.2
+SAMPLE_BATCH = 1024
+
+
+class ServiceTimeModel:
+    """
+    Draws processing times in ms from an experiment's fitted distributions, or
+    a constant.
+    """
+
+    def __init__(self, experiment_dir: Optional[str] = None,
+                 constant: float = 20.0, seed: Optional[int] = None):
+        self.random = np.random.RandomState(seed)
+        self.dists = {}
+        if experiment_dir is not None:
+            for feedback in (True, False):
+                best = cached_best_fit(experiment_dir, feedback)
+                if best is not None:
+                    self.dists[feedback] = frozen(best)
+                    LOGGER.info('Service time model (feedback=%s): %s %s',
+                                feedback, best.distribution, best.params)
+                else:
+                    LOGGER.warning('No processing time fit for feedback=%s '
+                                   'in %s', feedback, experiment_dir)
+        self.constant = constant
+        self.samples = {True: [], False: []}
+
+    def sample(self, feedback: bool) -> float:
+        if feedback not in self.dists:
+            return self.constant
+        if not self.samples[feedback]:
+            # draw in batches, scipy's per-call overhead is considerable
+            batch = self.dists[feedback].rvs(size=SAMPLE_BATCH,
+                                              random_state=self.random)
+            self.samples[feedback] = list(np.clip(batch, 0, None))
+        return float(self.samples[feedback].pop())
+
+
+def busy_wait(duration_ms: float) -> None:
+    end = time.perf_counter() + duration_ms / 1000.0
+    while time.perf_counter() < end:
+        pass
+
+
+def encode_result(result: Dict) -> bytes:
+    # length-prefixed JSON, as parsed from the capture by lego_timing
+    msg = json.dumps(result).encode('utf-8')
+    return struct.pack('>I', len(msg)) + msg
+
+
+class GabrielStandIn:
+    """
+    Stand-in Gabriel backend: queues frames for a pool of workers which hold
+    them for a modelled service time.
+    """
+
+    def __init__(self, config: Dict, n_clients: int,
+                 model: ServiceTimeModel, workers: int,
+                 busy: bool = False, host: str = '0.0.0.0'):
+        self.ports = [client_ports(config, c) for c in range(n_clients)]
+        self.model = model
+        self.n_workers = workers
+        self.host = host
+        self.busy = busy
+        self.executor = None
+        self.queue = None
+        self.idle = None
+        self.stopped = None
+        self.servers = []
+        self.workers = []
+        self.result_writers = {}
+        self.open_connections = 0
+        self.served_connections = 0
+
+    def _track(self, opened: bool) -> None:
+        if opened:
+            self.open_connections += 1
+            self.served_connections += 1
+            self.idle.clear()
+        else:
+            self.open_connections -= 1
+            if self.open_connections == 0:
+                self.idle.set()
+
+    async def _handle_video(self, client_idx: int,
+                            reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter) -> None:
+        self._track(True)
+        try:
+            while True:
+                (header_len,) = struct.unpack('>I',
+                                              await reader.readexactly(4))
+                header = json.loads(
+                    (await reader.readexactly(header_len)).decode('utf-8'))
+                (data_len,) = struct.unpack('>I', await reader.readexactly(4))
+                await reader.readexactly(data_len)
+                await self.queue.put((client_idx, header, time.time()))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            self._track(False)
+
+    async def _handle_result(self, client_idx: int,
+                             reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter) -> None:
+        self._track(True)
+        self.result_writers[client_idx] = writer
+        try:
+            # nothing is expected from the client on this port
+            await reader.read()
+        except ConnectionError:
+            pass
+        finally:
+            if self.result_writers.get(client_idx) is writer:
+                del self.result_writers[client_idx]
+            writer.close()
+            self._track(False)
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            client_idx, header, server_recv = await self.queue.get()
+            feedback = bool(header.get('feedback', False))
+            service_time = self.model.sample(feedback)
+            if self.executor is not None:
+                await loop.run_in_executor(self.executor, busy_wait,
+                                           service_time)
+            else:
+                await asyncio.sleep(service_time / 1000.0)
+
+            writer = self.result_writers.get(client_idx)
+            if writer is not None:
+                writer.write(encode_result({
+                    'frame_id'   : header['frame_id'],
+                    'status'     : 'success',
+                    'feedback'   : feedback,
+                    'state_index': header.get('state_index', -1),
+                    'server_recv': server_recv,
+                    'server_sent': time.time()
+                }))
+            self.queue.task_done()
+
+    async def start(self) -> None:
+        # created here so they belong to the running event loop
+        self.queue = asyncio.Queue()
+        self.idle = asyncio.Event()
+        self.stopped = asyncio.Event()
+        if self.busy:
+            self.executor = ProcessPoolExecutor(self.n_workers)
+
+        for client_idx, ports in enumerate(self.ports):
+            self.servers.append(await asyncio.start_server(
+                lambda r, w, c=client_idx: self._handle_video(c, r, w),
+                self.host, ports['video']))
+            self.servers.append(await asyncio.start_server(
+                lambda r, w, c=client_idx: self._handle_result(c, r, w),
+                self.host, ports['result']))
+        self.workers = [asyncio.ensure_future(self._worker())
+                        for _ in range(self.n_workers)]
+        LOGGER.info('Serving %d clients with %d workers', len(self.ports),
+                    self.n_workers)
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    async def serve(self, duration: Optional[float] = None,
+                    exit_when_done: bool = False) -> None:
+        if self.stopped is None:
+            await self.start()
+
+        loop = asyncio.get_event_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+        if duration is not None:
+            loop.call_later(duration, self.stop)
+
+        waiters = [asyncio.ensure_future(self.stopped.wait())]
+        if exit_when_done:
+            waiters.append(asyncio.ensure_future(self._wait_done()))
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+
+        for task in self.workers + waiters:
+            task.cancel()
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    async def _wait_done(self) -> None:
+        # done once every client that connected has disconnected again
+        while True:
+            await self.idle.wait()
+            if self.served_connections > 0:
+                return
+            self.idle.clear()
+
+
+async def record_system_stats(filename: str) -> None:
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['cpu_load', 'mem_avail', 'timestamp'])
+        psutil.cpu_percent()
+        while True:
+            await asyncio.sleep(SYSTEM_STATS_INTERVAL)
+            writer.writerow([psutil.cpu_percent(),
+                             psutil.virtual_memory().available,
+                             time.time() * 1000.0])
+
+
+async def run_server(server: GabrielStandIn, output_dir: str,
+                     duration: Optional[float],
+                     exit_when_done: bool) -> None:
+    run_start = time.time() * 1000.0
+    stats_task = asyncio.ensure_future(record_system_stats(
+        os.path.join(output_dir, 'system_stats.csv')))
+    try:
+        await server.serve(duration, exit_when_done)
+    finally:
+        stats_task.cancel()
+        run_end = time.time() * 1000.0
+        with open(os.path.join(output_dir, 'server_stats.json'), 'w') as f:
+            json.dump({'server_offset': 0.0,
+                       'run_start'    : run_start,
+                       'run_end'      : run_end}, f)
+
+
+@click.command()
+@click.argument('config_dir',
+                type=click.Path(dir_okay=True, file_okay=False, exists=True))
+@click.argument('output_dir', type=click.Path(file_okay=False))
+@click.option('--clients', type=int, default=None,
+              help='Number of clients to listen for (default: as '
+                   'configured).')
+@click.option('--workers', type=int, default=os.cpu_count(),
+              help='Number of frames processed concurrently.')
+@click.option('--model', 'model_dir', default=None,
+              type=click.Path(dir_okay=True, file_okay=False, exists=True),
+              help='Experiment whose fitted processing time distributions '
+                   'are used as service time model.')
+@click.option('--constant', type=float, default=20.0,
+              help='Service time in ms when no fitted model is available.')
+@click.option('--busy', is_flag=True, default=False,
+              help='Burn CPU in worker processes instead of sleeping.')
+@click.option('--duration', type=float, default=None,
+              help='Stop after this many seconds.')
+@click.option('--exit_when_done', is_flag=True, default=False,
+              help='Stop once all connected clients have disconnected.')
+@click.option('--seed', type=int, default=None)
+def serve(config_dir, output_dir, clients, workers, model_dir, constant,
+          busy, duration, exit_when_done, seed):
+    """
+    Runs a Gabriel stand-in server for the clients configured in CONFIG_DIR,
+    recording a single run to OUTPUT_DIR.
+    """
+    config = load_experiment_config(config_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    model = ServiceTimeModel(model_dir, constant, seed)
+    server = GabrielStandIn(config, clients or config['clients'], model,
+                            workers, busy)
+    asyncio.run(run_server(server, output_dir, duration, exit_when_done))
+
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,172 @@
+"""
+ Copyright 2019 Manuel Olguín
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import os
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+from cache import EXPERIMENT_CACHE, file_fingerprint
+from concurrent_logging import LOGGER
+from query import Experiments, collect_all, source_fingerprint
+
+HIST_FILE = 'histograms.npz'
+
+# fine log-spaced binning from 10us to 100s, 500 bins per decade
+HIST_RANGE = (1e-2, 1e5)
+BINS_PER_DECADE = 500
+HIST_METRICS = ('processing', 'uplink', 'downlink')
+
+HistKey = Tuple[bool, str]
+
+
+def fine_edges() -> np.ndarray:
+    lo, hi = np.log10(HIST_RANGE)
+    n_bins = int(round((hi - lo) * BINS_PER_DECADE))
+    return np.logspace(lo, hi, n_bins + 1)
+
+
+def _hist_name(key: HistKey) -> str:
+    feedback, metric = key
+    return '{}_{}'.format('feedback' if feedback else 'nofeedback', metric)
+
+
+def compute_histograms(experiments: Dict[str, str],
+                       metrics: Iterable[str] = HIST_METRICS,
+                       feedbacks: Iterable[bool] = (True, False)) -> None:
+    """
+    Computes and stores fine log-binned histograms of each (feedback, metric)
+    of the given experiments.
+    """
+    metrics = tuple(metrics)
+    feedbacks = tuple(feedbacks)
+    exps = Experiments(experiments)
+    query = exps.select().where(success=True).metric(*metrics) \
+        .groupby('experiment')
+    data = collect_all(*(query.where(feedback=fb) for fb in feedbacks))
+
+    edges = fine_edges()
+    arrays = OrderedDict((exp_dir, {'edges': edges})
+                         for exp_dir in exps.experiments.values())
+    for fb, fb_data in zip(feedbacks, data):
+        for exp_name, frames in fb_data.items():
+            exp_dir = exps.experiments[exp_name]
+            for metric in metrics:
+                values = np.clip(frames[metric].values, edges[0], edges[-1])
+                counts, _ = np.histogram(values, edges)
+                arrays[exp_dir][_hist_name((fb, metric))] = counts
+
+    for exp_dir, exp_arrays in arrays.items():
+        LOGGER.info('Storing histograms for %s', exp_dir)
+        exp_arrays['source'] = np.array(source_fingerprint(exp_dir))
+        np.savez_compressed(os.path.join(exp_dir, HIST_FILE), **exp_arrays)
+
+
+def load_histograms(experiments: Dict[str, str],
+                    metric: str = 'processing',
+                    feedback: bool = True) \
+        -> 'OrderedDict[str, Tuple[np.ndarray, np.ndarray]]':
+    """
+    Returns (edges, counts) per experiment, recomputing stored histograms whose
+    inputs changed.
+    """
+    key = _hist_name((feedback, metric))
+    exps = Experiments(experiments).experiments
+    results = OrderedDict()
+    for exp_name, exp_dir in exps.items():
+        hist = EXPERIMENT_CACHE.get('summary', exp_dir, ('histogram', key),
+                                    _hist_fingerprint(exp_dir))
+        if hist is None:
+            hist = _load_histogram(exp_dir, key)
+        if hist is None:
+            compute_histograms({exp_name: exp_dir}, HIST_METRICS)
+            hist = _load_histogram(exp_dir, key)
+        if hist is not None:
+            EXPERIMENT_CACHE.put('summary', exp_dir, ('histogram', key),
+                                 _hist_fingerprint(exp_dir), hist)
+            results[exp_name] = hist
+    return results
+
+
+def _hist_fingerprint(exp_dir: str) -> str:
+    return '{};{}'.format(source_fingerprint(exp_dir),
+                          file_fingerprint(os.path.join(exp_dir, HIST_FILE)))
+
+
+def _load_histogram(exp_dir: str, key: str) \
+        -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    try:
+        with np.load(os.path.join(exp_dir, HIST_FILE)) as hists:
+            if str(hists['source']) == source_fingerprint(exp_dir) \
+                    and key in hists:
+                return hists['edges'], hists[key]
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def rebin(edges: np.ndarray, counts: np.ndarray,
+          new_edges: np.ndarray) -> np.ndarray:
+    """
+    Redistributes fine histogram counts into new bins, splitting straddling
+    bins in log space.
+    """
+    cumulative = np.concatenate(([0], np.cumsum(counts)))
+    new_cumulative = np.interp(np.log10(new_edges), np.log10(edges),
+                               cumulative)
+    return np.diff(new_cumulative)
+
+
+def density(edges: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    total = counts.sum()
+    if total == 0:
+        return np.zeros(len(counts))
+    return counts / (total * np.diff(edges))
+
+
+def fft_kde(edges: np.ndarray, counts: np.ndarray,
+            bandwidth: float = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Gaussian KDE in log space of binned counts, computed with FFTs; the
+    bandwidth is in decades. Returns bin centers and densities of the linear
+    values.
+    """
+    log_edges = np.log10(edges)
+    log_centers = (log_edges[:-1] + log_edges[1:]) / 2.0
+    step = log_edges[1] - log_edges[0]
+    total = counts.sum()
+
+    if bandwidth is None:
+        mean = np.sum(counts * log_centers) / total
+        std = np.sqrt(np.sum(counts * (log_centers - mean) ** 2) / total)
+        bandwidth = max(1.06 * std * total ** (-1.0 / 5.0), step)
+
+    n = len(counts)
+    half_width = int(np.ceil(4.0 * bandwidth / step))
+    offsets = np.arange(-half_width, half_width + 1) * step
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+    kernel /= kernel.sum()
+
+    size = n + len(kernel) - 1
+    smoothed = np.fft.irfft(np.fft.rfft(counts, size) *
+                            np.fft.rfft(kernel, size), size)
+    smoothed = np.clip(smoothed[half_width:half_width + n], 0, None)
+
+    # density per decade, then per unit of the linear variable
+    log_density = smoothed / (total * step)
+    centers = 10 ** log_centers
+    return centers, log_density / (centers * np.log(10))
@@ -0,0 +1,76 @@
+"""
+ Copyright 2019 Manuel Olguín
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+# modules which the CLI must only import in the subcommands that use them
+HEAVY_MODULES = ('scapy', 'scipy', 'matplotlib')
+
+CHECK_HEAVY = 'import sys, {module}; ' \
+              'print(" ".join(m for m in {heavy} if m in sys.modules))'
+
+
+def startup_time(module: str, repeat: int) -> float:
+    """
+    Median wall time of starting a fresh interpreter and importing a module,
+    in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import ' + module], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def heavy_imports(module: str):
+    out = subprocess.run(
+        [sys.executable, '-c',
+         CHECK_HEAVY.format(module=module, heavy=HEAVY_MODULES)],
+        check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return out.split()
+
+
+@click.command()
+@click.option('--module', default='process_results',
+              help='Module to import, by default the one of the CLI.')
+@click.option('--budget', type=float, default=1.0,
+              help='Maximum median import time, in seconds.')
+@click.option('--repeat', type=int, default=5)
+def benchmark(module, budget, repeat):
+    """
+    Fails if importing the CLI exceeds its time budget or pulls in scapy, scipy
+    or matplotlib.
+    """
+    baseline = startup_time('sys', repeat)
+    elapsed = startup_time(module, repeat)
+    heavy = heavy_imports(module)
+    print('import {}: {:.3f} s ({:.3f} s over a bare interpreter), '
+          'budget {:.3f} s'.format(module, elapsed, elapsed - baseline,
+                                   budget))
+    if heavy:
+        print('heavy modules imported: {}'.format(', '.join(heavy)))
+    if elapsed > budget or heavy:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
 """
  Copyright 2019 Manuel Olguín
- 
+
  Licensed under the Apache License, Version 2.0 (the "License");
  you may not use this file except in compliance with the License.
  You may obtain a copy of the License at
- 
+
      http://www.apache.org/licenses/LICENSE-2.0
- 
+
  Unless required by applicable law or agreed to in writing, software
  distributed under the License is distributed on an "AS IS" BASIS,
  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
@@ -16,100 +16,815 @@
 """
 
 
+import heapq
 import json
-from json import JSONDecodeError
-from typing import Dict
-from scapy.all import *
+import mmap
+import struct
+from collections import deque
+from multiprocessing.pool import Pool
+from typing import Callable, Dict, FrozenSet, Iterable, Iterator, List, \
+    Optional, Tuple
+
+import pandas as pd
+
 from concurrent_logging import LOGGER
 
+PCAP_HEADER = struct.Struct('<IHHiIII')
+RECORD_HEADER = struct.Struct('<IIII')
+
+# magic numbers of classic pcap files, as read in little endian
+PCAP_MAGIC = {0xa1b2c3d4: ('<', 1e-3),  # microsecond timestamps
+              0xd4c3b2a1: ('>', 1e-3),
+              0xa1b23c4d: ('<', 1e-6),  # nanosecond timestamps
+              0x4d3cb2a1: ('>', 1e-6)}
+
+# link types and the offset of the network layer protocol field and header
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = 0x8100
+IPPROTO_TCP = 6
+
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+SEQ_MOD = 1 << 32
+
+# bounds on what is kept in memory for each direction of a connection
+MAX_HEADER_LEN = 4096  # JSON header of a video message
+MAX_MESSAGE_LEN = 1 << 26  # larger lengths mean we are not at a message start
+MAX_OUT_OF_ORDER = 1 << 20  # bytes of segments received ahead of a hole
+HOLE_TIMEOUT = 3000.0  # ms to wait for a hole to be filled by retransmission
+MAX_HEAD = 1 << 22  # bytes kept to continue a connection across byte ranges
+MAX_PREFIX = MAX_HEADER_LEN + 8
+RESULT_PREFIX_LEN = 80  # enough to get the "frame_id" part of a result
+MAX_UNACKED = 4096  # segments waiting for an ACK to take an RTT sample
+
+# per second counters of each direction of a connection; bytes is the
+# goodput, i.e. bytes delivered in order, and the sum of RTTs is counted in
+# whole microseconds, so that totals do not depend on the order in which the
+# counters of different byte ranges are added up
+NETWORK_COUNTERS = ('bytes', 'segments', 'retransmissions', 'out_of_order',
+                    'zero_windows', 'rtt_samples', 'rtt_sum')
+BYTES, SEGMENTS, RETRANSMISSIONS, OUT_OF_ORDER, ZERO_WINDOWS, RTT_SAMPLES, \
+    RTT_SUM = range(len(NETWORK_COUNTERS))
+
+# (source address, source port, destination address, destination port)
+FlowKey = Tuple[bytes, int, bytes, int]
+# (timestamp in ms, frame id) pairs per port, in capture order
+PortTable = Dict[int, List[Tuple[float, int]]]
+# counters by second of capture time
+FlowStats = Dict[int, List[int]]
+# length of a message and its frame id, see _video_message
+Framing = Callable[[bytearray], Optional[Tuple[int, Optional[int]]]]
+
+INVALID = (-1, None)
+
+
+def _mod(pos: Optional[int]) -> Optional[int]:
+    # stream positions of different byte ranges only agree modulo SEQ_MOD
+    return None if pos is None else pos % SEQ_MOD
+
+
+def _frame_id_incoming(message) -> Optional[int]:
+    """
+    Frame id in the length-prefixed JSON header of a Gabriel video message.
+    """
+    (header_len,) = struct.unpack_from('>I', message)
+    try:
+        header = bytes(message[4:header_len + 4]).decode('utf-8')
+        return json.loads(header)['frame_id']
+    except (UnicodeDecodeError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _frame_id_outgoing(message) -> Optional[int]:
+    """
+    Frame id in a Gabriel result message, read from the first bytes after its
+    length.
+    """
+    try:
+        data = bytes(message[4:RESULT_PREFIX_LEN]).decode('utf-8')
+        idx = data.index('"frame_id"')
+        comma_idx = data.index(',', idx, -1)
+        return json.loads('{' + data[idx:comma_idx] + '}')['frame_id']
+    except (UnicodeDecodeError, ValueError, KeyError):
+        return None
+
+
+def _video_message(prefix: bytearray) -> Optional[Tuple[int, Optional[int]]]:
+    """
+    Length and frame id of the video message at the start of prefix; None if
+    more bytes are needed, INVALID if none can start here.
+    """
+    if len(prefix) < 5:
+        return None
+    (header_len,) = struct.unpack_from('>I', prefix)
+    if not 0 < header_len <= MAX_HEADER_LEN or prefix[4] != ord('{'):
+        return INVALID
+    if len(prefix) < header_len + 8:
+        return None
+    (data_len,) = struct.unpack_from('>I', prefix, header_len + 4)
+    return header_len + 8 + data_len, _frame_id_incoming(prefix)
+
+
+def _result_message(prefix: bytearray) -> Optional[Tuple[int, Optional[int]]]:
+    """
+    Length and frame id of the length-prefixed Gabriel result message at the
+    start of prefix, see _video_message.
+    """
+    if len(prefix) < 5:
+        return None
+    (length,) = struct.unpack_from('>I', prefix)
+    if not 0 < length <= MAX_MESSAGE_LEN or prefix[4] != ord('{'):
+        return INVALID
+    if len(prefix) < min(length + 4, RESULT_PREFIX_LEN):
+        return None
+    return length + 4, _frame_id_outgoing(prefix[:length + 4])
+
+
+FRAMINGS = (_video_message, _result_message)
+
+
+def flow_framings(key: FlowKey, video_ports: Optional[FrozenSet[int]],
+                  result_ports: Optional[FrozenSet[int]]) \
+        -> Tuple[Framing, ...]:
+    """
+    Framings to look for in a flow given its ports; both if they are not known.
+    """
+    if video_ports is None and result_ports is None:
+        return FRAMINGS
+    src, sport, dst, dport = key
+    return tuple(f for f, match in ((_video_message, dport in video_ports),
+                                    (_result_message, sport in result_ports))
+                 if match)
+
+
+class MessageParser():
+    """
+    Finds length-prefixed messages in a byte stream, resynchronizing on a
+    plausible message start after lost bytes.
+    """
+
+    def __init__(self, framing: Framing):
+        self.framing = framing
+        self.boundary = None  # stream position of the next message
+        self.verified = False
+        self.prefix = bytearray()
+        self.prefix_ts = 0.0
+        self.candidates = []  # type: List[Tuple[int, float, int]]
+        # (stream position, timestamp of its first byte, frame id)
+        self.messages = []  # type: List[Tuple[int, float, int]]
+
+    def sync(self, pos: int) -> None:
+        # the start of the stream, e.g. right after a SYN
+        self._reset(pos)
+        self.verified = True
+
+    def in_sync(self) -> bool:
+        # between two messages of a verified stream
+        return self.verified and not self.prefix
+
+    def state(self) -> Tuple:
+        """
+        Everything that decides how the rest of the stream is parsed.
+        """
+        return (self.framing, _mod(self.boundary), self.verified,
+                bytes(self.prefix), self.prefix_ts if self.prefix else None,
+                [(_mod(start), ts, frame_id)
+                 for start, ts, frame_id in self.candidates])
+
+    def _reset(self, boundary: Optional[int]) -> None:
+        self.boundary = boundary
+        self.verified = False
+        self.prefix = bytearray()
+        self.candidates = []
+
+    def gap(self, start: int, end: int) -> None:
+        # bytes in [start, end) were never captured
+        if self.boundary is not None and (self.prefix or self.boundary < end):
+            self._reset(None)
+
+    def _resync(self, pos: int, data: bytes, offset: int) -> bool:
+        idx = data.find(b'{', max(offset, 4))
+        while idx >= 0:
+            result = self.framing(bytearray(data[idx - 4:idx + MAX_PREFIX]))
+            if result is None or result[0] > 0:
+                self._reset(pos + idx - 4)
+                return True
+            idx = data.find(b'{', idx + 1)
+        return False
+
+    def feed(self, pos: int, ts: float, data: bytes) -> None:
+        """
+        Processes the bytes at stream positions [pos, pos + len(data)),
+        captured at time ts.
+        """
+        end = pos + len(data)
+        while True:
+            if self.boundary is None and \
+                    not self._resync(pos, data, 0):
+                return
+            if self.boundary >= end:
+                return
+
+            if not self.prefix:
+                self.prefix_ts = ts
+            offset = self.boundary + len(self.prefix) - pos
+            self.prefix += data[offset:offset + MAX_PREFIX - len(self.prefix)]
+            result = self.framing(self.prefix)
+            if result is None:
+                if len(self.prefix) < MAX_PREFIX:
+                    return
+                result = INVALID
+            length, frame_id = result
+
+            start = self.boundary
+            if length < 0 or (not self.verified and frame_id is None):
+                self._reset(None)
+                # search again after the '{' of the rejected message
+                if not self._resync(pos, data, start - pos + 5):
+                    return
+                continue
+
+            self.boundary += length
+            self.prefix = bytearray()
+            if self.verified:
+                if frame_id is not None:
+                    self.messages.append((start, self.prefix_ts, frame_id))
+                continue
+
+            self.candidates.append((start, self.prefix_ts, frame_id))
+            if len(self.candidates) > 1:
+                # two consecutive valid messages, we are in sync
+                self.verified = True
+                self.messages.extend(self.candidates)
+                self.candidates = []
+
+
+class FlowReassembler():
+    """
+    Reorders the segments of one direction of a TCP connection for its message
+    parsers, reporting lost bytes as gaps and counting NETWORK_COUNTERS per
+    second.
+    """
+
+    def __init__(self, framings: Tuple[Framing, ...]):
+        self.framings = framings
+        self.parsers = [MessageParser(f) for f in framings]
+        self.next_pos = None
+        self.last_seq = 0
+        self.last_pos = 0
+        self.out_of_order = []  # heap of (position, ts, payload, length)
+        self.out_of_order_bytes = 0
+        self.hole_since = 0.0
+        self.acked_pos = None  # last position acknowledged by the other end
+        self.carried_data = False
+        self.stats = {}  # type: FlowStats
+        self.unacked = deque()  # (end position, ts) of segments sent once
+        # (is an ACK, arguments of acked or add) of each call before this
+        # reassembler settled
+        self.head = []  # type: List[Tuple[bool, tuple]]
+        self.head_bytes = 0
+        self.recording = True
+
+    def position(self, seq: int) -> int:
+        diff = (seq - self.last_seq) % SEQ_MOD
+        if diff >= SEQ_MOD // 2:
+            diff -= SEQ_MOD
+        return self.last_pos + diff
+
+    def _counters(self, ts: float) -> List[int]:
+        second = int(ts // 1000.0)
+        counters = self.stats.get(second)
+        if counters is None:
+            counters = self.stats[second] = [0] * len(NETWORK_COUNTERS)
+        return counters
+
+    def _sent(self, end: int, ts: float) -> None:
+        self.unacked.append((end, ts))
+        if len(self.unacked) > MAX_UNACKED:
+            self.unacked.popleft()
+
+    def _forget(self, start: int, end: int) -> None:
+        # retransmitted segments give ambiguous RTT samples
+        self.unacked = deque(u for u in self.unacked
+                             if not start < u[0] <= end)
+
+    def _settled(self) -> bool:
+        # all bytes so far are in order and acknowledged, and the parsers are
+        # between two messages or have not seen any data yet; from here on,
+        # a reassembler which saw the whole connection would most likely be
+        # in the same state
+        if self.next_pos is None or self.out_of_order or \
+                self.acked_pos is None or self.acked_pos < self.next_pos:
+            return False
+        return not self.carried_data or \
+            all(p.in_sync() for p in self.parsers)
+
+    def _record(self, is_ack: bool, args: tuple, size: int) -> None:
+        if self.recording:
+            self.head.append((is_ack, args))
+            self.head_bytes += size
+
+    def _settle(self) -> None:
+        if self.recording and (self.head_bytes >= MAX_HEAD or
+                               self._settled()):
+            self.recording = False
+
+    def acked(self, ack: int, ts: float) -> None:
+        """
+        Processes an acknowledgement number sent by the other end at time ts.
+        """
+        self._record(True, (ack, ts), 0)
+        self._acked(ack, ts)
+        self._settle()
+
+    def _acked(self, ack: int, ts: float) -> None:
+        if self.next_pos is None:
+            return
+        pos = self.position(ack)
+        if pos > self.next_pos:
+            return  # acknowledges bytes the capture missed
+        self.acked_pos = pos
+        sent = None
+        while self.unacked and self.unacked[0][0] <= pos:
+            _, sent = self.unacked.popleft()
+        if sent is not None:
+            counters = self._counters(ts)
+            counters[RTT_SAMPLES] += 1
+            counters[RTT_SUM] += int(round((ts - sent) * 1000.0))
+
+    def add(self, ts: float, seq: int, flags: int, window: int,
+            payload: bytes, seg_len: int) -> None:
+        """
+        Adds a segment with sequence number seq and seg_len bytes of payload,
+        of which only the first len(payload) may have been captured.
+        """
+        self._record(False, (ts, seq, flags, window, payload, seg_len),
+                     len(payload))
+        self._add(ts, seq, flags, window, payload, seg_len)
+        self._settle()
+
+    def _add(self, ts: float, seq: int, flags: int, window: int,
+             payload: bytes, seg_len: int) -> None:
+        if window == 0 and not flags & (TCP_SYN | TCP_RST):
+            self._counters(ts)[ZERO_WINDOWS] += 1
+
+        if self.next_pos is None or \
+                (flags & TCP_SYN and self.position(seq) + 1 != self.next_pos):
+            # first segment of the connection as far as we know
+            self.last_seq = self.last_pos = seq
+            self.next_pos = seq
+            self.out_of_order = []
+            self.out_of_order_bytes = 0
+            self.acked_pos = None
+            self.unacked.clear()
+            if flags & TCP_SYN:
+                self.next_pos += 1
+                self._sent(self.next_pos, ts)
+                for parser in self.parsers:
+                    parser.sync(self.next_pos)
+        elif flags & TCP_SYN:
+            self._forget(self.next_pos - 1, self.next_pos)
+
+        pos = self.position(seq)
+        self.last_seq, self.last_pos = seq, pos
+        if flags & TCP_SYN:
+            pos += 1
+        if seg_len == 0:
+            return
+        self.carried_data = True
+
+        counters = self._counters(ts)
+        counters[SEGMENTS] += 1
+        if pos < self.next_pos:
+            # some or all of its bytes were seen before
+            counters[RETRANSMISSIONS] += 1
+            self._forget(pos, pos + seg_len)
+        elif pos > self.next_pos:
+            counters[OUT_OF_ORDER] += 1
+        else:
+            self._sent(pos + seg_len, ts)
+
+        if pos > self.next_pos:
+            if not self.out_of_order:
+                self.hole_since = ts
+            heapq.heappush(self.out_of_order, (pos, ts, payload, seg_len))
+            self.out_of_order_bytes += len(payload)
+            while self.out_of_order and \
+                    (self.out_of_order_bytes > MAX_OUT_OF_ORDER or
+                     ts - self.hole_since > HOLE_TIMEOUT):
+                # the missing bytes were probably dropped by the capture
+                self._skip_hole()
+                self.hole_since = ts
+            return
+
+        self._deliver(pos, ts, payload, seg_len)
+        self._drain()
+
+    def _skip_hole(self) -> None:
+        hole_end, ts = self.out_of_order[0][:2]
+        # never captured, but delivered all the same
+        self._counters(ts)[BYTES] += hole_end - self.next_pos
+        for parser in self.parsers:
+            parser.gap(self.next_pos, hole_end)
+        self.next_pos = hole_end
+        self._drain()
+
+    def flush(self) -> None:
+        # no more segments, pass on what is still waiting for a hole
+        while self.out_of_order:
+            self._skip_hole()
+
+    def _drain(self) -> None:
+        while self.out_of_order and self.out_of_order[0][0] <= self.next_pos:
+            pos, ts, payload, seg_len = heapq.heappop(self.out_of_order)
+            self.out_of_order_bytes -= len(payload)
+            self._deliver(pos, ts, payload, seg_len)
+
+    def _deliver(self, pos: int, ts: float, payload: bytes,
+                 seg_len: int) -> None:
+        end = pos + seg_len
+        if end <= self.next_pos:
+            return  # retransmission
+        self._counters(ts)[BYTES] += end - self.next_pos
+        data = payload[self.next_pos - pos:]
+        pos = self.next_pos
+        if data:
+            for parser in self.parsers:
+                parser.feed(pos, ts, data)
+        if pos + len(data) < end:
+            # truncated by the capture's snapshot length
+            for parser in self.parsers:
+                parser.gap(pos + len(data), end)
+        self.next_pos = end
+
+    def state(self) -> Tuple:
+        """
+        Reassembly state, with stream positions modulo SEQ_MOD for comparison.
+        """
+        return (_mod(self.next_pos), self.last_seq,
+                sorted((_mod(pos), ts, payload, seg_len)
+                       for pos, ts, payload, seg_len in self.out_of_order),
+                self.hole_since if self.out_of_order else None,
+                [(_mod(end), ts) for end, ts in self.unacked],
+                [p.state() for p in self.parsers])
+
+    def _replay(self, head: List[Tuple[bool, tuple]]) -> None:
+        for is_ack, args in head:
+            if is_ack:
+                self.acked(*args)
+            else:
+                self.add(*args)
+
+    def continue_with(self, later: 'FlowReassembler') \
+            -> Tuple['FlowReassembler', bool]:
+        """
+        Replays the unsettled segments of a later range of the connection.
+        Returns the reassembler to continue with and whether both ranges ended
+        up in the same state.
+        """
+        self.recording = False
+        self.head = []
+        self._replay(later.head)
+        if later.recording:
+            # the later range never settled, so it recorded all its segments
+            return self, True
+
+        # the later range as it was when it settled
+        settled = FlowReassembler(later.framings)
+        settled.recording = False
+        settled._replay(later.head)
+        for parser, settled_parser, later_parser in \
+                zip(self.parsers, settled.parsers, later.parsers):
+            later_parser.messages[:len(settled_parser.messages)] = \
+                parser.messages
+        stats = self.stats
+        for second, counters in later.stats.items():
+            before = settled.stats.get(second, [0] * len(NETWORK_COUNTERS))
+            after = [c - b for c, b in zip(counters, before)]
+            if any(after):
+                total = stats.setdefault(second, [0] * len(NETWORK_COUNTERS))
+                for i, value in enumerate(after):
+                    total[i] += value
+        later.stats = stats
+        self.stats = {}
+        if not later.carried_data:
+            # the later range passed no data to its parsers, so they are
+            # still as this reassembler left them
+            later.parsers = settled.parsers = self.parsers
+        later.head = []
+        return later, self.state() == settled.state()
+
+
+def read_pcap_header(buf) -> Tuple[str, float, int]:
+    """
+    Byte order, timestamp fraction unit (in ms) and link type of a classic
+    pcap file. Raises ValueError for other formats, e.g. pcapng.
+    """
+    (magic,) = struct.unpack_from('<I', buf)
+    if magic not in PCAP_MAGIC:
+        raise ValueError('Not a classic pcap file')
+    order, frac_unit = PCAP_MAGIC[magic]
+    linktype = struct.unpack_from(order + 'I', buf, 20)[0] & 0xffff
+    return order, frac_unit, linktype
+
+
+def record_offsets(buf, order: str) -> List[int]:
+    """
+    Offsets of all packet records in a pcap file; only the record headers
+    are read.
+    """
+    header = struct.Struct(order + 'IIII')
+    offsets = []
+    offset = PCAP_HEADER.size
+    size = len(buf)
+    while offset + header.size <= size:
+        offsets.append(offset)
+        offset += header.size + header.unpack_from(buf, offset)[2]
+    return offsets
+
+
+def split_ranges(offsets: List[int], end: int,
+                 n_ranges: int) -> List[Tuple[int, int]]:
+    """
+    Splits a pcap file into at most n_ranges byte ranges of similar size,
+    each starting at a record boundary.
+    """
+    if not offsets:
+        return []
+    start = offsets[0]
+    step = (end - start) / float(n_ranges)
+    bounds = [start]
+    i = 0
+    for k in range(1, n_ranges):
+        target = start + k * step
+        while i < len(offsets) and offsets[i] < target:
+            i += 1
+        if i < len(offsets) and offsets[i] > bounds[-1]:
+            bounds.append(offsets[i])
+    bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def tcp_segments(buf, start: int, end: int, order: str, frac_unit: float,
+                 linktype: int) \
+        -> Iterator[Tuple[float, FlowKey, int, int, int, int, bytes, int]]:
+    """
+    Yields (ts, flow, seq, ack, flags, window, payload, length) of every TCP
+    segment in a byte range of a pcap file.
+    """
+    header = struct.Struct(order + 'IIII')
+    offset = start
+    while offset < end:
+        ts_sec, ts_frac, incl_len, _ = header.unpack_from(buf, offset)
+        offset += header.size
+        pkt = buf[offset:offset + incl_len]
+        offset += incl_len
+
+        if linktype == LINKTYPE_ETHERNET:
+            (ethertype,) = struct.unpack_from('>H', pkt, 12)
+            net = 14
+            if ethertype == ETHERTYPE_VLAN:
+                (ethertype,) = struct.unpack_from('>H', pkt, 16)
+                net = 18
+        elif linktype == LINKTYPE_LINUX_SLL:
+            (ethertype,) = struct.unpack_from('>H', pkt, 14)
+            net = 16
+        elif linktype == LINKTYPE_RAW:
+            ethertype = ETHERTYPE_IPV4 if pkt[0] >> 4 == 4 else ETHERTYPE_IPV6
+            net = 0
+        else:
+            raise ValueError('Unsupported link type {}'.format(linktype))
+
+        if ethertype == ETHERTYPE_IPV4:
+            if pkt[net + 9] != IPPROTO_TCP:
+                continue
+            (ip_len,) = struct.unpack_from('>H', pkt, net + 2)
+            tcp = net + (pkt[net] & 0x0f) * 4
+            ip_end = net + ip_len  # excludes link layer padding
+            src, dst = bytes(pkt[net + 12:net + 16]), \
+                bytes(pkt[net + 16:net + 20])
+        elif ethertype == ETHERTYPE_IPV6:
+            if pkt[net + 6] != IPPROTO_TCP:
+                continue
+            (payload_len,) = struct.unpack_from('>H', pkt, net + 4)
+            tcp = net + 40
+            ip_end = tcp + payload_len
+            src, dst = bytes(pkt[net + 8:net + 24]), \
+                bytes(pkt[net + 24:net + 40])
+        else:
+            continue
+
+        sport, dport, seq, ack, data_offset, flags, window = \
+            struct.unpack_from('>HHIIBBH', pkt, tcp)
+        data = tcp + (data_offset >> 4) * 4
+        ts = ts_sec * 1000.0 + ts_frac * frac_unit
+        yield ts, (src, sport, dst, dport), seq, ack, flags, window, \
+            bytes(pkt[data:ip_end]), max(0, ip_end - data)
+
+
+def _parse_range(args) -> Dict[FlowKey, FlowReassembler]:
+    """
+    Reassembles the TCP flows (only those in keys, if given) in a byte range of
+    a pcap file, without flushing them at its end.
+    """
+    filename, start, end, video_ports, result_ports, keys = args
+    flows = {}
+    with open(filename, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        order, frac_unit, linktype = read_pcap_header(buf)
+        for ts, key, seq, ack, flags, window, payload, seg_len in \
+                tcp_segments(memoryview(buf), start, end, order, frac_unit,
+                             linktype):
+            reverse_key = (key[2], key[3], key[0], key[1])
+            if keys is not None and key not in keys \
+                    and reverse_key not in keys:
+                continue
+            flow = flows.get(key)
+            if flow is None:
+                flow = flows[key] = FlowReassembler(
+                    flow_framings(key, video_ports, result_ports))
+            flow.add(ts, seq, flags, window, payload, seg_len)
+            if flags & TCP_ACK:
+                reverse = flows.get(reverse_key)
+                if reverse is None:
+                    # the ACK belongs to the history of the reverse flow,
+                    # whichever byte range its first segment falls in
+                    reverse = flows[reverse_key] = FlowReassembler(
+                        flow_framings(reverse_key, video_ports, result_ports))
+                reverse.acked(ack, ts)
+    return flows
+
 
 class LEGOTCPdumpParser():
-    pkts = []
+    """
+    Timestamps of the Gabriel video and result messages and network metrics of
+    each flow in a tcpdump capture, parsed in parallel byte ranges. Flows which
+    cannot be stitched across ranges are parsed again sequentially.
+    """
 
-    def __init__(self, pcapf):
-        self.pkts = rdpcap(pcapf)
+    def __init__(self, pcapf, workers: int = 1,
+                 video_ports: Optional[Iterable[int]] = None,
+                 result_ports: Optional[Iterable[int]] = None):
+        with open(pcapf, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            order, _, _ = read_pcap_header(buf)
+            if workers > 1:
+                ranges = split_ranges(record_offsets(buf, order), len(buf),
+                                      workers)
+            else:
+                ranges = [(PCAP_HEADER.size, len(buf))]
 
-    def extract_incoming_timestamps(self, dport: int) -> Dict[int, list]:
-        # pkts = rdpcap(pcapf)
-        processed_frames = dict()
+        if video_ports is not None or result_ports is not None:
+            video_ports = frozenset(video_ports or ())
+            result_ports = frozenset(result_ports or ())
+        tasks = [(pcapf, start, end, video_ports, result_ports, None)
+                 for start, end in ranges]
+        if len(tasks) > 1:
+            with Pool(len(tasks)) as pool:
+                results = pool.map(_parse_range, tasks)
+        else:
+            results = [_parse_range(t) for t in tasks]
 
-        for pkt in self.pkts:
-            if TCP in pkt and Raw in pkt and pkt[TCP].dport == dport:
-                try:
-                    # incoming timestamps are different
-                    # we know the packet header only includes the {frame_id}
-                    # part, so we can directly try to parse it using the info
-                    # provided in payload itself
-
-                    payload = bytes(pkt[TCP].payload)
-
-                    (header_len,) = struct.unpack('>I', payload[:4])
-                    (header,) = struct.unpack(
-                        '>{}s'.format(header_len), payload[4:header_len + 4]
-                    )
-
-                    frame_id_json = json.loads(header.decode('utf-8'))
-                    frame_id = frame_id_json['frame_id']
-                    if frame_id not in processed_frames.keys():
-                        processed_frames[frame_id] = list()
-
-                    # store the time as milliseconds
-                    processed_frames[frame_id].append(pkt.time * 1000.0)
-
-                except UnicodeDecodeError:
-                    LOGGER.warning('Incoming: Could not decode payload.')
-                except JSONDecodeError:
-                    LOGGER.warning('Incoming: Could not decode JSON string.')
-                    LOGGER.warning('Header: %s', header.decode('utf-8'))
-                except struct.error:
-                    continue
-                except Exception as error:
-                    LOGGER.error('Incoming: Unhandled exception!')
-                    LOGGER.error(error)
-                    raise error
+        self.flow_stats = {}  # type: Dict[FlowKey, FlowStats]
+        messages = {}  # type: Dict[FlowKey, List[Tuple[bool, int, list]]]
+        flows = {}  # type: Dict[FlowKey, FlowReassembler]
+        misaligned = set()
+        for range_flows in results:
+            for key, flow in range_flows.items():
+                if key in flows:
+                    flow, aligned = flows[key].continue_with(flow)
+                    if not aligned:
+                        misaligned.add(key)
+                flows[key] = flow
+                self._add_stats(key, flow)
+                self._add_messages(messages, key, flow)
+        for key, flow in flows.items():
+            flow.flush()
+            self._add_stats(key, flow)
+            self._add_messages(messages, key, flow)
 
+        if misaligned:
+            LOGGER.warning('Could not line up %d connections across byte '
+                           'ranges of %s, parsing them again sequentially',
+                           len(misaligned), pcapf)
+            flows = _parse_range((pcapf, ranges[0][0], ranges[-1][1],
+                                  video_ports, result_ports,
+                                  frozenset(misaligned)))
+            for key in misaligned:
+                del self.flow_stats[key]
+                messages.pop(key, None)
+                flow = flows[key]
+                flow.flush()
+                self._add_stats(key, flow)
+                self._add_messages(messages, key, flow)
+
+        self.incoming = {}  # type: PortTable
+        self.outgoing = {}  # type: PortTable
+        for flow_messages in messages.values():
+            for is_video, port, entries in flow_messages:
+                table = self.incoming if is_video else self.outgoing
+                table.setdefault(port, []).extend(entries)
+        # connections to the same port are interleaved in capture order
+        for table in (self.incoming, self.outgoing):
+            for entries in table.values():
+                entries.sort()
+
+    def _add_stats(self, key: FlowKey, flow: FlowReassembler) -> None:
+        stats = self.flow_stats.setdefault(key, {})
+        for second, counters in flow.stats.items():
+            total = stats.setdefault(second, [0] * len(NETWORK_COUNTERS))
+            for i, value in enumerate(counters):
+                total[i] += value
+        flow.stats = {}
+
+    @staticmethod
+    def _add_messages(messages: Dict[FlowKey, list], key: FlowKey,
+                      flow: FlowReassembler) -> None:
+        src, sport, dst, dport = key
+        for parser in flow.parsers:
+            is_video = parser.framing is _video_message
+            messages.setdefault(key, []).append(
+                (is_video, dport if is_video else sport,
+                 [(ts, frame_id) for _, ts, frame_id in parser.messages]))
+            parser.messages = []
+
+    def differences(self, other: 'LEGOTCPdumpParser') -> List[str]:
+        """
+        Tables and flow counters which differ from those of another parse of
+        the same capture, e.g. with a different number of workers.
+        """
+        diffs = []
+        for name in ('incoming', 'outgoing'):
+            ours, theirs = getattr(self, name), getattr(other, name)
+            diffs.extend('{} port {}'.format(name, port)
+                         for port in sorted(set(ours) | set(theirs))
+                         if ours.get(port, []) != theirs.get(port, []))
+        for key in sorted(set(self.flow_stats) | set(other.flow_stats)):
+            if self.flow_stats.get(key, {}) != other.flow_stats.get(key, {}):
+                diffs.append('counters of port {} -> {}'.format(key[1],
+                                                               key[3]))
+        return diffs
+
+    @staticmethod
+    def _by_frame(entries: List[Tuple[float, int]]) -> Dict[int, list]:
+        processed_frames = dict()
+        for ts, frame_id in entries:
+            processed_frames.setdefault(frame_id, []).append(ts)
         return processed_frames
 
+    def extract_incoming_timestamps(self, dport: int) -> Dict[int, list]:
+        return self._by_frame(self.incoming.get(dport, []))
+
     def extract_outgoing_timestamps(self, sport: int) -> Dict[int, list]:
-        # pkts = rdpcap(pcapf)
-        processed_frames = dict()
+        return self._by_frame(self.outgoing.get(sport, []))
 
-        for pkt in self.pkts:
-            if TCP in pkt and Raw in pkt and pkt[TCP].sport == sport:
-                try:
-                    # grab a slice of the payload.
-                    # we skip the first 4 bytes, since that's reserved for the
-                    # length of the message.
-                    # the 80 bytes is a bit arbitrary, but it's just so we can
-                    # be sure we grab enough data to get the "frame_id" part of
-                    # the message
-                    data = bytes(pkt[TCP].payload)[4:80].decode('utf-8')
-                    idx = data.index('"frame_id"')
-                    comma_idx = data.index(',', idx, -1)
-                    frame_id_txt = data[idx:comma_idx]
-                    frame_id_json = json.loads('{' + frame_id_txt + '}')
-
-                    frame_id = frame_id_json['frame_id']
-                    if frame_id not in processed_frames.keys():
-                        processed_frames[frame_id] = list()
-
-                    # store the time as milliseconds
-                    processed_frames[frame_id].append(pkt.time * 1000.0)
-
-                except UnicodeDecodeError:
-                    LOGGER.warning('Outgoing: Could not decode payload.')
-                except JSONDecodeError:
-                    LOGGER.warning('Outgoing: Could not decode JSON string.')
-                except ValueError:
-                    # LOGGER.warning('Outgoing: Could not find the frame
-                    # header string.')
-                    continue
-                except Exception as error:
-                    LOGGER.error('Outgoing: Unhandled exception!')
-                    LOGGER.error(error)
-                    raise error
+    def _network_stats(self, match: Callable[[FlowKey], bool],
+                       columns: List[str]) -> pd.DataFrame:
+        total = {}  # type: FlowStats
+        for key, stats in self.flow_stats.items():
+            if not match(key):
+                continue
+            for second, counters in stats.items():
+                acc = total.setdefault(second, [0] * len(NETWORK_COUNTERS))
+                for i, value in enumerate(counters):
+                    acc[i] += value
+        stats = pd.DataFrame.from_dict(total, orient='index',
+                                       columns=NETWORK_COUNTERS)
+        return stats[columns]
 
-        return processed_frames
+    def client_network_stats(self, video_port: int,
+                             result_port: int) -> pd.DataFrame:
+        """
+        Per second TCP metrics of the video (uplink) and result (downlink)
+        flows of a client, in capture time. RTTs are from the capture point to
+        the client, summed in ms.
+        """
+        data_columns = ['bytes', 'segments', 'retransmissions', 'out_of_order']
+        rtt_columns = ['rtt_samples', 'rtt_sum']
+        uplink = pd.concat([
+            self._network_stats(lambda k: k[3] == video_port, data_columns),
+            self._network_stats(lambda k: k[1] == video_port,
+                                ['zero_windows'] + rtt_columns)], axis=1)
+        downlink = pd.concat([
+            self._network_stats(lambda k: k[1] == result_port,
+                                data_columns + rtt_columns),
+            self._network_stats(lambda k: k[3] == result_port,
+                                ['zero_windows'])], axis=1)
+
+        results = []
+        for direction, stats in (('uplink', uplink), ('downlink', downlink)):
+            stats = stats.fillna(0).sort_index()
+            stats['rtt_sum'] /= 1000.0  # in ms
+            stats.insert(0, 'direction', direction)
+            stats.insert(0, 'time', stats.index * 1000.0)
+            results.append(stats[['time', 'direction']
+                                 + list(NETWORK_COUNTERS)])
+        return pd.concat(results, ignore_index=True)
 
 
 if __name__ == '__main__':
@@ -15,14 +15,23 @@
 """
 
 import json
+import math
 import os
-from typing import Dict, List, Tuple
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 from matplotlib import pylab, gridspec
+from matplotlib.colors import LogNorm
+from scipy import stats
 
-from util import *
+from dist_fit import best_fits, frozen
+from histograms import density, load_histograms, rebin
+from query import Experiments, collect_all, collect_metrics
+from timeseries import DEFAULT_POINTS, frame_raster, system_timeline
+from util import CONFIDENCE, SAMPLE_FACTOR, load_run_data, load_system_data
 
 # n_runs = 25
 
@@ -75,28 +84,14 @@ def autolabel(ax: plt.Axes, rects: List[plt.Rectangle],
 
 
 def plot_box_fb_vs_nfb(experiments: Dict) -> None:
-    root_dir = os.getcwd()
-    ticks = []
-    rtts_feedback = []
-    rtts_nofeedback = []
-
-    for exp_name, exp_dir in experiments.items():
-        os.chdir(root_dir + '/' + exp_dir)
-        data = pd.read_csv('total_frame_stats.csv')
-        run_data = pd.read_csv('total_run_stats.csv')
-        os.chdir(root_dir)
-
-        data = filter_runs(data, run_data)
-        data_fb = calculate_derived_metrics(data, feedback=True)
-        data_nofb = calculate_derived_metrics(data, feedback=False)
-
-        rtt_fb = data_fb['client_recv'] - data_fb['client_send']
-        rtt_nofb = data_nofb['client_recv'] - data_nofb['client_send']
+    ticks = list(experiments.keys())
+    query = Experiments(experiments).select().where(success=True) \
+        .metric('rtt').groupby('experiment')
+    data_fb, data_nofb = collect_all(query.where(feedback=True),
+                                     query.where(feedback=False))
 
-        rtts_feedback.append(rtt_fb)
-        rtts_nofeedback.append(rtt_nofb)
-
-        ticks.append(exp_name)
+    rtts_feedback = [d['rtt'] for d in data_fb.values()]
+    rtts_nofeedback = [d['rtt'] for d in data_nofb.values()]
 
     fig, ax = plt.subplots()
     num_exps = len(ticks)
@@ -159,24 +154,14 @@ def plot_box_fb_vs_nfb(experiments: Dict) -> None:
 
 
 def plot_time_taskstep(experiment: str) -> None:
-    # get all frame data
-    root_dir = os.getcwd()
-    os.chdir(root_dir + '/' + experiment)
-    data = pd.read_csv('total_frame_stats.csv')
-    run_data = pd.read_csv('total_run_stats.csv')
-    os.chdir(root_dir)
-
-    data = calculate_derived_metrics(data, True)
-    data = filter_runs(data, run_data)
+    # get all frame data, separated into steps
+    data = Experiments({experiment: experiment}).select() \
+        .where(feedback=True, success=True) \
+        .metric('rtt').groupby('state_index').collect()
 
-    # separate into steps
-    states = list(range(-1, data['state_index'].max() + 1, 1))
-
-    rtts = [[p + u + d for p, u, d in zip(
-        data.loc[data['state_index'] == state]['processing'],
-        data.loc[data['state_index'] == state]['uplink'],
-        data.loc[data['state_index'] == state]['downlink']
-    )] for state in states]
+    states = list(range(-1, max(data.keys()) + 1, 1))
+    rtts = [data[state]['rtt'] if state in data else []
+            for state in states]
 
     # fig, (ax_top, ax_bot) = plt.subplots(2, 1, sharex=True)
     fig = plt.figure()
@@ -260,27 +245,14 @@ def plot_time_taskstep(experiment: str) -> None:
 
 
 def plot_time_box(experiments: Dict, feedback: bool) -> None:
-    root_dir = os.getcwd()
-    # results = {}
-    ticks = []
-    processing_times = []
-    uplink_times = []
-    downlink_times = []
+    results = collect_metrics(experiments,
+                              ['processing', 'uplink', 'downlink'],
+                              feedback=feedback)
 
-    for exp_name, exp_dir in experiments.items():
-        os.chdir(root_dir + '/' + exp_dir)
-        data = pd.read_csv('total_frame_stats.csv')
-        run_data = pd.read_csv('total_run_stats.csv')
-        os.chdir(root_dir)
-
-        data = calculate_derived_metrics(data, feedback)
-        data = filter_runs(data, run_data)
-
-        # results[exp_name] = data
-        ticks.append(exp_name)
-        processing_times.append(data['processing'])
-        uplink_times.append(data['uplink'])
-        downlink_times.append(data['downlink'])
+    ticks = list(results.keys())
+    processing_times = [d['processing'] for d in results.values()]
+    uplink_times = [d['uplink'] for d in results.values()]
+    downlink_times = [d['downlink'] for d in results.values()]
 
     fig, ax = plt.subplots()
     num_exps = len(ticks)
@@ -354,19 +326,9 @@ def plot_time_box(experiments: Dict, feedback: bool) -> None:
 
 
 def plot_time_dist(experiments: Dict, feedback: bool) -> None:
-    root_dir = os.getcwd()
-    results = {}
-
-    for exp_name, exp_dir in experiments.items():
-        os.chdir(root_dir + '/' + exp_dir)
-        data = pd.read_csv('total_frame_stats.csv')
-        run_data = pd.read_csv('total_run_stats.csv')
-        os.chdir(root_dir)
-
-        data = calculate_derived_metrics(data, feedback)
-        data = filter_runs(data, run_data)
-
-        results[exp_name] = data
+    # both cached, only recomputed when the underlying data changes
+    results = load_histograms(experiments, 'processing', feedback)
+    fits = best_fits(experiments, 'processing', feedback)
 
     # bin_min = min(map(
     #     operator.methodcaller('min'),
@@ -398,24 +360,30 @@ def plot_time_dist(experiments: Dict, feedback: bool) -> None:
 
     hists = []
     pdfs = []
-    for exp_name, data in results.items():
-        hists.append(ax.hist(data['processing'], bins,
+    for exp_name, (fine_edges, fine_counts) in results.items():
+        # precomputed fine histograms, rebinned to the plot bins
+        counts = rebin(fine_edges, fine_counts, bins)
+        centers = np.sqrt(bins[:-1] * bins[1:])
+        hists.append(ax.hist(centers, bins,
+                             weights=density(bins, counts),
                              label=exp_name,
-                             # norm_hist=True
-                             alpha=0.5,
-                             density=True)[-1])
+                             alpha=0.5)[-1])
 
-        shape, loc, scale = stats.lognorm.fit(data['processing'])
-        pdf = stats.lognorm.pdf(bins, shape, loc, scale)
+        fit = fits.get(exp_name)
+        if fit is None:
+            # no plausible fit, e.g. no frames
+            continue
+        pdf = frozen(fit).pdf(bins)
         pdfs.append(*ax.plot(bins, pdf,
-                             label=exp_name + ' lognorm PDF'))
+                             label='{} {} PDF'.format(exp_name,
+                                                      fit.distribution)))
 
     if SEPARATE_LEGEND:
         figlegend = pylab.figure(figsize=(3, 1))
         plots = (*(h[0] for h in hists), *pdfs)
         labels = (
             *(exp_name for exp_name, _ in results.items()),
-            *(exp_name + ' PDF' for exp_name, _ in results.items())
+            *(exp_name + ' PDF' for exp_name in results if exp_name in fits)
         )
         figlegend.legend(plots,
                          labels,
@@ -639,6 +607,80 @@ def plot_cpu_loads(experiments: Dict) -> None:
     plt.show()
 
 
+def plot_cpu_timelines(experiments: Dict,
+                       points: int = DEFAULT_POINTS) -> None:
+    """
+    Median CPU load across runs over time, with the min-max range shaded.
+    """
+    fig, ax = plt.subplots()
+    for i, (exp_name, exp_dir) in enumerate(experiments.items()):
+        timeline = system_timeline(exp_dir, 'cpu_load', points)
+        ax.fill_between(timeline['time'], timeline['min'], timeline['max'],
+                        color='C{}'.format(i), alpha=0.3, linewidth=0)
+        ax.plot(timeline['time'], timeline['median'], color='C{}'.format(i),
+                label=exp_name)
+
+    ax.set_xlabel('Time since run start [s]')
+    ax.set_ylabel('Load [%]')
+    ax.set_ylim(0, 100)
+    ax.legend(loc='upper left', ncol=2)
+    ax.grid(True, which='major', axis='y', linestyle='--', alpha=0.8)
+
+    fig.set_size_inches(*PLOT_DIM)
+    fig.savefig('cpu_load_timeline.pdf', bbox_inches='tight')
+    plt.show()
+
+
+def plot_frame_timelines(experiments: Dict, view: str = 'latency',
+                         facet: Optional[str] = None,
+                         metric: str = 'rtt') -> None:
+    """
+    Frame rasters per experiment (rows) and facet (columns), on a shared log
+    color scale.
+    """
+    rasters = OrderedDict((exp_name, frame_raster(exp_dir, view, metric,
+                                                  facet))
+                          for exp_name, exp_dir in experiments.items())
+    columns = sorted({k for r in rasters.values() for k in r},
+                     key=lambda k: (k is None, k))
+    images = [r.image for exp in rasters.values() for r in exp.values()]
+    norm = LogNorm(vmin=min(np.nanmin(i[i > 0]) for i in images),
+                   vmax=max(np.nanmax(i) for i in images))
+
+    fig, axes = plt.subplots(len(rasters), len(columns), sharex=True,
+                             sharey=True, squeeze=False)
+    mappable = None
+    for row, (exp_name, exp_rasters) in enumerate(rasters.items()):
+        for col, key in enumerate(columns):
+            ax = axes[row][col]
+            if row == 0 and facet is not None:
+                ax.set_title('{} {}'.format(facet.capitalize(), key))
+            if col == 0:
+                ax.set_ylabel(exp_name)
+            raster = exp_rasters.get(key)
+            if raster is None:
+                continue
+            mappable = ax.imshow(
+                np.ma.masked_less_equal(raster.image, 0), norm=norm,
+                origin='lower', aspect='auto', interpolation='nearest',
+                extent=(raster.x_edges[0], raster.x_edges[-1],
+                        raster.y_edges[0], raster.y_edges[-1]))
+
+    for ax in axes[-1]:
+        ax.set_xlabel('Time since run start [s]')
+    fig.text(0.0, 0.5, 'Run' if view == 'runs'
+             else 'Latency ({}) [ms]'.format(metric),
+             rotation='vertical', va='center', ha='right')
+    fig.colorbar(mappable, ax=axes.ravel().tolist(),
+                 label='Mean {} [ms]'.format(metric) if view == 'runs'
+                 else 'Frames')
+
+    fig.set_size_inches(PLOT_DIM[0] * max(len(columns) / 2.0, 1.0),
+                        PLOT_DIM[1] * max(len(rasters) / 2.0, 1.0))
+    fig.savefig('frame_timeline_{}.pdf'.format(view), bbox_inches='tight')
+    plt.show()
+
+
 def plot_ram_usage(experiments: Dict) -> None:
     system_data_samples = []
     for exp_name, exp_dir in experiments.items():
@@ -706,6 +748,31 @@ def plot_ram_usage(experiments: Dict) -> None:
     plt.show()
 
 
+def plot_summary(table: pd.DataFrame, stat: str, filename: str) -> None:
+    """
+    Stacked uplink, processing and downlink times of every experiment in a
+    summary table, see experiment_index.summary_table().
+    """
+    fig, ax = plt.subplots()
+    x = np.arange(table.shape[0])
+    bottom = np.zeros(table.shape[0])
+    for metric, label in (('uplink', 'Uplink'),
+                          ('processing', 'Processing'),
+                          ('downlink', 'Downlink')):
+        values = table['{}_{}'.format(metric, stat)].fillna(0).values
+        ax.bar(x, values, bottom=bottom, label=label)
+        bottom += values
+
+    ax.set_xticks(x)
+    ax.set_xticklabels(table['experiment'], rotation=90)
+    ax.set_ylabel('Time [ms] ({})'.format(stat))
+    ax.legend(loc='upper left')
+
+    fig.set_size_inches(*PLOT_DIM)
+    fig.savefig(filename, bbox_inches='tight')
+    plt.close(fig)
+
+
 def load_data_for_experiment(experiment_id) -> Dict:
     os.chdir(experiment_id)
     with open('total_stats.json', 'r') as f:
@@ -714,17 +781,12 @@ def load_data_for_experiment(experiment_id) -> Dict:
 
 
 def load_system_data_for_experiment(experiment_id) -> pd.DataFrame:
-    os.chdir(experiment_id)
-    df = pd.read_csv('total_system_stats.csv')
-    os.chdir('..')
-    return df
+    return load_system_data(experiment_id)
 
 
 def print_successful_runs(experiments):
     for exp_name, exp_id in experiments.items():
-        os.chdir(exp_id)
-        df = pd.read_csv('total_run_stats.csv')
-        os.chdir('..')
+        df = load_run_data(exp_id)
 
         print(exp_name)
         n_clients = df['client_id'].max() + 1
@@ -781,4 +843,5 @@ if __name__ == '__main__':
         # plot_time_dist(experiments, feedback=False)
 
         # plot_cpu_loads(experiments)
+        # plot_frame_timelines(experiments, view='runs', facet='client')
         # plot_ram_usage(experiments)
@@ -16,42 +16,88 @@
 """
 
 
+import itertools
 import json
+import os
+import sys
+import time
 from multiprocessing.pool import Pool
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 
 import click
 import pandas as pd
-from scapy.all import *
 
+from archive import ARCHIVE_FILE, archive_experiment, load_client_stats, \
+    load_server_stats, load_system_stats, open_archive, \
+    remove_archived_files, unarchive_experiment, verify_archive
+from clock_sync import align_clocks, estimate_clock_offsets
+from data_quality import quality_report, stream_quality_report
+from experiment_index import load_index, summary_table, update_index
+from histograms import compute_histograms
 from lego_timing import LEGOTCPdumpParser
-from util import sample_frame_stats
+from util import aggregate_frame_stats, frame_partition_files, \
+    ingest_summaries, iter_frame_partitions, iter_raw_frame_partitions, \
+    load_clock_offsets, load_experiment_config, load_frame_summaries, \
+    load_partition_index, network_partition_files, round_floats, \
+    select_summaries, summary_stats, task_efficiency_stats, \
+    update_partition_index, valid_runs, write_clock_offsets, \
+    write_frame_partition, write_frame_summaries, write_network_partition, \
+    write_partition_index
 
 from concurrent_logging import LOGGER
 
 START_WINDOW = 10.0
 
-
-def load_results(client_idx) -> Dict:
-    filename = '{:02}_stats.json'.format(client_idx)
-    with open(filename, 'r') as f:
-        return json.load(f, encoding='utf-8')
-
-
-def parse_all_clients_for_run(run_idx, num_clients, use_tcpdump=True) -> \
-        pd.DataFrame:
-    os.chdir('run_{}'.format(run_idx + 1))
+QUALITY_REPORT = 'quality_report.csv'
+
+RUN_STATS_DTYPES = {
+    'client_id'      : int,
+    'run_id'         : int,
+    'start'          : float,
+    'end'            : float,
+    'success'        : bool,
+    'n_frames'       : int,
+    'ntp_offset'     : float,
+    'timestamp_error': float
+}
+
+
+def load_results(run_idx, client_idx) -> Dict:
+    return load_client_stats(run_idx, client_idx)
+
+
+def load_pcap_parser(run_idx, num_clients, pcap_workers=1) \
+        -> LEGOTCPdumpParser:
+    """
+    Parses the tcpdump capture of a run, looking for video messages on the
+    video ports of its clients and for results on their result ports.
+    """
+    ports = [load_results(run_idx, c)['ports'] for c in range(num_clients)]
+    return LEGOTCPdumpParser(
+        os.path.join('run_{}'.format(run_idx + 1), 'tcp.pcap'),
+        workers=pcap_workers,
+        video_ports=[p['video'] for p in ports],
+        result_ports=[p['result'] for p in ports])
+
+
+def parse_all_clients_for_run(run_idx, num_clients, use_tcpdump=True,
+                              by_client=False,
+                              pcap_workers=1) \
+        -> Tuple[List[Dict], Dict[bool, pd.DataFrame], pd.DataFrame,
+                 pd.DataFrame]:
+    """
+    Writes the frames of a run to its partitions. Returns their index entries,
+    frame summaries, clock offsets and quality report.
+    """
     LOGGER.info('Processing %d clients for run %d',
                 num_clients, run_idx + 1)
 
     if use_tcpdump:
-        parser = LEGOTCPdumpParser('tcp.pcap')
+        parser = load_pcap_parser(run_idx, num_clients, pcap_workers)
     else:
         parser = None
-    with open('server_stats.json', 'r') as f:
-        server_stats = json.load(f)
+    server_stats = load_server_stats(run_idx)
 
-    # client_ntp_offset = data['run_results']['ntp_offset']
     server_ntp_offset = server_stats['server_offset']
     run_start = server_stats['run_start']
     run_end = server_stats['run_end']
@@ -61,10 +107,10 @@ def parse_all_clients_for_run(run_idx, num_clients, use_tcpdump=True) -> \
 
     print('Window for run ' + str(run_idx + 1), start_cutoff, end_cutoff)
 
-    # with Pool(3) as pool:
-    client_dfs = list(itertools.starmap(
+    results = list(itertools.starmap(
         _parse_client_stats_for_run,
         zip(
+            itertools.repeat(run_idx),
             range(num_clients),
             itertools.repeat(parser),
             itertools.repeat(server_ntp_offset),
@@ -74,33 +120,42 @@ def parse_all_clients_for_run(run_idx, num_clients, use_tcpdump=True) -> \
         )
     ))
 
+    client_dfs = [cdf for cdf, _ in results]
     for cdf in client_dfs:
         cdf['run_id'] = run_idx
 
     df = pd.concat(client_dfs, ignore_index=True)
     df = df.astype(dtype={'run_id': int})
-    os.chdir('..')
-    return df
 
-    # for i in range(num_clients):
-    #     client_df = _parse_client_stats_for_run(i, parser, server_ntp_offset,
-    #                                             start_cutoff, end_cutoff)
-    #     client_df['run_id'] = run_idx
-    #
-    #     if df.empty:
-    #         df = client_df
-    #     else:
-    #         df = pd.concat([df, client_df], ignore_index=True)
-    #
-    # os.chdir('..')
-    # return df
-
-
-def _parse_client_stats_for_run(client_idx, parser, server_offset,
-                                start_cutoff, end_cutoff, use_tcpdump=True):
-    data = load_results(client_idx)
-
-    # print('Parsing stats for client {}'.format(client_idx))
+    if use_tcpdump:
+        network = pd.concat([n for _, n in results], ignore_index=True)
+        network.insert(0, 'run_id', run_idx)
+        write_network_partition(network, run_idx)
+
+    # clocks are fitted per (run, client), so each run is aligned on its own
+    status = pd.DataFrame([get_run_status(c, run_idx)
+                           for c in range(num_clients)])
+    fits = estimate_clock_offsets(df, status)
+    aligned = align_clocks(df, fits)
+
+    # RTT outliers are relative to the frames of the run
+    report = quality_report(aligned, status)
+    flagged = report.loc[report['flagged'], 'client_id']
+    if not flagged.empty:
+        LOGGER.warning('Run %d: clients %s flagged by quality checks',
+                       run_idx + 1, ', '.join(map(str, flagged)))
+
+    # each worker writes its own partitions, frames never go through the
+    # parent process; only their summaries do
+    return (write_frame_partition(df, run_idx, by_client=by_client),
+            ingest_summaries(aligned), fits, report)
+
+
+def _parse_client_stats_for_run(run_idx, client_idx, parser, server_offset,
+                                start_cutoff, end_cutoff, use_tcpdump=True) \
+        -> Tuple[pd.DataFrame, Optional[pd.DataFrame]]:
+    data = load_results(run_idx, client_idx)
+
     LOGGER.info('Parsing stats for client %d', client_idx)
 
     video_port = data['ports']['video']
@@ -120,9 +175,14 @@ def _parse_client_stats_for_run(client_idx, parser, server_offset,
     if use_tcpdump:
         server_in = parser.extract_incoming_timestamps(video_port)
         server_out = parser.extract_outgoing_timestamps(result_port)
+        # same clock as the server timestamps of the frames
+        network = parser.client_network_stats(video_port, result_port)
+        network['time'] += server_offset
+        network.insert(0, 'client_id', client_idx)
     else:
         server_in = None
         server_out = None
+        network = None
 
     for frame in data['run_results']['frames']:
         frame_id = frame['frame_id']
@@ -130,9 +190,6 @@ def _parse_client_stats_for_run(client_idx, parser, server_offset,
         feedback = frame['feedback']
         client_recv = frame['recv']
 
-        #if client_send < start_cutoff or client_recv > end_cutoff:
-        #    continue
-
         if use_tcpdump and server_in and server_out:
             try:
                 not_found = None
@@ -174,25 +231,18 @@ def _parse_client_stats_for_run(client_idx, parser, server_offset,
         except KeyError:
             n_data['state_index'].append(-1)
 
-        # raise e
-
     df = pd.DataFrame.from_dict(n_data)
     df = df.astype(dtype={'feedback' : bool,
                           'client_id': int,
                           'frame_id' : int})
-    return df
+    return df, network
 
 
 def load_system_stats_for_run(run_idx):
-    os.chdir('run_{}'.format(run_idx + 1))
-
-    # print('Processing system stats for run {}'.format(run_idx))
     LOGGER.info('Processing system stats for run %d', run_idx + 1)
 
-    df = pd.read_csv('system_stats.csv')
-
-    with open('server_stats.json', 'r') as f:
-        server_stats = json.load(f)
+    df = load_system_stats(run_idx)
+    server_stats = load_server_stats(run_idx)
 
     run_start = server_stats['run_start']
     run_end = server_stats['run_end']
@@ -203,31 +253,25 @@ def load_system_stats_for_run(run_idx):
     df['run'] = run_idx
     df = df.loc[df['timestamp'] > start_cutoff]
     df = df.loc[df['timestamp'] < end_cutoff]
-    # df['run_start_cutoff'] = start_cutoff
-    # df['run_end_cutoff'] = end_cutoff
-
-    os.chdir('..')
 
     return df
 
 
 def get_run_status(client_id, run_id):
-    os.chdir('run_{}'.format(run_id + 1))
-    # print('Loading run results for client {}, run {}'.format(client_id,
-    # run_id))
-
     LOGGER.info('Loading run results for client %d, run %d',
                 client_id, run_id + 1)
-    data = load_results(client_id)
+    data = load_results(run_id, client_id)
 
     status = dict(
         client_id=client_id,
         run_id=run_id,
         start=data['run_results']['init'],
         end=data['run_results']['end'],
-        success=data['run_results']['success']
+        success=data['run_results']['success'],
+        n_frames=len(data['run_results']['frames']),
+        ntp_offset=data['run_results'].get('ntp_offset', 0.0),
+        timestamp_error=data['run_results'].get('timestamp_error', 0.0)
     )
-    os.chdir('..')
     return status
 
 
@@ -238,24 +282,35 @@ def cli():
 
 def __sample_data(experiment_id):
     os.chdir(experiment_id)
-    frame_data = pd.read_csv('total_frame_stats.csv')
     run_data = pd.read_csv('total_run_stats.csv')
+    summaries = load_frame_summaries()
+    if summaries is not None:
+        # accumulated while the frames were ingested
+        results = {}
+        for fb, fb_summaries in summaries.items():
+            print('Feedback:', fb)
+            results[fb] = summary_stats(
+                [select_summaries(fb_summaries, run_data)])
+    else:
+        # partitions without valid runs are skipped without reading them
+        partitions = iter_frame_partitions(run_data=run_data,
+                                           keys=valid_runs(run_data))
+        results = aggregate_frame_stats(partitions, run_data)
+    __write_sampled_stats(results)
+    os.chdir('..')
 
-    sampl_feedback = sample_frame_stats(frame_data, run_data, feedback=True)
-    sampl_nofeedback = sample_frame_stats(frame_data, run_data, feedback=False)
 
+def __write_sampled_stats(results):
     sampl_feedback = {k: v._asdict()
-                      for k, v in sampl_feedback._asdict().items()}
+                      for k, v in results[True]._asdict().items()}
     sampl_nofeedback = {k: v._asdict()
-                        for k, v in sampl_nofeedback._asdict().items()}
+                        for k, v in results[False]._asdict().items()}
 
     with open('sampled_time_stats_feedback.json', 'w') as f:
-        json.dump(sampl_feedback, f)
+        json.dump(round_floats(sampl_feedback), f)
 
     with open('sampled_time_stats_nofeedback.json', 'w') as f:
-        json.dump(sampl_nofeedback, f)
-
-    os.chdir('..')
+        json.dump(round_floats(sampl_nofeedback), f)
 
 
 @cli.command()
@@ -277,17 +332,13 @@ def __prepare_task_stats(experiment_id, n_clients, n_runs):
         data = pool.starmap(get_run_status, combinations)
 
     df = pd.DataFrame(data)
-    df = df.astype(
-        dtype={
-            'client_id': int,
-            'run_id'   : int,
-            'start'    : float,
-            'end'      : float,
-            'success'  : bool
-        }
-    )
+    df = df.astype(dtype=RUN_STATS_DTYPES)
+    if os.path.exists(QUALITY_REPORT):
+        # checked as the frames were ingested
+        df = __flag_runs(df, pd.read_csv(QUALITY_REPORT, index_col=0))
 
     df.to_csv('total_run_stats.csv')
+    update_partition_index(run_data=df)
     os.chdir('..')
 
 
@@ -300,23 +351,389 @@ def prepare_task_stats(experiment_id, n_clients, n_runs):
     __prepare_task_stats(experiment_id, n_clients, n_runs)
 
 
+def __flag_runs(run_data, report):
+    # flagged runs are then excluded by valid_runs
+    run_data = run_data.drop(columns='flagged', errors='ignore').merge(
+        report[['run_id', 'client_id', 'flagged']],
+        on=['run_id', 'client_id'], how='left')
+    run_data['flagged'] = run_data['flagged'].fillna(True).astype(bool)
+    return run_data
+
+
+def __write_quality_report(report):
+    report.to_csv(QUALITY_REPORT)
+    LOGGER.info('%d out of %d client runs flagged by quality checks',
+                report['flagged'].sum(), report.shape[0])
+
+
+def __check_quality(experiment_id):
+    os.chdir(experiment_id)
+    run_data = pd.read_csv('total_run_stats.csv', index_col=0)
+    report = stream_quality_report('.', run_data)
+    __write_quality_report(report)
+
+    run_data = __flag_runs(run_data, report)
+    run_data.to_csv('total_run_stats.csv')
+    update_partition_index(run_data=run_data)
+    os.chdir('..')
+
+
+@cli.command()
+@click.argument('experiment_id',
+                type=click.Path(dir_okay=True, file_okay=False, exists=True))
+def check_quality(experiment_id):
+    __check_quality(experiment_id)
+
+
+def __align_clocks(experiment_id):
+    os.chdir(experiment_id)
+    run_data = pd.read_csv('total_run_stats.csv', index_col=0)
+
+    # clocks are fitted per (run, client), so runs can be fitted one at a
+    # time, from the timestamps as measured. Partitions are never modified,
+    # the offsets are removed as they are loaded.
+    fits = write_clock_offsets(
+        estimate_clock_offsets(frame_data, run_data)
+        for frame_data in iter_raw_frame_partitions())
+    __log_clock_offsets(fits)
+    os.chdir('..')
+
+
+def __log_clock_offsets(fits):
+    LOGGER.info('Clock offsets: median %f ms, max %f ms; drift residual '
+                'error: mean %f ms; non-causal frames after alignment: '
+                '%.2f%%; frames left out for non-positive times: %d',
+                fits['offset'].median(), fits['offset'].abs().max(),
+                fits['residual_std'].mean(),
+                100.0 * (fits['noncausal'] * fits['frames']).sum()
+                / fits['frames'].sum(), fits['dropped'].sum())
+
+
+@cli.command()
+@click.argument('experiment_id',
+                type=click.Path(dir_okay=True, file_okay=False, exists=True))
+def align_experiment_clocks(experiment_id):
+    __align_clocks(experiment_id)
+
+
+@cli.command()
+@click.argument('experiment_ids', nargs=-1, required=True,
+                type=click.Path(dir_okay=True, file_okay=False, exists=True))
+@click.option('--processes', type=int, default=6,
+              help='Number of parallel fitting processes.')
+def fit_distributions(experiment_ids, processes):
+    from dist_fit import fit_experiments
+
+    experiments = {exp: exp for exp in experiment_ids}
+    fits = fit_experiments(experiments,
+                           metrics=('processing', 'uplink', 'downlink'),
+                           processes=processes)
+    for exp, exp_fits in fits.items():
+        for (feedback, metric), results in sorted(exp_fits.items()):
+            if not results:
+                print('{} feedback={} {}: no plausible fit'.format(
+                    exp, feedback, metric))
+                continue
+            best = results[0]
+            print('{} feedback={} {}: {} (AIC {:.2f}, KS {:.4f})'.format(
+                exp, feedback, metric, best.distribution, best.aic,
+                best.ks_stat))
+
+
+@cli.command()
+@click.argument('experiment_ids', nargs=-1, required=True,
+                type=click.Path(dir_okay=True, file_okay=False, exists=True))
+def precompute_histograms(experiment_ids):
+    compute_histograms({exp: exp for exp in experiment_ids})
+
+
+@cli.command()
+@click.argument('experiment_ids', nargs=-1, required=True,
+                type=click.Path(dir_okay=True, file_okay=False, exists=True))
+@click.option('--feedback', type=bool, default=None,
+              help='Only compare frames with (or without) feedback.')
+@click.option('--permutations', type=int, default=10000,
+              help='Number of permutations for the permutation test, 0 to '
+                   'skip it.')
+@click.option('--processes', type=int, default=6,
+              help='Number of parallel permutation processes.')
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help='Also write the comparison table to this CSV file.')
+def compare(experiment_ids, feedback, permutations, processes, output):
+    """
+    Compares the latency components of each experiment against the first
+    one given.
+    """
+    if len(experiment_ids) < 2:
+        raise click.UsageError('At least two experiments are needed.')
+    # scipy is slow to import and only needed here and for fits
+    from compare import COMPARE_METRICS, compare_experiments
+
+    table = compare_experiments({exp: exp for exp in experiment_ids},
+                                COMPARE_METRICS, feedback, permutations,
+                                processes)
+    with pd.option_context('display.width', None,
+                           'display.max_columns', None):
+        print(table.to_string(index=False, float_format='{:.4g}'.format))
+    if output:
+        table.to_csv(output, index=False)
+
+
+@cli.command()
+@click.argument('experiment_ids', nargs=-1,
+                type=click.Path(dir_okay=True, file_okay=False, exists=True))
+@click.option('--force', is_flag=True, default=False,
+              help='Summarize experiments even if their inputs are unchanged.')
+def index_experiments(experiment_ids, force):
+    """
+    Updates the experiments index in the current directory, by default with
+    all experiments found there.
+    """
+    update_index(experiment_ids or None, force=force)
+
+
+@cli.command()
+@click.option('--feedback', type=bool, default=False,
+              help='Summarize frames with (or without) feedback.')
+@click.option('--stat', type=click.Choice(['mean', 'p50', 'p75', 'p90',
+                                           'p95', 'p99']),
+              default='mean', help='Latency statistic to show.')
+@click.option('--plot', type=click.Path(dir_okay=False), default=None,
+              help='Also plot the latencies to this file.')
+def summary(feedback, stat, plot):
+    """
+    Prints a summary of all indexed experiments.
+    """
+    index = load_index()
+    if not index:
+        raise click.UsageError('No experiments index, run index_experiments '
+                               'first.')
+    table = summary_table(index, feedback, stat=stat)
+    with pd.option_context('display.width', None,
+                           'display.max_columns', None):
+        print(table.to_string(index=False, float_format='{:.4g}'.format))
+
+    if plot:
+        # matplotlib is only needed here
+        from plot_results import plot_summary
+        plot_summary(table, stat, plot)
+
+
+def _run_ready(run_idx, n_clients, use_tcpdump) -> bool:
+    """
+    Whether all files of a run have been written, i.e. exist and, for JSON
+    files, can be parsed.
+    """
+    run_dir = 'run_{}'.format(run_idx + 1)
+    archive = open_archive()
+    if archive is not None and run_idx + 1 in archive.runs:
+        return not use_tcpdump or \
+            os.path.exists(os.path.join(run_dir, 'tcp.pcap'))
+
+    json_files = ['server_stats.json'] + \
+                 ['{:02}_stats.json'.format(c) for c in range(n_clients)]
+    other_files = ['system_stats.csv'] + (['tcp.pcap'] if use_tcpdump else [])
+    for filename in json_files + other_files:
+        if not os.path.exists(os.path.join(run_dir, filename)):
+            return False
+    for filename in json_files:
+        try:
+            with open(os.path.join(run_dir, filename), 'r') as f:
+                json.load(f)
+        except ValueError:
+            # still being written
+            return False
+    return True
+
+
+def __watch(experiment_id, interval, use_tcpdump, by_client,
+            pcap_workers=1):
+    os.chdir(experiment_id)
+    config = load_experiment_config()
+    n_clients, n_runs = config['clients'], config['runs']
+
+    # resume from the runs ingested before, if any
+    index = load_partition_index()
+    try:
+        run_data = pd.read_csv('total_run_stats.csv', index_col=0)
+    except FileNotFoundError:
+        run_data = pd.DataFrame(columns=list(RUN_STATS_DTYPES))
+    done = set(run_data['run_id'])
+    if index is not None:
+        done &= set(index['run_id'])
+        index = index.loc[index['run_id'].isin(done)]
+        entries = index.drop(columns='success').to_dict('records')
+    else:
+        done = set()
+        entries = []
+    run_data = run_data.loc[run_data['run_id'].isin(done)]
+    try:
+        n_system_rows = 0 if not done else \
+            sum(1 for _ in open('total_system_stats.csv')) - 1
+    except FileNotFoundError:
+        n_system_rows = 0
+
+    # summaries of all ingested runs, valid or not, as stored; those of
+    # runs ingested before summaries were stored are recomputed once
+    run_summaries = []
+    run_fits = []
+    reports = []
+    if done:
+        stored_fits = load_clock_offsets()
+        if stored_fits is not None:
+            stored_fits = stored_fits.reset_index()
+            run_fits.append(stored_fits.loc[stored_fits['run_id'].isin(done)])
+        if os.path.exists(QUALITY_REPORT):
+            report = pd.read_csv(QUALITY_REPORT, index_col=0)
+            reports.append(report.loc[report['run_id'].isin(done)])
+        stored = load_frame_summaries()
+        if stored is not None:
+            run_summaries.append(
+                {fb: s.loc[s.index.get_level_values('run_id').isin(done)]
+                 for fb, s in stored.items()})
+        else:
+            run_summaries.extend(
+                ingest_summaries(partition) for partition in
+                iter_frame_partitions(run_data=run_data, keys=run_data))
+    LOGGER.info('Watching %s, %d out of %d runs already processed',
+                experiment_id, len(done), n_runs)
+
+    while len(done) < n_runs:
+        ready = [r for r in range(n_runs)
+                 if r not in done and _run_ready(r, n_clients, use_tcpdump)]
+        for run_idx in ready:
+            run_entries, new_summaries, fits, report = \
+                parse_all_clients_for_run(run_idx, n_clients, use_tcpdump,
+                                          by_client, pcap_workers)
+            entries.extend(run_entries)
+            run_summaries.append(new_summaries)
+            run_fits.append(fits)
+            reports.append(report)
+            status = pd.DataFrame([get_run_status(c, run_idx)
+                                   for c in range(n_clients)])
+            status = status.astype(dtype=RUN_STATS_DTYPES)
+            status = __flag_runs(status, report)
+            run_data = pd.concat([run_data, status], ignore_index=True)
+            run_data = run_data.astype(dtype=RUN_STATS_DTYPES)
+            # runs ingested before they were checked are not flagged
+            run_data['flagged'] = \
+                run_data['flagged'].fillna(False).astype(bool)
+            run_data.to_csv('total_run_stats.csv')
+            write_partition_index(entries, run_data=run_data)
+            run_fits = [write_clock_offsets(run_fits)]
+            reports = [pd.concat(reports, ignore_index=True)]
+            reports[0].to_csv(QUALITY_REPORT)
+            summaries = write_frame_summaries(run_summaries)
+            run_summaries = [summaries]
+
+            system_stats = load_system_stats_for_run(run_idx)
+            system_stats.index = pd.RangeIndex(
+                n_system_rows, n_system_rows + system_stats.shape[0])
+            system_stats.to_csv('total_system_stats.csv',
+                                mode='a' if n_system_rows else 'w',
+                                header=not n_system_rows)
+            n_system_rows += system_stats.shape[0]
+            done.add(run_idx)
+
+            failed = (~status['success']).sum()
+            log = LOGGER.warning if failed else LOGGER.info
+            log('Run %d: %d out of %d clients failed; %d out of %d client '
+                'runs successful so far', run_idx + 1, failed, n_clients,
+                run_data['success'].sum(), run_data.shape[0])
+
+        valid = {fb: select_summaries(s, run_data)
+                 for fb, s in summaries.items()} if ready else {}
+        if valid and all(not s.empty for s in valid.values()):
+            results = {fb: summary_stats([s]) for fb, s in valid.items()}
+            __write_sampled_stats(results)
+            proc = results[False].processing
+            LOGGER.info('Processing time without feedback after %d runs: '
+                        '%.2f ms (%.2f - %.2f)', len(done), proc.mean,
+                        proc.conf_lower, proc.conf_upper)
+        if len(done) < n_runs:
+            time.sleep(interval)
+
+    LOGGER.info('All %d runs processed', n_runs)
+    os.chdir('..')
+    update_index([experiment_id])
+
+
+@cli.command()
+@click.argument('experiment_id',
+                type=click.Path(dir_okay=True, file_okay=False, exists=True))
+@click.option('--interval', type=float, default=10.0,
+              help='Seconds between checks for new runs.')
+@click.option('--use_tcpdump', type=bool, default=True)
+@click.option('--partition_by_client', is_flag=True, default=False,
+              help='Store frames in one partition per run and client.')
+@click.option('--pcap_workers', type=int, default=1,
+              help='Processes parsing each tcpdump capture.')
+def watch(experiment_id, interval, use_tcpdump, partition_by_client,
+          pcap_workers):
+    """
+    Processes the runs of an experiment as they are completed.
+    """
+    __watch(experiment_id, interval, use_tcpdump, partition_by_client,
+            pcap_workers)
+
+
+def __task_efficiency(experiment_id):
+    os.chdir(experiment_id)
+    run_data = pd.read_csv('total_run_stats.csv')
+    efficiency = task_efficiency_stats(
+        iter_frame_partitions(run_data=run_data,
+                              keys=run_data.loc[run_data['success']]),
+        run_data)
+    with open('task_efficiency_stats.json', 'w') as f:
+        json.dump(round_floats(efficiency), f)
+
+    os.chdir('..')
+
+
+@cli.command()
+@click.argument('experiment_id',
+                type=click.Path(dir_okay=True, file_okay=False, exists=True))
+def task_efficiency(experiment_id):
+    __task_efficiency(experiment_id)
+
+
 def __prepare_client_stats(experiment_id, n_clients,
                            n_runs, only_system_stats=False,
-                           use_tcpdump=True):
+                           use_tcpdump=True, by_client=False,
+                           pcap_workers=1):
     os.chdir(experiment_id)
 
     with Pool(min(6, n_runs)) as pool:
         if not only_system_stats:
-            runs_df = pool.starmap(
-                parse_all_clients_for_run,
-                zip(
-                    range(n_runs),
-                    itertools.repeat(n_clients),
-                    itertools.repeat(use_tcpdump)
-                )
+            # stale partitions from a previous, larger, processing
+            for filename in frame_partition_files() + \
+                    network_partition_files():
+                os.remove(filename)
+
+            args = zip(
+                range(n_runs),
+                itertools.repeat(n_clients),
+                itertools.repeat(use_tcpdump),
+                itertools.repeat(by_client),
+                itertools.repeat(pcap_workers)
             )
-            runs = pd.concat(runs_df, ignore_index=True)
-            runs.to_csv('total_frame_stats.csv')
+            if use_tcpdump and pcap_workers > 1:
+                # pool workers are daemonic and cannot start the capture
+                # parsers' own processes, so runs are parsed one at a time
+                # with the parallelism inside each capture instead
+                results = list(itertools.starmap(parse_all_clients_for_run,
+                                                 args))
+            else:
+                results = pool.starmap(parse_all_clients_for_run, args)
+            index = write_partition_index(
+                list(itertools.chain(*(e for e, _, _, _ in results))))
+            write_frame_summaries(s for _, s, _, _ in results)
+            __log_clock_offsets(
+                write_clock_offsets(f for _, _, f, _ in results))
+            __write_quality_report(
+                pd.concat((r for _, _, _, r in results), ignore_index=True))
+            LOGGER.info('Wrote %d frames in %d partitions',
+                        index['rows'].sum(), index.shape[0])
 
         system_dfs = pool.map(load_system_stats_for_run, range(n_runs))
         system_stats = pd.concat(system_dfs, ignore_index=True)
@@ -332,8 +749,15 @@ def __prepare_client_stats(experiment_id, n_clients,
 @click.argument('n_runs', type=int)
 @click.option('--only_system_stats', type=bool, default=False,
               help='Only prepare system stats.')
-def prepare_client_stats(experiment_id, n_clients, n_runs, only_system_stats):
-    __prepare_client_stats(experiment_id, n_clients, n_runs, only_system_stats)
+@click.option('--partition_by_client', is_flag=True, default=False,
+              help='Store frames in one partition per run and client.')
+@click.option('--pcap_workers', type=int, default=1,
+              help='Processes parsing each tcpdump capture.')
+def prepare_client_stats(experiment_id, n_clients, n_runs, only_system_stats,
+                         partition_by_client, pcap_workers):
+    __prepare_client_stats(experiment_id, n_clients, n_runs, only_system_stats,
+                           by_client=partition_by_client,
+                           pcap_workers=pcap_workers)
 
 
 @cli.command()
@@ -342,10 +766,90 @@ def prepare_client_stats(experiment_id, n_clients, n_runs, only_system_stats):
 @click.argument('n_clients', type=int)
 @click.argument('n_runs', type=int)
 @click.argument('use_tcpdump', type=bool, default=True)
-def process_all(experiment_id, n_clients, n_runs, use_tcpdump):
-    __prepare_client_stats(experiment_id, n_clients, n_runs, False, use_tcpdump)
+@click.option('--partition_by_client', is_flag=True, default=False,
+              help='Store frames in one partition per run and client.')
+@click.option('--pcap_workers', type=int, default=1,
+              help='Processes parsing each tcpdump capture.')
+def process_all(experiment_id, n_clients, n_runs, use_tcpdump,
+                partition_by_client, pcap_workers):
+    __prepare_client_stats(experiment_id, n_clients, n_runs, False,
+                           use_tcpdump, partition_by_client, pcap_workers)
     __prepare_task_stats(experiment_id, n_clients, n_runs)
     __sample_data(experiment_id)
+    __task_efficiency(experiment_id)
+    update_index([experiment_id])
+
+
+@cli.command()
+@click.argument('experiment_id',
+                type=click.Path(dir_okay=True, file_okay=False, exists=True))
+@click.argument('n_clients', type=int)
+@click.argument('run', type=int)
+@click.option('--pcap_workers', type=int, default=4,
+              help='Processes parsing the capture in the split parse.')
+def check_pcap_split(experiment_id, n_clients, run, pcap_workers):
+    """
+    Compares split and single-process parses of the capture of a run.
+    """
+    os.chdir(experiment_id)
+    single = load_pcap_parser(run - 1, n_clients)
+    split = load_pcap_parser(run - 1, n_clients, pcap_workers)
+    os.chdir('..')
+
+    diffs = single.differences(split)
+    for diff in diffs:
+        LOGGER.error('%s differs with %d workers', diff, pcap_workers)
+    if diffs:
+        sys.exit(1)
+    LOGGER.info('Run %d parses the same with 1 and %d workers', run,
+                pcap_workers)
+
+
+@cli.command()
+@click.argument('experiment_ids', nargs=-1,
+                type=click.Path(dir_okay=True, file_okay=False, exists=True))
+@click.option('--codec', type=click.Choice(['lzma', 'zstd']), default='lzma',
+              help='Compression of the archive blocks.')
+@click.option('--remove', is_flag=True, default=False,
+              help='Delete the archived files once the archive is verified.')
+def archive(experiment_ids, codec, remove):
+    """
+    Stores the run statistics of each experiment in a compressed columnar
+    archive.
+    """
+    for experiment_id in experiment_ids:
+        archive_experiment(experiment_id, codec=codec)
+        if not remove:
+            continue
+        mismatches = verify_archive(experiment_id)
+        if mismatches:
+            LOGGER.error('%s: %d files differ from their archived version, '
+                         'e.g. %s; nothing was removed', experiment_id,
+                         len(mismatches), mismatches[0])
+            continue
+        LOGGER.info('%s: removed %d archived files', experiment_id,
+                    remove_archived_files(experiment_id))
+
+
+@cli.command()
+@click.argument('experiment_ids', nargs=-1,
+                type=click.Path(dir_okay=True, file_okay=False, exists=True))
+@click.option('--remove', is_flag=True, default=False,
+              help='Delete the archive once the run files are restored.')
+def unarchive(experiment_ids, remove):
+    """
+    Restores, byte for byte, the run files of each experiment from its
+    archive. Files already present are kept.
+    """
+    for experiment_id in experiment_ids:
+        LOGGER.info('%s: restored %d files', experiment_id,
+                    unarchive_experiment(experiment_id))
+        if remove:
+            if verify_archive(experiment_id):
+                LOGGER.error('%s: run files differ from the archive, which '
+                             'was kept', experiment_id)
+            else:
+                os.remove(os.path.join(experiment_id, ARCHIVE_FILE))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,316 @@
+"""
+ Copyright 2019 Manuel Olguín
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import os
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from cache import EXPERIMENT_CACHE
+from util import CLOCK_FILE, FRAMES_DIR, METRICS, TIME_COLUMNS, \
+    compute_metric, frame_partition_files, iter_frame_partitions, \
+    load_run_data
+
+# frame-level filters, evaluated while scanning the frame table
+FRAME_FILTERS = ('feedback', 'run_id', 'client_id', 'state_index')
+
+# run-level filters, resolved against total_run_stats.csv and then applied
+# during the scan
+RUN_FILTERS = ('success',)
+
+KEY_COLUMNS = ('run_id', 'client_id')
+
+
+def _as_set(value) -> set:
+    if isinstance(value, (list, tuple, set, frozenset, np.ndarray)):
+        return set(value)
+    return {value}
+
+
+class Query:
+    """
+    Lazy query over the frame tables of a set of experiments; nothing is read
+    until collect(). Frames are filtered as in valid_frames().
+    """
+
+    def __init__(self,
+                 experiments: 'OrderedDict[str, str]',
+                 filters: Tuple[Tuple[str, object], ...] = (),
+                 metrics: Tuple[str, ...] = (),
+                 group_keys: Tuple[str, ...] = ()):
+        self.experiments = experiments
+        self.filters = filters
+        self.metrics = metrics
+        self.group_keys = group_keys
+
+    def _replace(self, **kwargs) -> 'Query':
+        params = dict(experiments=self.experiments,
+                      filters=self.filters,
+                      metrics=self.metrics,
+                      group_keys=self.group_keys)
+        params.update(kwargs)
+        return Query(**params)
+
+    def where(self, **filters) -> 'Query':
+        for key in filters:
+            if key not in FRAME_FILTERS + RUN_FILTERS:
+                raise ValueError('Unsupported filter: {}'.format(key))
+        return self._replace(filters=self.filters + tuple(filters.items()))
+
+    def metric(self, *metrics: str) -> 'Query':
+        for m in metrics:
+            if m not in METRICS:
+                raise ValueError('Unknown metric: {}'.format(m))
+        return self._replace(metrics=self.metrics + metrics)
+
+    def groupby(self, *keys: str) -> 'Query':
+        return self._replace(group_keys=self.group_keys + keys)
+
+    def columns(self) -> List[str]:
+        """
+        Frame table columns needed to evaluate this query.
+        """
+        cols = set(KEY_COLUMNS) | set(TIME_COLUMNS)
+        cols.update(k for k, _ in self.filters if k in FRAME_FILTERS)
+        cols.update(k for k in self.group_keys if k != 'experiment')
+        return sorted(cols)
+
+    def scan_mask(self, frame_data: pd.DataFrame,
+                  run_data: pd.DataFrame) -> np.ndarray:
+        """
+        Rows of the frame table selected by this query, including the
+        (run, client) pairs that pass the run-level filters.
+        """
+        mask = np.ones(frame_data.shape[0], dtype=bool)
+        for key, value in self.filters:
+            if key in FRAME_FILTERS:
+                mask &= frame_data[key].isin(_as_set(value)).values
+
+        if any(k in RUN_FILTERS for k, _ in self.filters):
+            runs = self.run_mask(run_data)
+            keys = pd.MultiIndex.from_frame(runs[list(KEY_COLUMNS)])
+            mask &= pd.MultiIndex.from_frame(
+                frame_data[list(KEY_COLUMNS)]).isin(keys)
+        return mask
+
+    def run_mask(self, run_data: pd.DataFrame) -> pd.DataFrame:
+        """
+        Applies the run-level filters to the run table. Filtering on success
+        also drops runs flagged by the quality checks, as filter_runs() does.
+        """
+        for key, value in self.filters:
+            if key == 'success':
+                if value:
+                    run_data = run_data.loc[run_data['success']]
+                    if 'flagged' in run_data.columns:
+                        run_data = run_data.loc[~run_data['flagged']]
+                else:
+                    run_data = run_data.loc[~run_data['success']]
+        return run_data
+
+    def partition_keys(self, run_data: pd.DataFrame) -> Optional[pd.DataFrame]:
+        """
+        (run, client) pairs this query can select rows from, used to skip
+        frame partitions; None if it may select from any of them.
+        """
+        keyed = [k for k, _ in self.filters
+                 if k in RUN_FILTERS or k in KEY_COLUMNS]
+        if not keyed:
+            return None
+        pairs = self.run_mask(run_data)
+        for key, value in self.filters:
+            if key in KEY_COLUMNS:
+                pairs = pairs.loc[pairs[key].isin(_as_set(value))]
+        return pairs[list(KEY_COLUMNS)]
+
+    def plan(self) -> Dict:
+        return {
+            'experiments': list(self.experiments.items()),
+            'columns'    : self.columns(),
+            'scan_filters': [f for f in self.filters
+                             if f[0] in FRAME_FILTERS],
+            'run_filters': [f for f in self.filters if f[0] in RUN_FILTERS],
+            'metrics'    : list(self.metrics),
+            'groupby'    : list(self.group_keys)
+        }
+
+    def collect(self) -> Union[pd.DataFrame, 'OrderedDict']:
+        return collect_all(self)[0]
+
+    def cache_key(self) -> Tuple:
+        """
+        Identifies the rows and columns this query selects from any single
+        experiment.
+        """
+        filters = tuple((k, tuple(sorted(_as_set(v), key=repr)))
+                        for k, v in self.filters)
+        return ('query', filters, self.metrics,
+                tuple(k for k in self.group_keys if k != 'experiment'))
+
+    def _select(self, data: pd.DataFrame,
+                run_data: pd.DataFrame) -> pd.DataFrame:
+        data = data.loc[self.scan_mask(data, run_data)]
+        result = data[[c for c in data.columns
+                       if c in KEY_COLUMNS or c in self.group_keys]].copy()
+        for m in self.metrics:
+            result[m] = compute_metric(data, m)
+        return result
+
+    def _finish(self, selections: Dict[Tuple[str, Tuple], pd.DataFrame]) \
+            -> Union[pd.DataFrame, 'OrderedDict']:
+        results = []
+        for exp_name, exp_dir in self.experiments.items():
+            result = selections[(exp_dir, self.cache_key())] \
+                .copy(deep=False)
+            result.insert(0, 'experiment', exp_name)
+            results.append(result)
+
+        result = pd.concat(results, ignore_index=True)
+        result['experiment'] = pd.Categorical(result['experiment'],
+                                              categories=list(
+                                                  self.experiments.keys()))
+        if not self.group_keys:
+            return result
+
+        keys = list(self.group_keys)
+        groups = OrderedDict()
+        for key, group in result.groupby(keys[0] if len(keys) == 1 else keys,
+                                         sort=False, observed=True):
+            groups[key] = group
+        if 'experiment' in keys and len(keys) == 1:
+            # keep the order in which experiments were given
+            groups = OrderedDict((e, groups[e]) for e in self.experiments
+                                 if e in groups)
+        else:
+            groups = OrderedDict(sorted(groups.items()))
+        return groups
+
+
+def _scan(exp_dir: str, columns: List[str], queries: List[Query],
+          run_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Reads the columns and rows the queries need from the frame table of an
+    experiment, one partition at a time.
+    """
+    keys = [q.partition_keys(run_data) for q in queries]
+    keys = None if any(k is None for k in keys) else pd.concat(keys)
+
+    chunks = []
+    for chunk in iter_frame_partitions(exp_dir, run_data, columns, keys):
+        mask = np.zeros(chunk.shape[0], dtype=bool)
+        for q in queries:
+            mask |= q.scan_mask(chunk, run_data)
+
+        # same validity rules as valid_frames()
+        for m in ('processing', 'uplink', 'downlink'):
+            mask &= (compute_metric(chunk, m) > 0).values
+        chunks.append(chunk.loc[mask])
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def source_fingerprint(exp_dir: str) -> str:
+    """
+    Cheap fingerprint of the processed tables of an experiment, based on
+    file sizes and modification times. Used to invalidate derived results.
+    """
+    parts = []
+    partitions = frame_partition_files(exp_dir)
+    if partitions:
+        stats = [os.stat(p) for p in partitions]
+        parts.append('{}:{}:{}:{}'.format(
+            FRAMES_DIR, len(stats), sum(st.st_size for st in stats),
+            max(st.st_mtime_ns for st in stats)))
+    for filename in ('total_frame_stats.csv', 'total_run_stats.csv',
+                     os.path.join(FRAMES_DIR, CLOCK_FILE)):
+        try:
+            st = os.stat(os.path.join(exp_dir, filename))
+            parts.append('{}:{}:{}'.format(filename, st.st_size,
+                                           st.st_mtime_ns))
+        except FileNotFoundError:
+            parts.append('{}:missing'.format(filename))
+    return ';'.join(parts)
+
+
+def collect_all(*queries: Query) -> List:
+    """
+    Evaluates several queries with a single scan of the frame table of each
+    experiment. Results are cached until the tables change.
+    """
+    by_dir = OrderedDict()
+    for q in queries:
+        for exp_dir in q.experiments.values():
+            by_dir.setdefault(exp_dir, []).append(q)
+
+    selections = {}
+    for exp_dir, exp_queries in by_dir.items():
+        fingerprint = source_fingerprint(exp_dir)
+        missing = OrderedDict()
+        for q in exp_queries:
+            key = q.cache_key()
+            cached = EXPERIMENT_CACHE.get('derived', exp_dir, key,
+                                          fingerprint)
+            if cached is None:
+                missing.setdefault(key, q)
+            else:
+                selections[(exp_dir, key)] = cached
+        if not missing:
+            continue
+
+        run_data = load_run_data(exp_dir)
+        columns = sorted(set().union(*(q.columns()
+                                       for q in missing.values())))
+        scan = _scan(exp_dir, columns, list(missing.values()), run_data)
+        for key, q in missing.items():
+            selection = q._select(scan, run_data)
+            EXPERIMENT_CACHE.put('derived', exp_dir, key, fingerprint,
+                                 selection)
+            selections[(exp_dir, key)] = selection
+
+    return [q._finish(selections) for q in queries]
+
+
+class Experiments:
+    """
+    Entry point for queries, e.g. Experiments(experiments).select()
+    .where(success=True).metric('rtt').collect()
+    """
+
+    def __init__(self, experiments: Dict[str, str], root_dir: str = None):
+        root_dir = root_dir or os.getcwd()
+        self.experiments = OrderedDict(
+            (name, os.path.join(root_dir, exp_dir))
+            for name, exp_dir in experiments.items())
+
+    def select(self, *names: str) -> Query:
+        if not names:
+            return Query(self.experiments)
+        return Query(OrderedDict((n, self.experiments[n]) for n in names))
+
+
+def collect_metrics(experiments: Dict[str, str],
+                    metrics: Iterable[str],
+                    **filters) -> 'OrderedDict[str, pd.DataFrame]':
+    """
+    Shorthand for the common case of per-experiment metrics of successful
+    runs.
+    """
+    filters.setdefault('success', True)
+    return Experiments(experiments).select().where(**filters) \
+        .metric(*metrics).groupby('experiment').collect()
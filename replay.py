@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+ Copyright 2019 Manuel Olguín
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import asyncio
+import json
+import os
+import struct
+import time
+from typing import Dict, List, NamedTuple
+
+import click
+
+from archive import load_client_stats
+from concurrent_logging import LOGGER
+from util import client_ports, load_experiment_config
+
+DEFAULT_PAYLOAD_SIZE = 16 * 1024
+RESULT_TIMEOUT = 10.0
+
+TraceFrame = NamedTuple('TraceFrame', [('frame_id', int),
+                                       ('offset', float),
+                                       ('feedback', bool),
+                                       ('state_index', int)])
+
+
+def now_ms() -> float:
+    return time.time() * 1000.0
+
+
+def load_trace(run_dir: str, client_idx: int) -> List[TraceFrame]:
+    """
+    Frame schedule recorded by a client, with send times as millisecond
+    offsets from the start of its run.
+    """
+    exp_dir, run_name = os.path.split(os.path.normpath(run_dir))
+    run_idx = int(run_name.split('_')[-1]) - 1
+    results = load_client_stats(run_idx, client_idx,
+                                exp_dir or '.')['run_results']
+
+    init = results['init']
+    return [TraceFrame(frame['frame_id'],
+                       frame['sent'] - init,
+                       frame['feedback'],
+                       frame.get('state_index', -1))
+            for frame in results['frames']]
+
+
+def encode_frame(frame: TraceFrame, payload: bytes) -> bytes:
+    """
+    Gabriel video message, with the recorded feedback and state in its header.
+    """
+    header = json.dumps({'frame_id'   : frame.frame_id,
+                         'feedback'   : frame.feedback,
+                         'state_index': frame.state_index}).encode('utf-8')
+    return struct.pack('>I', len(header)) + header + \
+        struct.pack('>I', len(payload)) + payload
+
+
+async def read_message(reader: asyncio.StreamReader) -> Dict:
+    (length,) = struct.unpack('>I', await reader.readexactly(4))
+    return json.loads((await reader.readexactly(length)).decode('utf-8'))
+
+
+class ReplayClient:
+    def __init__(self, client_idx: int, trace: List[TraceFrame],
+                 ports: Dict[str, int], host: str, experiment_id: str,
+                 payload_size: int = DEFAULT_PAYLOAD_SIZE,
+                 min_interval: float = 0.0,
+                 closed_loop: bool = True):
+        self.client_idx = client_idx
+        self.trace = trace
+        self.ports = ports
+        self.host = host
+        self.experiment_id = experiment_id
+        self.payload = os.urandom(payload_size)
+        self.min_interval = min_interval
+        self.closed_loop = closed_loop
+        self.pending = {}
+        self.records = []
+
+    async def _receive_results(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while True:
+                result = await read_message(reader)
+                recv = now_ms()
+                waiter = self.pending.pop(result['frame_id'], None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result((recv, result))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    async def run(self) -> Dict:
+        video_reader, video_writer = await asyncio.open_connection(
+            self.host, self.ports['video'])
+        result_reader, result_writer = await asyncio.open_connection(
+            self.host, self.ports['result'])
+        receiver = asyncio.ensure_future(
+            self._receive_results(result_reader))
+
+        loop = asyncio.get_event_loop()
+        init = now_ms()
+        last_sent = None
+        in_flight = []
+        success = True
+
+        for frame in self.trace:
+            # keep the recorded schedule, but never exceed the trace fps
+            target = init + frame.offset
+            if last_sent is not None:
+                target = max(target, last_sent + self.min_interval)
+            delay = (target - now_ms()) / 1000.0
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            waiter = loop.create_future()
+            self.pending[frame.frame_id] = waiter
+            sent = now_ms()
+            video_writer.write(encode_frame(frame, self.payload))
+            await video_writer.drain()
+            last_sent = sent
+
+            if self.closed_loop:
+                # Gabriel clients wait for each result before sending again
+                success &= await self._record(frame, sent, waiter)
+            else:
+                in_flight.append((frame, sent, waiter))
+
+        for frame, sent, waiter in in_flight:
+            success &= await self._record(frame, sent, waiter)
+
+        end = now_ms()
+        receiver.cancel()
+        video_writer.close()
+        result_writer.close()
+
+        LOGGER.info('Client %d replayed %d frames', self.client_idx,
+                    len(self.records))
+        return {
+            'client_id'    : self.client_idx,
+            'experiment_id': self.experiment_id,
+            'ports'        : self.ports,
+            'run_results'  : {
+                'init'           : init,
+                'end'            : end,
+                'timestamp_error': 0.0,
+                'success'        : bool(success),
+                'ntp_offset'     : 0.0,
+                'frames'         : self.records
+            }
+        }
+
+    async def _record(self, frame: TraceFrame, sent: float,
+                      waiter: asyncio.Future) -> bool:
+        try:
+            recv, result = await asyncio.wait_for(waiter, RESULT_TIMEOUT)
+        except asyncio.TimeoutError:
+            LOGGER.warning('Client %d: no result for frame %d',
+                           self.client_idx, frame.frame_id)
+            self.pending.pop(frame.frame_id, None)
+            return False
+
+        record = {
+            'frame_id'   : frame.frame_id,
+            'sent'       : sent,
+            'recv'       : recv,
+            'feedback'   : result.get('feedback', frame.feedback),
+            'state_index': result.get('state_index', frame.state_index)
+        }
+        # server timestamps, in seconds, as in the NoTCPDUMP experiments
+        if 'server_recv' in result and 'server_sent' in result:
+            record['server_recv'] = result['server_recv']
+            record['server_sent'] = result['server_sent']
+        self.records.append(record)
+        return True
+
+
+async def replay_run(trace_run_dir: str, n_clients: int, config: Dict,
+                     host: str, **client_opts) -> List[Dict]:
+    n_recorded = config['clients']
+    clients = [
+        ReplayClient(c, load_trace(trace_run_dir, c % n_recorded),
+                     client_ports(config, c), host, config['experiment_id'],
+                     **client_opts)
+        for c in range(n_clients)
+    ]
+    return await asyncio.gather(*(c.run() for c in clients))
+
+
+async def served_run(trace_run_dir: str, run_dir: str, n_clients: int,
+                     config: Dict, host: str, server_opts: Dict,
+                     **client_opts) -> List[Dict]:
+    """
+    Replays a run against a stand-in server which records to run_dir.
+    """
+    from gabriel_server import GabrielStandIn, run_server
+
+    server = GabrielStandIn(config, n_clients, host=host, **server_opts)
+    await server.start()
+    server_task = asyncio.ensure_future(run_server(server, run_dir, None,
+                                                   False))
+    try:
+        return await replay_run(trace_run_dir, n_clients, config, host,
+                                **client_opts)
+    finally:
+        server.stop()
+        await server_task
+
+
+@click.command()
+@click.argument('experiment_id',
+                type=click.Path(dir_okay=True, file_okay=False, exists=True))
+@click.argument('output_dir', type=click.Path(file_okay=False))
+@click.option('--clients', type=int, default=None,
+              help='Number of virtual clients (default: as recorded).')
+@click.option('--runs', type=int, default=1,
+              help='Number of recorded runs to replay.')
+@click.option('--host', type=str, default='127.0.0.1')
+@click.option('--payload_size', type=int, default=DEFAULT_PAYLOAD_SIZE,
+              help='Size in bytes of the dummy frame payloads.')
+@click.option('--open_loop', is_flag=True, default=False,
+              help='Do not wait for results before sending the next frame.')
+@click.option('--serve', is_flag=True, default=False,
+              help='Start a Gabriel stand-in server on HOST for each run, '
+                   'recording its server and system stats in the run.')
+@click.option('--workers', type=int, default=os.cpu_count(),
+              help='Frames processed concurrently by the stand-in server.')
+@click.option('--model', 'model_dir', default=None,
+              type=click.Path(dir_okay=True, file_okay=False, exists=True),
+              help='Experiment whose fitted processing time distributions '
+                   'the stand-in server uses as service time model.')
+@click.option('--constant', type=float, default=20.0,
+              help='Service time in ms when no fitted model is available.')
+@click.option('--busy', is_flag=True, default=False,
+              help='Burn CPU in the stand-in server instead of sleeping.')
+@click.option('--seed', type=int, default=None)
+def replay(experiment_id, output_dir, clients, runs, host, payload_size,
+           open_loop, serve, workers, model_dir, constant, busy, seed):
+    """
+    Replays the runs of EXPERIMENT_ID, writing the measurements to OUTPUT_DIR.
+    """
+    config = load_experiment_config(experiment_id)
+    n_clients = clients or config['clients']
+    fps = config.get('fps')
+    min_interval = 1000.0 / fps if fps else 0.0
+    client_opts = dict(payload_size=payload_size, min_interval=min_interval,
+                       closed_loop=not open_loop)
+    if serve:
+        from gabriel_server import ServiceTimeModel
+        server_opts = dict(model=ServiceTimeModel(model_dir, constant, seed),
+                           workers=workers, busy=busy)
+
+    os.makedirs(output_dir, exist_ok=True)
+    out_config = dict(config, clients=n_clients, runs=runs,
+                      ports=[client_ports(config, c)
+                             for c in range(n_clients)])
+    with open(os.path.join(output_dir, 'experiment_config.json'), 'w') as f:
+        json.dump(out_config, f)
+
+    for run_idx in range(runs):
+        LOGGER.info('Replaying run %d with %d clients', run_idx + 1,
+                    n_clients)
+        trace_dir = os.path.join(experiment_id, 'run_{}'.format(run_idx + 1))
+        run_dir = os.path.join(output_dir, 'run_{}'.format(run_idx + 1))
+        os.makedirs(run_dir, exist_ok=True)
+        if serve:
+            results = asyncio.run(served_run(trace_dir, run_dir, n_clients,
+                                             config, host, server_opts,
+                                             **client_opts))
+        else:
+            results = asyncio.run(replay_run(trace_dir, n_clients, config,
+                                             host, **client_opts))
+
+        for result in results:
+            filename = '{:02}_stats.json'.format(result['client_id'])
+            with open(os.path.join(run_dir, filename), 'w') as f:
+                json.dump(result, f)
+
+
+if __name__ == '__main__':
+    replay()
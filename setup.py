@@ -0,0 +1,43 @@
+"""
+ Copyright 2019 Manuel Olguín
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+from setuptools import setup
+
+with open('requirements.txt', 'r') as f:
+    requirements = [line.strip() for line in f if line.strip()]
+
+setup(
+    name='edgedroid-results',
+    version='0.1.0',
+    description='Processing and analysis of EdgeDroid experiment results',
+    license='Apache License 2.0',
+    python_requires='>=3.6',
+    # the modules import each other by name, so they are installed flat
+    py_modules=['archive', 'cache', 'clock_sync', 'compare',
+                'concurrent_logging', 'data_quality', 'dist_fit',
+                'experiment_index', 'gabriel_server', 'histograms',
+                'lego_timing', 'plot_results', 'process_results', 'query',
+                'replay', 'simulation', 'timeseries', 'util'],
+    install_requires=requirements,
+    entry_points={
+        'console_scripts': [
+            'edgedroid-results=process_results:cli',
+            'edgedroid-replay=replay:replay',
+            'edgedroid-server=gabriel_server:serve',
+            'edgedroid-simulate=simulation:main',
+        ]
+    }
+)
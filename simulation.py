@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+ Copyright 2019 Manuel Olguín
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import heapq
+import json
+import os
+from collections import deque
+from multiprocessing.pool import Pool
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import click
+import numpy as np
+import pandas as pd
+
+from concurrent_logging import LOGGER
+from query import Experiments
+from util import iter_frame_partitions, write_frame_partition, \
+    write_partition_index
+
+# milliseconds before the first frame of each client, drawn uniformly
+START_JITTER = 1000.0
+
+# frame columns needed for the think times and frames per run
+THINK_COLUMNS = ('run_id', 'client_id', 'frame_id', 'client_send',
+                 'client_recv')
+
+Calibration = NamedTuple('Calibration',
+                         [('uplink', np.ndarray),
+                          ('downlink', np.ndarray),
+                          ('processing_fb', np.ndarray),
+                          ('processing_nofb', np.ndarray),
+                          ('think', np.ndarray),
+                          ('frames_per_run', np.ndarray),
+                          ('feedback_prob', float)])
+
+
+def calibrate(experiment_dir: str) -> Calibration:
+    """
+    Empirical network, processing and think times of an experiment's successful
+    runs.
+    """
+    exp_dir = os.path.abspath(experiment_dir)
+    query = Experiments({'exp': exp_dir}).select().where(success=True) \
+        .metric('processing', 'uplink', 'downlink').groupby('feedback')
+    data = query.collect()
+    missing = [name for feedback, name in ((True, 'with'),
+                                           (False, 'without'))
+               if feedback not in data or data[feedback].empty]
+    if missing:
+        raise ValueError('Cannot calibrate from {}: no valid frames {} '
+                         'feedback in its successful runs'
+                         .format(experiment_dir, ' or '.join(missing)))
+    fb = data[True]
+    nofb = data[False]
+
+    # the frames of each client are all in the same partition, so think
+    # times and frame counts are reduced one partition at a time
+    run_data = pd.read_csv(os.path.join(exp_dir, 'total_run_stats.csv'))
+    think = []
+    counts = []
+    for frames in iter_frame_partitions(exp_dir, run_data, THINK_COLUMNS):
+        frames = frames.sort_values(['run_id', 'client_id', 'frame_id'])
+        grouped = frames.groupby(['run_id', 'client_id'])
+        part_think = grouped['client_send'].shift(-1) - frames['client_recv']
+        think.append(part_think.loc[part_think >= 0].values)
+        counts.append(grouped.size())
+    think = np.concatenate(think)
+
+    success = run_data.loc[run_data['success'], ['run_id', 'client_id']]
+    counts = pd.concat(counts)
+    counts = counts.loc[counts.index.isin(
+        pd.MultiIndex.from_frame(success))].values
+
+    both = pd.concat([fb, nofb])
+    return Calibration(uplink=both['uplink'].values,
+                       downlink=both['downlink'].values,
+                       processing_fb=fb['processing'].values,
+                       processing_nofb=nofb['processing'].values,
+                       think=think,
+                       frames_per_run=counts,
+                       feedback_prob=fb.shape[0] / float(both.shape[0]))
+
+
+def estimate_cpu_scale(base_dir: str, throttled_dir: str) -> float:
+    """
+    Slowdown of the mean no-feedback processing time under CPU throttling.
+    """
+    means = []
+    for exp_dir in (base_dir, throttled_dir):
+        filename = os.path.join(exp_dir, 'sampled_time_stats_nofeedback.json')
+        with open(filename, 'r') as f:
+            means.append(json.load(f)['processing']['mean'])
+    return means[1] / means[0]
+
+
+def simulate_run(calibration: Calibration, n_clients: int, n_cores: int,
+                 cpu_scale: float = 1.0, seed: Optional[int] = None,
+                 run_id: int = 0) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Simulates one run of closed-loop clients against n_cores FIFO cores.
+    Returns frame and run tables with times in ms since the start of the run.
+    """
+    rng = np.random.RandomState(seed)
+    n_frames = rng.choice(calibration.frames_per_run, size=n_clients)
+    total = int(n_frames.sum())
+    # index of the first frame of each client in the flat arrays
+    first = np.concatenate(([0], np.cumsum(n_frames)[:-1]))
+
+    feedback = rng.random_sample(total) < calibration.feedback_prob
+    feedback[first] = True  # the first frame always gets instructions
+    processing = np.where(
+        feedback,
+        rng.choice(calibration.processing_fb, size=total),
+        rng.choice(calibration.processing_nofb, size=total)) * cpu_scale
+    uplink = rng.choice(calibration.uplink, size=total)
+    downlink = rng.choice(calibration.downlink, size=total)
+    think = rng.choice(calibration.think, size=total)
+
+    client_send = np.empty(total)
+    server_recv = np.empty(total)
+    server_send = np.empty(total)
+
+    events = []
+    seq = 0
+    starts = rng.uniform(0, START_JITTER, size=n_clients)
+    for c in range(n_clients):
+        i = first[c]
+        client_send[i] = starts[c]
+        events.append((starts[c] + uplink[i], seq, True, i))
+        seq += 1
+    heapq.heapify(events)
+
+    free_cores = n_cores
+    queue = deque()
+    last = first + n_frames - 1
+    is_last = np.zeros(total, dtype=bool)
+    is_last[last] = True
+    while events:
+        t, _, arrival, i = heapq.heappop(events)
+        if arrival:
+            server_recv[i] = t
+            if free_cores > 0:
+                free_cores -= 1
+                heapq.heappush(events, (t + processing[i], seq, False, i))
+                seq += 1
+            else:
+                queue.append(i)
+        else:
+            server_send[i] = t
+            if not is_last[i]:
+                # the client sends its next frame once it gets this result
+                j = i + 1
+                client_send[j] = t + downlink[i] + think[i]
+                heapq.heappush(events, (client_send[j] + uplink[j], seq,
+                                        True, j))
+                seq += 1
+            if queue:
+                k = queue.popleft()
+                heapq.heappush(events, (t + processing[k], seq, False, k))
+                seq += 1
+            else:
+                free_cores += 1
+
+    client_ids = np.repeat(np.arange(n_clients), n_frames)
+    frame_ids = np.arange(total) - np.repeat(first, n_frames) + 1
+    steps = np.cumsum(feedback) - np.repeat(np.cumsum(feedback)[first],
+                                            n_frames)
+    frame_data = pd.DataFrame({
+        'client_id'  : client_ids,
+        'frame_id'   : frame_ids,
+        'feedback'   : feedback,
+        'client_send': client_send,
+        'server_recv': server_recv,
+        'server_send': server_send,
+        'client_recv': server_send + downlink,
+        'state_index': steps,
+        'run_id'     : run_id
+    })
+    run_data = pd.DataFrame({
+        'client_id': np.arange(n_clients),
+        'run_id'   : run_id,
+        'start'    : starts,
+        'end'      : (server_send + downlink)[last],
+        'success'  : True
+    })
+    return frame_data, run_data
+
+
+def _simulate_task(args) -> Tuple[List[Dict], pd.DataFrame]:
+    calibration, n_clients, n_cores, cpu_scale, seed, run_id, output_dir = \
+        args
+    frame_data, run_data = simulate_run(calibration, n_clients, n_cores,
+                                        cpu_scale, seed, run_id)
+    # written here, so only the index entries go back to the parent
+    return write_frame_partition(frame_data, run_id, output_dir), run_data
+
+
+def simulate(calibration: Calibration, output_dir: str, n_clients: int,
+             n_runs: int, n_cores: int, cpu_scale: float = 1.0, seed: int = 0,
+             processes: int = 6) -> pd.DataFrame:
+    """
+    Simulates runs in worker processes which write their own partitions.
+    Returns the run table.
+    """
+    tasks = [(calibration, n_clients, n_cores, cpu_scale, seed + r, r,
+              output_dir) for r in range(n_runs)]
+    run_dfs = []
+    entries = []
+    with Pool(min(processes, n_runs)) as pool:
+        for run_entries, run_data in pool.imap(_simulate_task, tasks):
+            entries.extend(run_entries)
+            run_dfs.append(run_data)
+    run_data = pd.concat(run_dfs, ignore_index=True)
+    write_partition_index(entries, output_dir, run_data)
+    return run_data
+
+
+@click.command()
+@click.argument('calibration_dir',
+                type=click.Path(dir_okay=True, file_okay=False, exists=True))
+@click.argument('output_dir', type=click.Path(file_okay=False))
+@click.option('--clients', type=int, default=30)
+@click.option('--runs', type=int, default=100)
+@click.option('--cores', type=int, default=os.cpu_count(),
+              help='Number of simulated backend cores.')
+@click.option('--cpu_scale', type=float, default=1.0,
+              help='Factor applied to processing times.')
+@click.option('--throttled', nargs=2, default=None,
+              type=click.Path(dir_okay=True, file_okay=False, exists=True),
+              help='Estimate the CPU scale factor from a pair of normal and '
+                   'CPU-limited experiments instead.')
+@click.option('--seed', type=int, default=0)
+def main(calibration_dir, output_dir, clients, runs, cores, cpu_scale,
+         throttled, seed):
+    """
+    Simulates an experiment calibrated from CALIBRATION_DIR into OUTPUT_DIR.
+    """
+    if throttled:
+        cpu_scale = estimate_cpu_scale(*throttled)
+        LOGGER.info('Estimated CPU scale factor: %f', cpu_scale)
+
+    calibration = calibrate(calibration_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    run_data = simulate(calibration, output_dir, clients, runs, cores,
+                        cpu_scale, seed)
+    run_data.to_csv(os.path.join(output_dir, 'total_run_stats.csv'))
+    with open(os.path.join(output_dir, 'experiment_config.json'), 'w') as f:
+        json.dump({'experiment_id': 'Simulated_{}'.format(calibration_dir),
+                   'clients'      : clients,
+                   'runs'         : runs,
+                   'cores'        : cores,
+                   'cpu_scale'    : cpu_scale}, f)
+
+
+if __name__ == '__main__':
+    main()
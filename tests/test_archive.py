@@ -0,0 +1,115 @@
+"""
+ Copyright 2019 Manuel Olguín
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import json
+import os
+import random
+
+import pytest
+from pandas.testing import assert_frame_equal
+
+from archive import archive_experiment, load_client_stats, \
+    load_server_stats, load_system_stats, remove_archived_files, \
+    unarchive_experiment, verify_archive, zstandard
+
+
+def _client_stats(rnd, run, client):
+    init = 1536587043199 + run * 100000
+    frames = []
+    for frame_id in range(1, 60):
+        frame = {'frame_id': frame_id,
+                 'sent': init + frame_id * 37,
+                 'recv': init + frame_id * 37 + rnd.randrange(20, 90),
+                 'feedback': rnd.random() < 0.2}
+        if frame_id % 3:
+            # server timestamps in seconds, not present for every frame
+            frame['server_recv'] = round(frame['sent'] / 1000.0 + 0.003, 6)
+            frame['server_sent'] = frame['server_recv'] + 0.1
+        if frame_id == 7:
+            frame['state_index'] = None
+        frames.append(frame)
+    return {'client_id': client,
+            'experiment_id': 'T',
+            'ports': {'video': 8098 + client, 'result': 8111 + client},
+            'run_results': {'init': init, 'end': init + 60 * 37,
+                            'timestamp_error': rnd.random(),
+                            'success': run != 2,
+                            'ntp_offset': rnd.choice([725, 0.1, -3.25]),
+                            'frames': frames}}
+
+
+def _write_experiment(exp_dir, runs=3, clients=2):
+    rnd = random.Random(1)
+    with open(os.path.join(exp_dir, 'experiment_config.json'), 'w') as f:
+        json.dump({'experiment_id': 'T', 'clients': clients,
+                   'runs': runs}, f)
+    files = {}
+    for run in range(1, runs + 1):
+        run_dir = os.path.join(exp_dir, 'run_{}'.format(run))
+        os.makedirs(run_dir)
+        texts = {'server_stats.json': json.dumps(
+            {'server_offset': 0.5 * run, 'run_start': 1.5e12 + run,
+             'run_end': 1.5e12 + run + 60000.25})}
+        rows = ['cpu_load,mem_avail,timestamp']
+        for i in range(50):
+            rows.append('{},{},{}'.format(
+                rnd.choice([12.5, 0.0, 100.0, 33.3]),
+                rnd.randrange(1 << 33), repr(1.5e12 + i * 200.125)))
+        texts['system_stats.csv'] = '\n'.join(rows) + '\n'
+        for client in range(clients):
+            texts['{:02}_stats.json'.format(client)] = json.dumps(
+                _client_stats(rnd, run, client))
+        # a file which is not archived
+        texts['notes.txt'] = 'kept in place'
+        for name, text in texts.items():
+            with open(os.path.join(run_dir, name), 'w') as f:
+                f.write(text)
+            files[os.path.join(run_dir, name)] = text
+    return files
+
+
+@pytest.mark.parametrize('codec', [
+    'lzma',
+    pytest.param('zstd', marks=pytest.mark.skipif(
+        zstandard is None, reason='zstandard is not installed'))])
+def test_archive_round_trip(tmp_path, codec):
+    exp_dir = str(tmp_path)
+    files = _write_experiment(exp_dir)
+    archive_experiment(exp_dir, codec)
+    assert verify_archive(exp_dir) == []
+
+    originals = {name: json.loads(text) for name, text in files.items()
+                 if name.endswith('.json')}
+    system = [load_system_stats(run, exp_dir) for run in range(3)]
+    remove_archived_files(exp_dir)
+    assert sorted(os.listdir(os.path.join(exp_dir, 'run_1'))) \
+        == ['notes.txt']
+
+    # read straight from the archive
+    for run in range(3):
+        run_dir = os.path.join(exp_dir, 'run_{}'.format(run + 1))
+        for client in range(2):
+            assert load_client_stats(run, client, exp_dir) == originals[
+                os.path.join(run_dir, '{:02}_stats.json'.format(client))]
+        assert load_server_stats(run, exp_dir) \
+            == originals[os.path.join(run_dir, 'server_stats.json')]
+        assert_frame_equal(load_system_stats(run, exp_dir), system[run])
+
+    # and restored byte by byte
+    unarchive_experiment(exp_dir)
+    for name, text in files.items():
+        with open(name, 'r', newline='') as f:
+            assert f.read() == text, name
@@ -0,0 +1,131 @@
+"""
+ Copyright 2019 Manuel Olguín
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import json
+import random
+import struct
+
+import pytest
+
+from lego_timing import LEGOTCPdumpParser
+
+VIDEO_PORTS = [60000, 60002]
+RESULT_PORTS = [60001, 60003]
+SERVER = bytes([10, 0, 0, 1])
+
+
+def _packet(src, sport, dst, dport, seq, ack, flags, payload=b''):
+    tcp = struct.pack('>HHIIBBHHH', sport, dport, seq % (1 << 32),
+                      ack % (1 << 32), 5 << 4, flags, 65535, 0, 0)
+    ip = struct.pack('>BBHHHBBH4s4s', 0x45, 0, 40 + len(payload), 0, 0, 64,
+                     6, 0, src, dst)
+    return b'\x00' * 12 + b'\x08\x00' + ip + tcp + payload
+
+
+def _client(rnd, idx, frames):
+    """ Timestamped packets of the video and result connections of a
+    client, with retransmissions. """
+    client = bytes([10, 0, 1, idx + 2])
+    vport, rport = VIDEO_PORTS[idx], RESULT_PORTS[idx]
+    cv, cr = 40000 + idx, 41000 + idx
+    vseq, sv = rnd.randrange(1 << 32), rnd.randrange(1 << 32)
+    rseq, sr = rnd.randrange(1 << 32), rnd.randrange(1 << 32)
+    t = 1000.0 + idx
+    packets = [
+        (t, _packet(client, cv, SERVER, vport, vseq, 0, 0x02)),
+        (t + .1, _packet(SERVER, vport, client, cv, sv, vseq + 1, 0x12)),
+        (t + .2, _packet(client, cv, SERVER, vport, vseq + 1, sv + 1, 0x10)),
+        (t + .3, _packet(SERVER, rport, client, cr, sr, 0, 0x02)),
+        (t + .4, _packet(client, cr, SERVER, rport, rseq, sr + 1, 0x12)),
+        (t + .5, _packet(SERVER, rport, client, cr, sr + 1, rseq + 1, 0x10)),
+    ]
+    vseq, sr, rseq, sv, t = vseq + 1, sr + 1, rseq + 1, sv + 1, t + 1
+    for frame_id in range(frames):
+        header = json.dumps({'frame_id': frame_id}).encode()
+        data = bytes(rnd.randrange(256)
+                     for _ in range(rnd.randrange(2000, 6000)))
+        message = struct.pack('>I', len(header)) + header + \
+            struct.pack('>I', len(data)) + data
+        for off in range(0, len(message), 1400):
+            segment = message[off:off + 1400]
+            packets.append((t, _packet(client, cv, SERVER, vport, vseq + off,
+                                       sv, 0x18, segment)))
+            if rnd.random() < 0.03:
+                packets.append((t + rnd.uniform(5, 60), _packet(
+                    client, cv, SERVER, vport, vseq + off, sv, 0x18,
+                    segment)))
+            packets.append((t + .3, _packet(
+                SERVER, vport, client, cv, sv,
+                vseq + off + len(segment), 0x10)))
+            t += .05
+        vseq += len(message)
+        t += rnd.uniform(5, 20)
+        result = json.dumps({'frame_id': frame_id,
+                             'status': 'success'}).encode()
+        result = struct.pack('>I', len(result)) + result
+        packets.append((t, _packet(SERVER, rport, client, cr, sr, rseq,
+                                   0x18, result)))
+        packets.append((t + .4, _packet(client, cr, SERVER, rport, rseq,
+                                        sr + len(result), 0x10)))
+        sr += len(result)
+        t += rnd.uniform(10, 40)
+    return packets
+
+
+def write_capture(path, seed, loss=0.0, frames=120):
+    """ Writes a capture of two clients, with reordering and, optionally,
+    packet loss. """
+    rnd = random.Random(seed)
+    packets = sorted(p for idx in range(len(VIDEO_PORTS))
+                     for p in _client(rnd, idx, frames))
+    for i in range(len(packets) - 1):
+        if rnd.random() < 0.05:
+            packets[i], packets[i + 1] = packets[i + 1], packets[i]
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        for ts, packet in packets:
+            if rnd.random() < loss:
+                continue
+            sec = int(ts // 1000)
+            usec = int(round((ts - sec * 1000) * 1000))
+            f.write(struct.pack('<IIII', sec, usec, len(packet),
+                                len(packet)))
+            f.write(packet)
+
+
+@pytest.mark.parametrize('loss', [0.0, 0.01, 0.05])
+@pytest.mark.parametrize('seed', [1, 2])
+def test_split_parse_matches_single_parse(tmp_path, seed, loss):
+    capture = str(tmp_path / 'tcp.pcap')
+    write_capture(capture, seed, loss)
+    ports = dict(video_ports=VIDEO_PORTS, result_ports=RESULT_PORTS)
+    single = LEGOTCPdumpParser(capture, **ports)
+    assert single.incoming and single.outgoing
+    for workers in (2, 5, 16):
+        split = LEGOTCPdumpParser(capture, workers=workers, **ports)
+        assert single.differences(split) == []
+
+
+def test_messages_found_without_loss(tmp_path):
+    capture = str(tmp_path / 'tcp.pcap')
+    write_capture(capture, seed=3, frames=40)
+    parser = LEGOTCPdumpParser(capture, workers=4, video_ports=VIDEO_PORTS,
+                               result_ports=RESULT_PORTS)
+    for vport, rport in zip(VIDEO_PORTS, RESULT_PORTS):
+        assert sorted(parser.extract_incoming_timestamps(vport)) \
+            == list(range(40))
+        assert sorted(parser.extract_outgoing_timestamps(rport)) \
+            == list(range(40))
@@ -0,0 +1,87 @@
+"""
+ Copyright 2019 Manuel Olguín
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from simulation import Calibration, simulate, simulate_run
+from util import iter_frame_partitions, load_partition_index
+
+PROCESSING = 20.0
+
+# constant times, so that queueing is the only source of variation
+CALIBRATION = Calibration(uplink=np.array([5.0]),
+                          downlink=np.array([3.0]),
+                          processing_fb=np.array([PROCESSING]),
+                          processing_nofb=np.array([PROCESSING]),
+                          think=np.array([1.0]),
+                          frames_per_run=np.array([40, 60]),
+                          feedback_prob=0.2)
+
+
+def test_seeded_runs_are_reproducible():
+    a, a_runs = simulate_run(CALIBRATION, 5, 2, seed=3)
+    b, b_runs = simulate_run(CALIBRATION, 5, 2, seed=3)
+    assert_frame_equal(a, b)
+    assert_frame_equal(a_runs, b_runs)
+    c, _ = simulate_run(CALIBRATION, 5, 2, seed=4)
+    assert not a.equals(c)
+
+
+def test_closed_loop_clients_queue_for_cores():
+    frames, runs = simulate_run(CALIBRATION, 6, 2, seed=1)
+    assert frames.groupby('client_id')['frame_id'].apply(list).map(
+        lambda ids: ids == list(range(1, len(ids) + 1))).all()
+    assert (frames['server_recv'] - frames['client_send'] == 5.0).all()
+    assert (frames['client_recv'] - frames['server_send'] == 3.0).all()
+    # waiting for a core only ever adds to the service time
+    assert (frames['server_send'] - frames['server_recv']
+            >= PROCESSING - 1e-9).all()
+
+    # never more than two frames in service at once
+    done = np.sort(frames['server_send'].values)
+    assert (done[2:] - done[:-2] >= PROCESSING - 1e-9).all()
+
+    # each client sends its next frame once it got the last result
+    ordered = frames.sort_values(['client_id', 'frame_id'])
+    gaps = ordered.groupby('client_id')['client_send'].shift(-1) \
+        - ordered['client_recv']
+    assert np.allclose(gaps.dropna(), 1.0)
+    assert (runs['end'].values
+            == ordered.groupby('client_id')['client_recv'].max().values).all()
+
+
+def test_no_queueing_with_a_core_per_client():
+    frames, _ = simulate_run(CALIBRATION, 4, 4, seed=2)
+    assert np.allclose(frames['server_send'] - frames['server_recv'],
+                       PROCESSING)
+
+
+def test_simulate_writes_partitions(tmp_path):
+    exp_dir = str(tmp_path)
+    run_data = simulate(CALIBRATION, exp_dir, n_clients=3, n_runs=4,
+                        n_cores=2, seed=5, processes=2)
+    assert list(run_data['run_id'].unique()) == [0, 1, 2, 3]
+
+    index = load_partition_index(exp_dir)
+    assert list(index['run_id']) == [0, 1, 2, 3]
+    frames = pd.concat(iter_frame_partitions(exp_dir, run_data),
+                       ignore_index=True)
+    assert frames.shape[0] == index['rows'].sum()
+    # run r is simulated with seed + r, whichever worker ran it
+    expected, _ = simulate_run(CALIBRATION, 3, 2, seed=7, run_id=2)
+    assert frames.loc[frames['run_id'] == 2].shape[0] == expected.shape[0]
@@ -0,0 +1,66 @@
+"""
+ Copyright 2019 Manuel Olguín
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from util import cluster_summaries, compute_metric, merge_moments
+
+
+def _frames(seed):
+    rnd = np.random.RandomState(seed)
+    parts = []
+    for run_id in range(4):
+        for client_id in range(3):
+            # includes a (run, client) with a single frame
+            n = 1 if (run_id, client_id) == (2, 1) else rnd.randint(5, 300)
+            client_send = 1.5e12 + np.sort(rnd.uniform(0, 6e4, n))
+            server_recv = client_send + rnd.lognormal(2.0, 0.5, n)
+            server_send = server_recv + rnd.gamma(2.0, 10.0 * (run_id + 1),
+                                                  n)
+            parts.append(pd.DataFrame({
+                'run_id'     : run_id,
+                'client_id'  : client_id,
+                'client_send': client_send,
+                'server_recv': server_recv,
+                'server_send': server_send,
+                'client_recv': server_send + rnd.lognormal(2.0, 0.5, n)}))
+    return pd.concat(parts, ignore_index=True)
+
+
+def _check(merged, values):
+    assert merged['count'] == len(values)
+    assert merged['mean'] == pytest.approx(np.mean(values), rel=1e-12)
+    assert merged['m2'] / (merged['count'] - 1) \
+        == pytest.approx(np.var(values, ddof=1), rel=1e-9)
+    assert merged['min'] == np.min(values)
+    assert merged['max'] == np.max(values)
+
+
+@pytest.mark.parametrize('metric', ['processing', 'uplink', 'downlink'])
+def test_merge_moments_matches_pooled_frames(metric):
+    frame_data = _frames(seed=7)
+    values = compute_metric(frame_data, metric)
+    # summaries of disjoint partitions, as stored per run
+    summaries = pd.concat(cluster_summaries(part)
+                          for _, part in frame_data.groupby('run_id'))
+
+    _check(merge_moments(summaries, metric).iloc[0], values.values)
+    by_run = merge_moments(summaries, metric, level='run_id')
+    assert list(by_run.index) == [0, 1, 2, 3]
+    for run_id, merged in by_run.iterrows():
+        _check(merged, values[frame_data['run_id'] == run_id].values)
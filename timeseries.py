@@ -0,0 +1,276 @@
+"""
+ Copyright 2019 Manuel Olguín
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+     http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+"""
+
+import os
+from collections import OrderedDict
+from typing import Dict, Hashable, NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+
+from cache import EXPERIMENT_CACHE, file_fingerprint
+from util import CLOCK_FILE, FRAMES_DIR, METRICS, frame_partition_files, \
+    iter_frame_partitions, load_run_data, load_system_data
+
+# points per plotted series, independent of the number of runs and samples
+DEFAULT_POINTS = 500
+
+# width of the bins runs are resampled into before taking the envelope,
+# in seconds; system stats are sampled every 200 ms, so each bin averages
+# about five samples of a run
+DEFAULT_RESOLUTION = 1.0
+
+ENVELOPE_COLUMNS = ('time', 'min', 'median', 'max', 'runs')
+
+# frame timelines are rasterized into bins of time since the start of the
+# run, in seconds, and of latency, in milliseconds; latencies above the
+# maximum are counted in the last bin
+RASTER_TIME_BIN = 1.0
+RASTER_LATENCY_BIN = 5.0
+RASTER_MAX_LATENCY = 2000.0
+
+# frames per (latency, time) bin, or mean latency per (run, time) bin
+RASTER_VIEWS = ('latency', 'runs')
+RASTER_FACETS = {'client': 'client_id', 'feedback': 'feedback'}
+
+Raster = NamedTuple('Raster', [('image', np.ndarray),
+                               ('x_edges', np.ndarray),
+                               ('y_edges', np.ndarray),
+                               ('frames', int)])
+
+
+def lttb(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """
+    Indices of the points kept by Largest-Triangle-Three-Buckets downsampling
+    of a series sorted by x.
+    """
+    n = len(x)
+    if points >= n or points < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(1, n - 1, points - 1).astype(int)
+    # mean of each bucket, the last point stands in for the one after the
+    # last bucket
+    sizes = np.diff(edges)
+    mean_x = np.append(np.add.reduceat(x[:-1], edges[:-1]) / sizes, x[-1])
+    mean_y = np.append(np.add.reduceat(y[:-1], edges[:-1]) / sizes, y[-1])
+
+    selected = np.empty(points, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        cx, cy = mean_x[i + 1], mean_y[i + 1]
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) -
+                      (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def align_runs(system_data: pd.DataFrame,
+               run_starts: Optional[pd.Series] = None) -> pd.DataFrame:
+    """
+    Adds the seconds since the start of each run to the system stats.
+    """
+    data = system_data.copy(deep=False)
+    runs = data['run'] if 'run' in data.columns \
+        else pd.Series(0, index=data.index)
+    if run_starts is None:
+        starts = data['timestamp'].groupby(runs).transform('min')
+    else:
+        starts = runs.map(run_starts)
+    data['time'] = (data['timestamp'] - starts) / 1000.0
+    return data
+
+
+def run_envelope(data: pd.DataFrame, column: str = 'cpu_load',
+                 resolution: float = DEFAULT_RESOLUTION) -> pd.DataFrame:
+    """
+    Minimum, median and maximum of a column across runs, in time bins of the
+    given width.
+    """
+    runs = data['run'].values if 'run' in data.columns \
+        else np.zeros(data.shape[0], dtype=int)
+    values = data[column].values.astype(np.float64)
+    bins = np.floor(data['time'].values / resolution)
+    valid = np.isfinite(values) & np.isfinite(bins) & (bins >= 0)
+    if not valid.any():
+        return pd.DataFrame(columns=ENVELOPE_COLUMNS)
+
+    _, run_codes = np.unique(runs[valid], return_inverse=True)
+    bins = bins[valid].astype(int)
+    n_runs = run_codes.max() + 1
+    n_bins = bins.max() + 1
+
+    cells = bins * n_runs + run_codes
+    sums = np.bincount(cells, weights=values[valid],
+                       minlength=n_bins * n_runs).reshape(n_bins, n_runs)
+    counts = np.bincount(cells,
+                         minlength=n_bins * n_runs).reshape(n_bins, n_runs)
+    sampled = counts > 0
+    present = sampled.any(axis=1)
+    means = np.full(sums.shape, np.nan)
+    means[sampled] = sums[sampled] / counts[sampled]
+    means = means[present]
+
+    return pd.DataFrame({
+        'time'  : (np.arange(n_bins)[present] + 0.5) * resolution,
+        'min'   : np.nanmin(means, axis=1),
+        'median': np.nanmedian(means, axis=1),
+        'max'   : np.nanmax(means, axis=1),
+        'runs'  : sampled[present].sum(axis=1)
+    }, columns=ENVELOPE_COLUMNS)
+
+
+def downsample_envelope(envelope: pd.DataFrame,
+                        points: int = DEFAULT_POINTS) -> pd.DataFrame:
+    """
+    Reduces an envelope to at most the given number of points without narrowing
+    it.
+    """
+    if envelope.shape[0] <= points:
+        return envelope.reset_index(drop=True)
+    idx = lttb(envelope['time'].values, envelope['median'].values, points)
+    result = envelope.iloc[idx].reset_index(drop=True)
+    result['min'] = np.minimum.reduceat(envelope['min'].values, idx)
+    result['max'] = np.maximum.reduceat(envelope['max'].values, idx)
+    return result
+
+
+def system_timeline(exp_dir: str, column: str = 'cpu_load',
+                    points: int = DEFAULT_POINTS,
+                    resolution: float = DEFAULT_RESOLUTION) -> pd.DataFrame:
+    """
+    Downsampled envelope of a system stats column across all runs of an
+    experiment.
+    """
+    def compute() -> pd.DataFrame:
+        data = align_runs(load_system_data(exp_dir))
+        return downsample_envelope(run_envelope(data, column, resolution),
+                                   points)
+
+    return EXPERIMENT_CACHE.get_or_compute(
+        'derived', exp_dir, ('system_timeline', column, points, resolution),
+        file_fingerprint(os.path.join(exp_dir, 'total_system_stats.csv')),
+        compute)
+
+
+def _add_padded(total: Optional[np.ndarray],
+                part: np.ndarray) -> np.ndarray:
+    """
+    Sum of two arrays of the same number of dimensions, the smaller one
+    padded with zeros at the end of each axis.
+    """
+    if total is None:
+        return part
+    shape = np.maximum(total.shape, part.shape)
+    total = np.pad(total, [(0, n - m) for n, m in zip(shape, total.shape)],
+                   mode='constant')
+    total[tuple(slice(0, m) for m in part.shape)] += part
+    return total
+
+
+def frame_raster(exp_dir: str, view: str = 'latency', metric: str = 'rtt',
+                 facet: Optional[str] = None,
+                 time_bin: float = RASTER_TIME_BIN,
+                 latency_bin: float = RASTER_LATENCY_BIN,
+                 max_latency: float = RASTER_MAX_LATENCY) \
+        -> Dict[Hashable, Raster]:
+    """
+    Rasterized timeline of the frames of an experiment, binned one partition at
+    a time. Returns a raster per facet value, or keyed by None if not faceted.
+    """
+    if view not in RASTER_VIEWS:
+        raise ValueError('Unknown view: {}'.format(view))
+    if facet is not None and facet not in RASTER_FACETS:
+        raise ValueError('Unknown facet: {}'.format(facet))
+    end, start = METRICS[metric]
+    columns = {'run_id', 'client_send', end, start}
+    if facet is not None:
+        columns.add(RASTER_FACETS[facet])
+
+    def compute() -> Dict[Hashable, Raster]:
+        try:
+            run_data = load_run_data(exp_dir)
+        except FileNotFoundError:
+            run_data = None
+
+        max_bin = int(np.ceil(max_latency / latency_bin)) - 1
+        # facet values in order of appearance, as indexed in the rasters
+        keys = OrderedDict()
+        counts = sums = None
+        for partition in iter_frame_partitions(exp_dir, run_data, columns):
+            latency = (partition[end].values -
+                       partition[start].values).astype(np.float64)
+            x = np.floor(partition['client_send'].values / 1000.0 / time_bin)
+            valid = np.isfinite(latency) & (latency >= 0) & \
+                np.isfinite(x) & (x >= 0)
+            if not valid.any():
+                continue
+            x = x[valid].astype(np.int64)
+            latency = latency[valid]
+            if view == 'latency':
+                y = np.minimum(latency // latency_bin, max_bin) \
+                    .astype(np.int64)
+            else:
+                y = partition['run_id'].values[valid].astype(np.int64)
+
+            # all facets are binned at once, as one more axis
+            part_keys = partition[RASTER_FACETS[facet]].values[valid] \
+                if facet is not None else np.zeros(x.shape[0], dtype=int)
+            values, codes = np.unique(part_keys, return_inverse=True)
+            codes = np.array([keys.setdefault(v.item(), len(keys))
+                              for v in values])[codes]
+            shape = (len(keys), y.max() + 1, x.max() + 1)
+            cells = np.ravel_multi_index((codes, y, x), shape)
+            size = int(np.prod(shape))
+            counts = _add_padded(
+                counts, np.bincount(cells, minlength=size).reshape(shape))
+            if view == 'runs':
+                sums = _add_padded(sums, np.bincount(
+                    cells, weights=latency, minlength=size).reshape(shape))
+
+        if counts is None:
+            return OrderedDict()
+        x_edges = np.arange(counts.shape[2] + 1) * time_bin
+        if view == 'latency':
+            y_edges = np.arange(counts.shape[1] + 1) * latency_bin
+            images = counts.astype(np.float64)
+        else:
+            # runs are numbered from 1, as their directories
+            y_edges = np.arange(counts.shape[1] + 1) + 0.5
+            images = np.full(counts.shape, np.nan)
+            np.divide(sums, counts, out=images, where=counts > 0)
+
+        return OrderedDict(
+            (None if facet is None else key,
+             Raster(images[i], x_edges, y_edges, int(counts[i].sum())))
+            for key, i in sorted(keys.items()))
+
+    frames_files = frame_partition_files(exp_dir) or \
+        [os.path.join(exp_dir, 'total_frame_stats.csv')]
+    return EXPERIMENT_CACHE.get_or_compute(
+        'derived', exp_dir,
+        ('frame_raster', view, metric, facet, time_bin, latency_bin,
+         max_latency),
+        file_fingerprint(os.path.join(exp_dir, 'total_run_stats.csv'),
+                         os.path.join(exp_dir, FRAMES_DIR, CLOCK_FILE),
+                         *frames_files),
+        compute)
@@ -14,144 +14,780 @@
  limitations under the License.
 """
 
+import json
 import math
-from typing import NamedTuple
+import os
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, \
+    Tuple
 
+import numpy as np
 import pandas as pd
-from scipy import stats
+
+from cache import EXPERIMENT_CACHE, file_fingerprint
+from clock_sync import ALIGNED_COLUMNS, CLOCK_GROUPS, align_clocks
 
 # TODO: tweak
 SAMPLE_FACTOR = 5
-MIN_SAMPLES = 300  # 300
 CONFIDENCE = 0.95
 Z_STAR = 1.96
+PERCENTILES = (50, 75, 90, 95, 99)
 
 Stats = NamedTuple('Stats', [('mean', float),
                              ('std', float),
+                             ('min', float),
+                             ('max', float),
                              ('conf_lower', float),
-                             ('conf_upper', float)])
+                             ('conf_upper', float),
+                             ('between_run_std', float),
+                             ('runs', int),
+                             ('frames', int),
+                             ('run_medians', Dict[str, float])])
 
 ExperimentTimes = NamedTuple('ExperimentTimes',
                              [('processing', Stats),
                               ('uplink', Stats),
                               ('downlink', Stats)])
 
+# in-memory schema for frame data: small integers for identifiers, and
+# timestamps as float32 millisecond offsets from the start of each run
+FRAME_DTYPES = {
+    'run_id'     : np.int16,
+    'client_id'  : np.int16,
+    'frame_id'   : np.int32,
+    'state_index': np.int16,
+    'feedback'   : bool
+}
+TIME_COLUMNS = ('client_send', 'server_recv', 'server_send', 'client_recv')
+TIME_DTYPE = np.float32
+
+# intervals derived from the timestamps of each frame, as (end, start);
+# they are computed when needed rather than stored, see compute_metric()
+METRICS = OrderedDict([
+    ('processing', ('server_send', 'server_recv')),
+    ('uplink', ('server_recv', 'client_send')),
+    ('downlink', ('client_recv', 'server_send')),
+    ('rtt', ('client_recv', 'client_send'))
+])
+
+# significant digits of the statistics written to JSON files; timestamps
+# are float32 in memory, so further digits are only rounding noise
+JSON_DIGITS = 6
+
+# processed frames are stored in one file per run (or per run and client)
+# in this subdirectory, listed in its index file
+FRAMES_DIR = 'frames'
+PARTITION_INDEX = 'index.csv'
+PARTITION_INDEX_COLUMNS = ['file', 'run_id', 'client_id', 'rows',
+                           'min_time', 'max_time', 'success']
+# client_id of partitions holding all clients of a run
+ALL_CLIENTS = -1
+PARTITION_CHUNKSIZE = 200000
+# per (run, client) moments of the metrics, accumulated while the frames are
+# ingested, see cluster_summaries()
+SUMMARIES_FILE = 'summaries.csv'
+MOMENTS = ('count', 'mean', 'm2', 'min', 'max')
+# per (run, client) clock offsets, removed from the server timestamps of the
+# frames as they are loaded, see clock_sync.estimate_clock_offsets()
+CLOCK_FILE = 'clock_offsets.csv'
+
+# TCP metrics from the captures are stored in one file per run in this
+# subdirectory, in bins of one second, see lego_timing.NETWORK_COUNTERS
+NETWORK_DIR = 'network'
+NETWORK_BIN = 1000.0
+
+
+def load_experiment_config(exp_dir: str = '.') -> Dict:
+    """
+    Loads experiment_config.json or .toml (possibly from the archive) in the
+    layout of the former.
+    """
+    json_file = os.path.join(exp_dir, 'experiment_config.json')
+    toml_file = os.path.join(exp_dir, 'experiment_config.toml')
+    if os.path.exists(json_file):
+        with open(json_file, 'r') as f:
+            return json.load(f)
+    elif os.path.exists(toml_file):
+        with open(toml_file, 'r') as f:
+            text = f.read()
+    else:
+        # archived experiments carry their configuration
+        from archive import archived_config
+        name, text = archived_config(exp_dir)
+        if name.endswith('.json'):
+            return json.loads(text)
+
+    try:
+        import tomllib
+    except ImportError:  # Python < 3.11
+        import toml as tomllib
+
+    exp = tomllib.loads(text)['experiment']
+
+    config = {
+        'experiment_id': exp['name'],
+        'clients'      : exp['clients'],
+        'runs'         : exp['runs'],
+        'steps'        : exp['trace']['steps'],
+        'ntp_server'   : exp['ntp']['servers'][0],
+        'ports'        : [{'video'  : p['video'],
+                           'result' : p['results'],
+                           'control': p['control']}
+                          for p in exp['ports']]
+    }
+    for key in ('fps', 'rewind_seconds', 'max_replays'):
+        config[key] = exp['trace'][key]
+    config['cpu_cores'] = exp.get('performance', {}).get('cpu_cores', [])
+    return config
+
+
+def client_ports(config: Dict, client_idx: int) -> Dict[str, int]:
+    """
+    Port layout of a client. Clients beyond those in the configuration get
+    consecutive port triplets after the last configured one.
+    """
+    ports = config['ports']
+    if client_idx < len(ports):
+        return ports[client_idx]
+    last = ports[-1]
+    shift = 3 * (client_idx - len(ports) + 1)
+    return {k: v + shift for k, v in last.items()}
+
+
+def run_start_times(run_data: pd.DataFrame) -> pd.Series:
+    """
+    Earliest client start time of each run, indexed by run id.
+    """
+    return run_data.groupby('run_id')['start'].min()
+
+
+def compact_frame_data(frame_data: pd.DataFrame,
+                       run_starts: pd.Series = None) -> pd.DataFrame:
+    """
+    Converts frame data to the compact in-memory schema, with timestamps
+    relative to the start of their run.
+    """
+    fallback = frame_data.groupby('run_id')['client_send'].transform('min')
+    if run_starts is not None:
+        reference = run_starts.reindex(frame_data['run_id'].values).values
+        reference = np.where(np.isnan(reference), fallback.values, reference)
+    else:
+        reference = fallback.values
+
+    columns = OrderedDict()
+    for col in frame_data.columns:
+        if col in TIME_COLUMNS:
+            columns[col] = (frame_data[col].values - reference) \
+                .astype(TIME_DTYPE)
+        elif col in FRAME_DTYPES:
+            columns[col] = frame_data[col].values.astype(FRAME_DTYPES[col])
+        else:
+            columns[col] = frame_data[col].values
+    return pd.DataFrame(columns, index=frame_data.index)
+
+
+def frame_partition_path(run_id: int, exp_dir: str = '.',
+                         client_id: int = None) -> str:
+    if client_id is None:
+        name = 'run_{:04}.csv'.format(run_id)
+    else:
+        name = 'run_{:04}_client_{:03}.csv'.format(run_id, client_id)
+    return os.path.join(exp_dir, FRAMES_DIR, name)
+
+
+def write_frame_partition(frame_data: pd.DataFrame, run_id: int,
+                          exp_dir: str = '.',
+                          by_client: bool = False) -> List[Dict]:
+    """
+    Writes the frames of a run to its partition, or to one partition per
+    client, and returns the corresponding entries of the partition index.
+    """
+    os.makedirs(os.path.join(exp_dir, FRAMES_DIR), exist_ok=True)
+    parts = frame_data.groupby('client_id') if by_client \
+        else [(None, frame_data)]
+
+    entries = []
+    for client_id, part in parts:
+        filename = frame_partition_path(
+            run_id, exp_dir, None if client_id is None else int(client_id))
+        part.to_csv(filename, index=False)
+        entries.append({
+            'file'     : os.path.basename(filename),
+            'run_id'   : run_id,
+            'client_id': ALL_CLIENTS if client_id is None else int(client_id),
+            'rows'     : part.shape[0],
+            'min_time' : part['client_send'].min(),
+            'max_time' : part['client_recv'].max()
+        })
+    return entries
+
+
+def valid_runs(run_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Successful (run, client) pairs, minus those flagged by the data quality
+    checks if these have been run.
+    """
+    valid = run_data['success']
+    if 'flagged' in run_data.columns:
+        valid = valid & ~run_data['flagged']
+    return run_data.loc[valid]
+
+
+def _partition_matches(index: pd.DataFrame,
+                       keys: pd.DataFrame) -> np.ndarray:
+    """
+    Partitions containing at least one of the given (run, client) pairs.
+    """
+    keys = keys[['run_id', 'client_id']].drop_duplicates()
+    by_client = pd.MultiIndex.from_frame(keys)
+    part_keys = pd.MultiIndex.from_frame(index[['run_id', 'client_id']])
+    return np.where(index['client_id'] == ALL_CLIENTS,
+                    index['run_id'].isin(keys['run_id']).values,
+                    part_keys.isin(by_client))
+
+
+def write_partition_index(entries: List[Dict], exp_dir: str = '.',
+                          run_data: pd.DataFrame = None) -> pd.DataFrame:
+    index = pd.DataFrame(entries, columns=PARTITION_INDEX_COLUMNS[:-1])
+    index = index.sort_values(['run_id', 'client_id']).reset_index(drop=True)
+    return update_partition_index(exp_dir, run_data, index)
+
+
+def update_partition_index(exp_dir: str = '.',
+                           run_data: pd.DataFrame = None,
+                           index: pd.DataFrame = None) \
+        -> Optional[pd.DataFrame]:
+    """
+    Stores the partition index, with a partition successful if any of its runs
+    is.
+    """
+    if index is None:
+        index = load_partition_index(exp_dir)
+        if index is None:
+            return None
+    if run_data is not None:
+        index['success'] = _partition_matches(index, valid_runs(run_data))
+    else:
+        index['success'] = True
+    index.to_csv(os.path.join(exp_dir, FRAMES_DIR, PARTITION_INDEX),
+                 index=False)
+    return index
+
+
+def load_partition_index(exp_dir: str = '.') -> Optional[pd.DataFrame]:
+    """
+    Index of the frame partitions of an experiment, or None if not partitioned.
+    """
+    try:
+        return pd.read_csv(os.path.join(exp_dir, FRAMES_DIR, PARTITION_INDEX))
+    except FileNotFoundError:
+        pass
+
+    entries = []
+    for filename in frame_partition_files(exp_dir):
+        name = os.path.basename(filename)
+        parts = name[:-len('.csv')].split('_')
+        entries.append({
+            'file'     : name,
+            'run_id'   : int(parts[1]),
+            'client_id': int(parts[3]) if len(parts) > 3 else ALL_CLIENTS,
+            'rows'     : np.nan,
+            'min_time' : np.nan,
+            'max_time' : np.nan,
+            'success'  : True
+        })
+    if not entries:
+        return None
+    return pd.DataFrame(entries, columns=PARTITION_INDEX_COLUMNS)
+
+
+def frame_partition_files(exp_dir: str = '.') -> List[str]:
+    frames_dir = os.path.join(exp_dir, FRAMES_DIR)
+    try:
+        names = sorted(n for n in os.listdir(frames_dir)
+                       if n.startswith('run_') and n.endswith('.csv'))
+    except FileNotFoundError:
+        return []
+    return [os.path.join(frames_dir, n) for n in names]
+
+
+def iter_raw_frame_partitions(exp_dir: str = '.',
+                              columns: Iterable[str] = None,
+                              keys: pd.DataFrame = None) \
+        -> Iterator[pd.DataFrame]:
+    """
+    Yields the frames of an experiment per partition, as stored, skipping
+    partitions without any of the given (run, client) pairs.
+    """
+    usecols = None
+    if columns is not None:
+        usecols = list(columns)
+        if 'run_id' not in usecols:
+            usecols.append('run_id')
+
+    index = load_partition_index(exp_dir)
+    if index is not None:
+        if keys is not None:
+            index = index.loc[_partition_matches(index, keys)]
+        for name in index['file']:
+            yield pd.read_csv(os.path.join(exp_dir, FRAMES_DIR, name),
+                              usecols=usecols)
+        return
+
+    wanted = set(keys['run_id']) if keys is not None else None
+    reader = pd.read_csv(os.path.join(exp_dir, 'total_frame_stats.csv'),
+                         index_col=None if usecols else 0, usecols=usecols,
+                         chunksize=PARTITION_CHUNKSIZE)
+    pending = None
+    for chunk in reader:
+        if pending is not None:
+            chunk = pd.concat([pending, chunk], ignore_index=True)
+        # the last run in the chunk may continue in the next one
+        complete = chunk['run_id'] != chunk['run_id'].iloc[-1]
+        for run_id, part in chunk.loc[complete].groupby('run_id', sort=False):
+            if wanted is None or run_id in wanted:
+                yield part.reset_index(drop=True)
+        pending = chunk.loc[~complete]
+    if pending is not None and not pending.empty and \
+            (wanted is None or pending['run_id'].iloc[0] in wanted):
+        yield pending.reset_index(drop=True)
+
+
+def iter_frame_partitions(exp_dir: str = '.',
+                          run_data: pd.DataFrame = None,
+                          columns: Iterable[str] = None,
+                          keys: pd.DataFrame = None) \
+        -> Iterator[pd.DataFrame]:
+    """
+    Same as iter_raw_frame_partitions(), compacted and with aligned clocks.
+    """
+    run_starts = run_start_times(run_data) if run_data is not None else None
+    offsets = load_clock_offsets(exp_dir)
+    read_columns = columns
+    if offsets is not None and columns is not None:
+        columns = list(columns)
+        if any(c in columns for c in ALIGNED_COLUMNS):
+            read_columns = columns + [
+                c for c in CLOCK_GROUPS + list(ALIGNED_COLUMNS.values())
+                if c not in columns]
+
+    for partition in iter_raw_frame_partitions(exp_dir, read_columns, keys):
+        if offsets is not None:
+            partition = align_clocks(partition, offsets)
+            if read_columns is not columns:
+                partition = partition[[c for c in partition.columns
+                                       if c in columns or c == 'run_id']]
+        yield compact_frame_data(partition, run_starts)
+
+
+def write_clock_offsets(fits: Iterable[pd.DataFrame],
+                        exp_dir: str = '.') -> pd.DataFrame:
+    fits = pd.concat(fits, ignore_index=True) \
+        .sort_values(CLOCK_GROUPS).reset_index(drop=True)
+    os.makedirs(os.path.join(exp_dir, FRAMES_DIR), exist_ok=True)
+    fits.to_csv(os.path.join(exp_dir, FRAMES_DIR, CLOCK_FILE), index=False)
+    return fits
+
+
+def load_clock_offsets(exp_dir: str = '.') -> Optional[pd.DataFrame]:
+    """
+    Clock offsets of an experiment, indexed by run and client, or None if
+    its clocks have not been aligned.
+    """
+    filename = os.path.join(exp_dir, FRAMES_DIR, CLOCK_FILE)
+    try:
+        return EXPERIMENT_CACHE.get_or_compute(
+            'raw', exp_dir, 'clock_offsets', file_fingerprint(filename),
+            lambda: pd.read_csv(filename).set_index(CLOCK_GROUPS))
+    except FileNotFoundError:
+        return None
+
+
+def load_frame_data(exp_dir: str = '.',
+                    run_data: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Loads the whole frame table of an experiment in the compact schema, see
+    compact_frame_data(). Prefer iter_frame_partitions() for reductions.
+    """
+    return pd.concat(iter_frame_partitions(exp_dir, run_data),
+                     ignore_index=True)
+
+
+def load_run_data(exp_dir: str = '.') -> pd.DataFrame:
+    """
+    The run table of an experiment, as read by pd.read_csv. Kept in memory
+    until total_run_stats.csv changes.
+    """
+    filename = os.path.join(exp_dir, 'total_run_stats.csv')
+    return EXPERIMENT_CACHE.get_or_compute(
+        'raw', exp_dir, 'total_run_stats', file_fingerprint(filename),
+        lambda: pd.read_csv(filename))
+
+
+def load_system_data(exp_dir: str = '.') -> pd.DataFrame:
+    """
+    The system statistics of all runs of an experiment, kept in memory until
+    total_system_stats.csv changes.
+    """
+    filename = os.path.join(exp_dir, 'total_system_stats.csv')
+    return EXPERIMENT_CACHE.get_or_compute(
+        'raw', exp_dir, 'total_system_stats', file_fingerprint(filename),
+        lambda: pd.read_csv(filename))
+
+
+def network_partition_path(run_id: int, exp_dir: str = '.') -> str:
+    return os.path.join(exp_dir, NETWORK_DIR, 'run_{:04}.csv'.format(run_id))
+
+
+def network_partition_files(exp_dir: str = '.') -> List[str]:
+    network_dir = os.path.join(exp_dir, NETWORK_DIR)
+    try:
+        names = sorted(n for n in os.listdir(network_dir)
+                       if n.startswith('run_') and n.endswith('.csv'))
+    except FileNotFoundError:
+        return []
+    return [os.path.join(network_dir, n) for n in names]
+
+
+def write_network_partition(network_data: pd.DataFrame, run_id: int,
+                            exp_dir: str = '.') -> None:
+    os.makedirs(os.path.join(exp_dir, NETWORK_DIR), exist_ok=True)
+    network_data.to_csv(network_partition_path(run_id, exp_dir), index=False)
+
+
+def load_network_data(exp_dir: str = '.') -> Optional[pd.DataFrame]:
+    """
+    Network metrics of all runs of an experiment, or None if its captures
+    were not processed.
+    """
+    files = network_partition_files(exp_dir)
+    if not files:
+        return None
+    return pd.concat((pd.read_csv(f) for f in files), ignore_index=True)
+
+
+def join_network_stats(frame_data: pd.DataFrame,
+                       network_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds the uplink_* and downlink_* network metrics of the second each frame
+    was received and answered in.
+    """
+    joined = frame_data.assign(_order=np.arange(frame_data.shape[0]))
+    for direction, time_col in (('uplink', 'server_recv'),
+                                ('downlink', 'server_send')):
+        net = network_data.loc[network_data['direction'] == direction] \
+            .drop(columns='direction')
+        net = net.assign(rtt=net['rtt_sum'] / net['rtt_samples']
+                         .where(net['rtt_samples'] > 0))
+        net = net.rename(columns={
+            c: '{}_{}'.format(direction, c) for c in net.columns
+            if c not in ('run_id', 'client_id', 'time')})
+        joined = pd.merge_asof(
+            joined.sort_values(time_col),
+            net.sort_values('time').rename(columns={'time': '_bin'}),
+            left_on=time_col, right_on='_bin', by=['run_id', 'client_id'],
+            tolerance=NETWORK_BIN, direction='backward').drop(columns='_bin')
+    joined = joined.sort_values('_order').drop(columns='_order')
+    joined.index = frame_data.index
+    return joined
+
 
 def filter_runs(frame_data: pd.DataFrame,
                 run_data: pd.DataFrame) -> pd.DataFrame:
-    n_runs = run_data['run_id'].max() + 1
-    n_clients = run_data['client_id'].max() + 1
+    """
+    Frames of the successful (run, client) pairs not flagged by the quality
+    checks.
+    """
+    keys = pd.MultiIndex.from_frame(valid_runs(run_data)[['run_id',
+                                                          'client_id']])
+    frame_keys = pd.MultiIndex.from_frame(frame_data[['run_id', 'client_id']])
+    return frame_data.loc[frame_keys.isin(keys)]
 
-    samples = []
-    for run in range(n_runs):
-        for client in range(n_clients):
-            success = run_data.loc[run_data['run_id'] == run]
-            success = success.loc[success['client_id'] == client]
-            success = success.iloc[0]['success']
 
-            if success:
-                d = frame_data.loc[frame_data['run_id'] == run]
-                d = d.loc[d['client_id'] == client]
-                samples.append(d)
+def compute_metric(frame_data: pd.DataFrame, metric: str) -> pd.Series:
+    """
+    A derived interval of each frame in milliseconds, always computed in
+    float64.
+    """
+    end, start = METRICS[metric]
+    return frame_data[end].astype(np.float64) - \
+        frame_data[start].astype(np.float64)
 
-    return pd.concat(samples)
 
+def valid_frames(data: pd.DataFrame, feedback: bool) -> pd.DataFrame:
+    """
+    Frames with or without feedback whose processing, uplink and downlink times
+    are all positive. Those left out are counted per run, see clock_sync.
+    """
+    frame_data = data.loc[data['feedback'] == feedback]
+    valid = np.ones(frame_data.shape[0], dtype=bool)
+    for metric in ExperimentTimes._fields:
+        valid &= (compute_metric(frame_data, metric) > 0).values
+    return frame_data.loc[valid]
 
-def calculate_derived_metrics(data, feedback):
-    if feedback:
-        frame_data = data.loc[data['feedback']]
-    else:
-        # filter only frames without feedback
-        frame_data = data.loc[~data['feedback']]
-    frame_data['processing'] = \
-        frame_data['server_send'] - frame_data['server_recv']
-    frame_data['uplink'] = \
-        frame_data['server_recv'] - frame_data['client_send']
-    frame_data['downlink'] = \
-        frame_data['client_recv'] - frame_data['server_send']
-    # only count frames with positive values (time can't be negative)
-    frame_data = frame_data.loc[frame_data['processing'] > 0]
-    frame_data = frame_data.loc[frame_data['uplink'] > 0]
-    frame_data = frame_data.loc[frame_data['downlink'] > 0]
-    return frame_data
-
-
-def sample_frame_stats(f_data: pd.DataFrame,
-                       r_data: pd.DataFrame,
-                       feedback: bool = False) -> ExperimentTimes:
-    frame_data = calculate_derived_metrics(f_data, feedback)
-    frame_data = filter_runs(frame_data, r_data)
-
-    u_runs = frame_data['run_id'].unique()
-    adj_sampl_factor = SAMPLE_FACTOR
-
-    if feedback:
-        samples = [frame_data.loc[frame_data['run_id'] == run_id].sample()
-                   for run_id in u_runs]
+
+def round_floats(obj, digits: int = JSON_DIGITS):
+    """
+    Rounds the floats in a JSON-serializable object to a number of
+    significant digits.
+    """
+    if isinstance(obj, (float, np.floating)):
+        return float('{:.{}g}'.format(obj, digits)) if math.isfinite(obj) \
+            else float(obj)
+    if isinstance(obj, dict):
+        return type(obj)((k, round_floats(v, digits)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [round_floats(v, digits) for v in obj]
+    return obj
+
+
+def _percentiles(series: pd.Series) -> Dict[str, float]:
+    values = np.percentile(series, PERCENTILES) if not series.empty \
+        else [math.nan] * len(PERCENTILES)
+    results = {'p{}'.format(p): float(v) for p, v in zip(PERCENTILES, values)}
+    results['mean'] = float(series.mean())
+    return results
+
+
+def task_efficiency_stats(partitions: Iterable[pd.DataFrame],
+                          run_data: pd.DataFrame) -> Dict:
+    """
+    Task completion times and efficiency of the successful client runs. Frames
+    without feedback count as wasted uploads, in frames and uplink time.
+    """
+    per_client = []
+    for frame_data in partitions:
+        uplink = compute_metric(frame_data, 'uplink').clip(lower=0)
+        wasted = ~frame_data['feedback']
+
+        per_client.append(pd.DataFrame({
+            'run_id'       : frame_data['run_id'],
+            'client_id'    : frame_data['client_id'],
+            'frames'       : 1,
+            'steps'        : frame_data['feedback'].astype(int),
+            'wasted_frames': wasted.astype(int),
+            'uplink'       : uplink,
+            'wasted_uplink': uplink.where(wasted, 0.0)
+        }).groupby(['run_id', 'client_id']).sum())
+    per_client = pd.concat(per_client)
+
+    runs = run_data.set_index(['run_id', 'client_id'])
+    runs = runs.loc[runs['success'], ['start', 'end']]
+    per_client = per_client.join(runs, how='inner')
+
+    completion_time = per_client['end'] - per_client['start']
+    frames_per_step = per_client['frames'] / per_client['steps']
+    frames_per_step = frames_per_step.loc[per_client['steps'] > 0]
+
+    totals = per_client.sum()
+    return {
+        'successful_runs'     : int(per_client.shape[0]),
+        'completion_time'     : _percentiles(completion_time),
+        'frames_per_step'     : _percentiles(frames_per_step),
+        'total_frames'        : int(totals['frames']),
+        'wasted_frames'       : int(totals['wasted_frames']),
+        'wasted_frame_ratio'  : float(totals['wasted_frames']
+                                      / totals['frames']),
+        'total_uplink_time'   : float(totals['uplink']),
+        'wasted_uplink_time'  : float(totals['wasted_uplink']),
+        'wasted_uplink_ratio' : float(totals['wasted_uplink']
+                                      / totals['uplink'])
+    }
+
+
+def cluster_summaries(frame_data: pd.DataFrame,
+                      metrics: Tuple[str, ...] = ExperimentTimes._fields) \
+        -> pd.DataFrame:
+    """
+    Per (run, client) counts, means, m2, minima, maxima and medians of each
+    metric; combine them with merge_moments().
+    """
+    values = pd.DataFrame(OrderedDict(
+        (m, compute_metric(frame_data, m)) for m in metrics))
+    grouped = pd.concat([frame_data[['run_id', 'client_id']], values],
+                        axis=1).groupby(['run_id', 'client_id'])
+    summaries = grouped.agg({m: ['count', 'mean', 'var', 'min', 'max',
+                                 'median'] for m in metrics})
+
+    columns = OrderedDict()
+    for m in metrics:
+        count = summaries[(m, 'count')]
+        for agg in ('count', 'mean', 'm2', 'min', 'max', 'median'):
+            columns['{}_{}'.format(m, agg)] = \
+                (summaries[(m, 'var')] * (count - 1)).fillna(0.0) \
+                if agg == 'm2' else summaries[(m, agg)]
+    return pd.DataFrame(columns, index=summaries.index)
+
+
+def merge_moments(summaries: pd.DataFrame, metric: str,
+                  level: Optional[str] = None) -> pd.DataFrame:
+    """
+    Combines per (run, client) moments of a metric over all frames, or per
+    value of an index level, with Chan et al.'s pairwise update.
+    """
+    parts = pd.DataFrame({m: summaries['{}_{}'.format(metric, m)].values
+                          for m in MOMENTS}, index=summaries.index)
+    parts = parts.loc[parts['count'] > 0]
+    keys = parts.index.get_level_values(level) if level is not None \
+        else np.zeros(parts.shape[0], dtype=int)
+
+    parts['weighted'] = parts['count'] * parts['mean']
+    grouped = parts.groupby(keys)
+    merged = pd.DataFrame({'count': grouped['count'].sum()})
+    merged['mean'] = grouped['weighted'].sum() / merged['count']
+    deviations = parts['count'] * \
+        (parts['mean'] - merged['mean'].reindex(keys).values) ** 2
+    merged['m2'] = grouped['m2'].sum() + deviations.groupby(keys).sum()
+    merged['min'] = grouped['min'].min()
+    merged['max'] = grouped['max'].max()
+    if level is not None:
+        merged.index.name = level
+    return merged
+
+
+def hierarchical_stats(summaries: pd.DataFrame, metric: str) -> Stats:
+    """
+    Frame-level mean and std of a metric, with a run-clustered confidence
+    interval and the between-run std.
+    """
+    # scipy takes longer to import than most commands take to run
+    from scipy import stats
+
+    total = merge_moments(summaries, metric).iloc[0]
+    n = total['count']
+    mean = total['mean']
+    std = math.sqrt(total['m2'] / (n - 1)) if n > 1 else 0.0
+
+    by_run = merge_moments(summaries, metric, level='run_id')
+    n_runs = by_run.shape[0]
+    run_means = by_run['mean']
+
+    if n_runs > 1:
+        residuals = by_run['count'] * (run_means - mean)
+        se = math.sqrt(n_runs / (n_runs - 1.0)
+                       * np.sum(residuals ** 2) / n ** 2)
+        conf = stats.t.interval(CONFIDENCE, n_runs - 1, loc=mean, scale=se) \
+            if se > 0 else (mean, mean)
+
+        within = by_run['m2'].sum() / max(n - n_runs, 1)
+        between = np.sum(by_run['count'] * (run_means - mean) ** 2) \
+            / (n_runs - 1.0)
+        n0 = (n - np.sum(by_run['count'] ** 2) / n) / (n_runs - 1.0)
+        between_std = math.sqrt(max(between - within, 0.0) / n0)
     else:
-        # find number of clients
-        n_clients = frame_data['client_id'].max() + 1
-
-        while True:
-            # take SAMPLE_FACTOR samples per client per run
-            samples = []
-            for run_id in u_runs:
-                run_data = frame_data.loc[frame_data['run_id'] == run_id]
-                for client_id in range(n_clients):
-                    client_data = run_data.loc[
-                        run_data['client_id'] == client_id]
-
-                    if not client_data.empty:
-                        if adj_sampl_factor <= client_data.shape[0]:
-                            samples.append(
-                                client_data.sample(n=adj_sampl_factor)
-                            )
-                        else:
-                            samples.append(client_data)
-
-            if sum(map(lambda s: s.shape[0], samples)) > MIN_SAMPLES:
-                break
-            else:
-                adj_sampl_factor += SAMPLE_FACTOR
-
-        # if client_data.shape[0] >= SAMPLE_FACTOR:
-        #     samples.append(client_data.sample(n=SAMPLE_FACTOR))
-        # else:
-        #    samples.append(client_data)
-
-    samples = pd.concat(samples)
-    print('Total samples:', samples.shape[0])
-    print('Samples per successful run:', adj_sampl_factor)
-
-    # stats for processing times:
-    proc_mean = samples['processing'].mean()
-    proc_std = samples['processing'].std()
-    proc_conf = stats.norm.interval(
-        CONFIDENCE,
-        loc=proc_mean,
-        scale=proc_std / math.sqrt(samples.shape[0])
-    )
-
-    proc_stats = Stats(proc_mean, proc_std, *proc_conf)
-
-    # stats for uplink times:
-    up_mean = samples['uplink'].mean()
-    up_std = samples['uplink'].std()
-    up_conf = stats.norm.interval(
-        CONFIDENCE,
-        loc=up_mean,
-        scale=up_std / math.sqrt(samples.shape[0])
-    )
-    up_stats = Stats(up_mean, up_std, *up_conf)
-
-    # stats for downlink times:
-    down_mean = samples['downlink'].mean()
-    down_std = samples['downlink'].std()
-    down_conf = stats.norm.interval(
-        CONFIDENCE,
-        loc=down_mean,
-        scale=down_std / math.sqrt(samples.shape[0])
-    )
-    down_stats = Stats(down_mean, down_std, *down_conf)
-
-    return ExperimentTimes(proc_stats, up_stats, down_stats)
+        # a single run has no between-run variation to estimate, fall back
+        # to treating its frames as independent
+        conf = stats.norm.interval(CONFIDENCE, loc=mean,
+                                   scale=std / math.sqrt(n))
+        between_std = math.nan
+
+    medians = np.percentile(summaries['{}_median'.format(metric)],
+                            PERCENTILES)
+    return Stats(float(mean), float(std), float(total['min']),
+                 float(total['max']), float(conf[0]), float(conf[1]),
+                 float(between_std), int(n_runs), int(n),
+                 {'p{}'.format(p): float(v)
+                  for p, v in zip(PERCENTILES, medians)})
+
+
+def frame_summaries(partition: pd.DataFrame, r_data: pd.DataFrame,
+                    feedbacks: Tuple[bool, ...] = (True, False)) \
+        -> Dict[bool, pd.DataFrame]:
+    """
+    Per (run, client) summaries of the valid frames of a partition, with and
+    without feedback.
+    """
+    summaries = {}
+    for fb in feedbacks:
+        frame_data = valid_frames(partition, fb)
+        frame_data = filter_runs(frame_data, r_data)
+        summaries[fb] = cluster_summaries(frame_data)
+    return summaries
+
+
+def ingest_summaries(frame_data: pd.DataFrame,
+                     feedbacks: Tuple[bool, ...] = (True, False)) \
+        -> Dict[bool, pd.DataFrame]:
+    """
+    Unfiltered per (run, client) summaries of a run's frames with aligned
+    clocks, as they are ingested.
+    """
+    return {fb: cluster_summaries(valid_frames(frame_data, fb))
+            for fb in feedbacks}
+
+
+def write_frame_summaries(run_summaries: Iterable[Dict[bool, pd.DataFrame]],
+                          exp_dir: str = '.') -> Dict[bool, pd.DataFrame]:
+    """
+    Stores the frame summaries of an experiment next to its partitions.
+    """
+    run_summaries = list(run_summaries)
+    feedbacks = run_summaries[0].keys() if run_summaries else ()
+    summaries = {fb: pd.concat([s[fb] for s in run_summaries]).sort_index()
+                 for fb in feedbacks}
+    table = pd.concat([s.assign(feedback=fb) for fb, s in summaries.items()])
+    os.makedirs(os.path.join(exp_dir, FRAMES_DIR), exist_ok=True)
+    table.to_csv(os.path.join(exp_dir, FRAMES_DIR, SUMMARIES_FILE))
+    return summaries
+
+
+def load_frame_summaries(exp_dir: str = '.') \
+        -> Optional[Dict[bool, pd.DataFrame]]:
+    """
+    Summaries stored by write_frame_summaries(), or None if there are none
+    or any frame partition has been written since.
+    """
+    filename = os.path.join(exp_dir, FRAMES_DIR, SUMMARIES_FILE)
+    try:
+        mtime = os.stat(filename).st_mtime
+    except FileNotFoundError:
+        return None
+    clock_file = os.path.join(exp_dir, FRAMES_DIR, CLOCK_FILE)
+    inputs = frame_partition_files(exp_dir) + \
+        ([clock_file] if os.path.exists(clock_file) else [])
+    if any(os.stat(f).st_mtime > mtime for f in inputs):
+        return None
+
+    table = pd.read_csv(filename, index_col=['run_id', 'client_id'])
+    return {bool(fb): s.drop(columns='feedback')
+            for fb, s in table.groupby('feedback', sort=False)}
+
+
+def select_summaries(summaries: pd.DataFrame,
+                     run_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Summaries of the valid (run, client) pairs, see filter_runs().
+    """
+    keys = pd.MultiIndex.from_frame(valid_runs(run_data)[['run_id',
+                                                          'client_id']])
+    return summaries.loc[summaries.index.isin(keys)]
+
+
+def summary_stats(summaries: Iterable[pd.DataFrame]) -> ExperimentTimes:
+    summaries = pd.concat(summaries)
+    print('Total frames:',
+          int(summaries['{}_count'.format(ExperimentTimes._fields[0])].sum()))
+    print('Client runs:', summaries.shape[0])
+    return ExperimentTimes(*(hierarchical_stats(summaries, metric)
+                             for metric in ExperimentTimes._fields))
+
+
+def aggregate_frame_stats(partitions: Iterable[pd.DataFrame],
+                          r_data: pd.DataFrame,
+                          feedbacks: Tuple[bool, ...] = (True, False)) \
+        -> Dict[bool, ExperimentTimes]:
+    """
+    Hierarchical statistics of each metric over all frames of successful runs,
+    from per (run, client) summaries.
+    """
+    summaries = {fb: [] for fb in feedbacks}
+    for partition in partitions:
+        for fb, fb_summaries in frame_summaries(partition, r_data,
+                                                feedbacks).items():
+            summaries[fb].append(fb_summaries)
+
+    results = {}
+    for fb in feedbacks:
+        print('Feedback:', fb)
+        results[fb] = summary_stats(summaries[fb])
+    return results